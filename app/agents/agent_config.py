@@ -1,114 +1,279 @@
 from app.utils.logger import logger
-import ollama
-import base64
+import asyncio
 import os
+import base64
+import time
+from app.agents import ollama_client
+from app.utils.page_store import PageStore
+from app.utils.image_prep import prepare_vlm_image
+from app.utils.metrics import OUTPUT_PARSES, PAGE_STEP_SECONDS, VLM_CALLS, VLM_PAYLOAD_BYTES
+from app.utils.file_utils import safe_json_parse
+from app.agents.output_schema import fields_schema, schema_num_predict
+from app.utils.tracing import span
 
-image_folder = "./pages/filtered"
 model_name = "qwen2.5vl:7b"
 
-def get_bank_name(page_name="bank_copy"):
+# The bank name answer is a one-field object
+bank_name_schema = fields_schema(["bank_name"])
+
+async def get_bank_name(store: PageStore, page_name="bank_copy"):
     logger.info(f"Extracting bank name from {page_name}...")
-    image_path = os.path.join("./pages", f"{page_name}.png")
-    if not os.path.exists(image_path):
-        logger.warning(f"Image not found: {image_path}")
+    image_bytes = await asyncio.to_thread(store.get_role, page_name)
+    if image_bytes is None:
+        logger.warning(f"Image not found: {page_name}")
         return ""
     
-    with open(image_path, "rb") as f:
-        image_b64 = base64.b64encode(f.read()).decode("utf-8")
+    image_bytes = await asyncio.to_thread(prepare_vlm_image, image_bytes)
+    image_b64 = base64.b64encode(image_bytes).decode("utf-8")
     
     system_prompt = """
     You are a document analysis assistant tasked with extracting the bank name from an official loan document.
-    Return only the bank name as a plain string, with no labels, formatting, or explanations.
+    Return a JSON object with a single "bank_name" field holding the bank name, with no labels, formatting, or explanations.
     Examples: CIMB Bank Berhad, Maybank Berhad, RHB Bank, Public Bank Berhad
-    If no bank name is found, return an empty string.
+    If no bank name is found, return an empty string for "bank_name".
     """
     
     user_prompt = """
-    Extract the bank name from the provided loan document page. Output ONLY the bank name as plain text.
+    Extract the bank name from the provided loan document page. Output ONLY the JSON object.
     """
     
     try:
-        response = ollama.chat(
-            model=model_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt, "images": [image_b64]}
-            ],
-            options={"temperature": 0.3, "max_tokens": 2048}
-        )
-        content = response.get("message", {}).get("content", "").strip()
+        start_time = time.perf_counter()
+        VLM_PAYLOAD_BYTES.labels("bank_name").observe(len(image_bytes))
+        with span("vlm.bank_name", page=page_name, bytes_sent=len(image_bytes)):
+            try:
+                response = await ollama_client.chat(
+                    model=model_name,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt, "images": [image_b64]}
+                    ],
+                    format=bank_name_schema,
+                    options={"temperature": 0.3, "num_predict": schema_num_predict(bank_name_schema)}
+                )
+            except Exception:
+                VLM_CALLS.labels("bank_name", "error").inc()
+                raise
+        VLM_CALLS.labels("bank_name", "ok").inc()
+        PAGE_STEP_SECONDS.labels("vlm").observe(time.perf_counter() - start_time)
+        store.vlm_calls.append({"page": page_name, "purpose": "bank_name", "bytes_sent": len(image_bytes),
+                                "latency_ms": round((time.perf_counter() - start_time) * 1000, 1), "cached": False})
+        parsed = safe_json_parse(response.get("message", {}).get("content", ""))
+        OUTPUT_PARSES.labels("bank_name", "ok" if isinstance(parsed, dict) else "failed").inc()
+        content = str(parsed.get("bank_name") or "").strip() if isinstance(parsed, dict) else ""
         if content:
             return content
         logger.warning("No bank name found.")
         return ""
     except Exception as e:
         logger.warning(f"Error extracting bank name from {page_name}: {e}")
+        store.vlm_calls.append({"page": page_name, "purpose": "bank_name", "bytes_sent": len(image_bytes),
+                                "cached": False, "error": f"{type(e).__name__}: {e}"})
         return ""
 
-def page_fields_mapping(bank_name: str):
-    bank_field_mappings = {
-        "CIMB BANK BERHAD": {
-            "page_fields_map": {
-                "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
-                              "bank_name", "bank_address", "bank_registration_number"],
-                "law_firm_details": ["law_firm_name", "law_firm_address"],
-                "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
-                "guarantor_details": ["guarantor_name", "guarantor_nric",
-                                      "corporate_guarantor_name", "corporate_guarantor_registration_number"],
-                "property_details": ["property_title", "property_address"]
-            },
-            "stamp_required": False
+# How pages are batched into VLM calls when a bank doesn't set "vlm_mode":
+# "per_page", "section" or "document" (see vlm_agent.build_vlm_groups)
+VLM_MODE = os.getenv("VLM_MODE", "per_page")
+
+# Pages to send to the VLM per bank, and the fields to extract from each.
+# A bank may also set "crop_regions": {page_key: [x0, y0, x1, y1]} (fractions of
+# the page) to send only part of a page to the VLM, and "vlm_mode" to batch
+# its pages into fewer multi-image calls
+bank_field_mappings = {
+    "CIMB BANK BERHAD": {
+        "page_fields_map": {
+            "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
+                          "bank_name", "bank_address", "bank_registration_number"],
+            "law_firm_details": ["law_firm_name", "law_firm_address"],
+            "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
+            "guarantor_details": ["guarantor_name", "guarantor_nric",
+                                  "corporate_guarantor_name", "corporate_guarantor_registration_number"],
+            "property_details": ["property_title", "property_address"]
         },
-        "CIMB ISLAMIC BANK BERHAD": {
-            "page_fields_map": {
-                "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
-                              "bank_name", "bank_address", "bank_registration_number"],
-                "law_firm_details": ["law_firm_name", "law_firm_address"],
-                "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
-                "guarantor_details": ["guarantor_name", "guarantor_nric",
-                                      "corporate_guarantor_name", "corporate_guarantor_registration_number"],
-                "property_details": ["property_title", "property_address"]
-            },
-            "stamp_required": False
+        "stamp_required": False
+    },
+    "CIMB ISLAMIC BANK BERHAD": {
+        "page_fields_map": {
+            "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
+                          "bank_name", "bank_address", "bank_registration_number"],
+            "law_firm_details": ["law_firm_name", "law_firm_address"],
+            "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
+            "guarantor_details": ["guarantor_name", "guarantor_nric",
+                                  "corporate_guarantor_name", "corporate_guarantor_registration_number"],
+            "property_details": ["property_title", "property_address"]
         },
-        "MAYBANK BERHAD": {
-            "page_fields_map": {
-                "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
-                              "bank_name", "bank_address", "bank_registration_number"],
-                "law_firm_details": ["law_firm_name", "law_firm_address"],
-                "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
-                "guarantor_details": ["guarantor_name", "guarantor_nric",
-                                      "corporate_guarantor_name", "corporate_guarantor_registration_number"],
-                "property_details": ["property_title", "property_address"]
-            },
-            "stamp_required": False
+        "stamp_required": False
+    },
+    "MAYBANK BERHAD": {
+        "page_fields_map": {
+            "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
+                          "bank_name", "bank_address", "bank_registration_number"],
+            "law_firm_details": ["law_firm_name", "law_firm_address"],
+            "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
+            "guarantor_details": ["guarantor_name", "guarantor_nric",
+                                  "corporate_guarantor_name", "corporate_guarantor_registration_number"],
+            "property_details": ["property_title", "property_address"]
         },
-        "RHB BANK BERHAD": {
-            "page_fields_map": {
-                "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
-                              "bank_name", "bank_address", "bank_registration_number"],
-                "law_firm_details": ["law_firm_name", "law_firm_address"],
-                "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
-                "guarantor_details": ["guarantor_name", "guarantor_nric",
-                                      "corporate_guarantor_name", "corporate_guarantor_registration_number"],
-                "property_details": ["property_title", "property_address"]
-            },
-            "stamp_required": False
+        "stamp_required": False
+    },
+    "RHB BANK BERHAD": {
+        "page_fields_map": {
+            "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
+                          "bank_name", "bank_address", "bank_registration_number"],
+            "law_firm_details": ["law_firm_name", "law_firm_address"],
+            "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
+            "guarantor_details": ["guarantor_name", "guarantor_nric",
+                                  "corporate_guarantor_name", "corporate_guarantor_registration_number"],
+            "property_details": ["property_title", "property_address"]
         },
-        "PUBLIC BANK BERHAD": {
-            "page_fields_map": {
-                "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
-                              "bank_name", "bank_address", "bank_registration_number"],
-                "law_firm_details": ["law_firm_name", "law_firm_address"],
-                "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
-                "guarantor_details": ["guarantor_name", "guarantor_nric",
-                                      "corporate_guarantor_name", "corporate_guarantor_registration_number"],
-                "property_details": ["property_title", "property_address"]
-            },
-            "stamp_required": False
-        }
+        "stamp_required": False
+    },
+    "PUBLIC BANK BERHAD": {
+        "page_fields_map": {
+            "bank_copy": ["date", "borrower_name", "borrower_registration_number", "borrower_address",
+                          "bank_name", "bank_address", "bank_registration_number"],
+            "law_firm_details": ["law_firm_name", "law_firm_address"],
+            "subject_of_fa": ["subject_of_FA", "total_loan_amount"],
+            "guarantor_details": ["guarantor_name", "guarantor_nric",
+                                  "corporate_guarantor_name", "corporate_guarantor_registration_number"],
+            "property_details": ["property_title", "property_address"]
+        },
+        "stamp_required": False
     }
+}
+
+# Ways each bank's name appears in letters and in VLM answers. Matched against
+# the bank copy text with punctuation dropped and whitespace collapsed, so
+# "CIMB Bank Berhad." and "CIMB BANK BERHAD (13491-P)" both resolve to the
+# same key in bank_field_mappings
+bank_aliases = {
+    "CIMB BANK BERHAD": ["cimb bank berhad", "cimb bank bhd", "cimb bank"],
+    "CIMB ISLAMIC BANK BERHAD": ["cimb islamic bank berhad", "cimb islamic bank bhd", "cimb islamic bank",
+                                 "cimb islamic"],
+    "MAYBANK BERHAD": ["maybank berhad", "maybank bhd", "malayan banking berhad", "malayan banking bhd"],
+    "RHB BANK BERHAD": ["rhb bank berhad", "rhb bank bhd", "rhb bank"],
+    "PUBLIC BANK BERHAD": ["public bank berhad", "public bank bhd", "public bank"],
+}
+
+# Page classification rules per bank, evaluated in order on each page's text.
+# A rule fires when any of its "match" phrases is on the page, and then either
+# adds "label", or tries its "branches" in order (first one with a phrase on
+# the page wins) and falls back to "else". An outcome with "continues" marks
+# that section as carrying over to the next page, which gets '<section>_2'.
+# Phrases are matched case-insensitively with whitespace collapsed
+CIMB_PAGE_RULES = [
+    {
+        "match": ["we are pleased to inform you that", "strictly private and highly confidential"],
+        "label": "bank_copy",
+    },
+    {
+        "match": ["form of facility", "facility amount is an amount which is equal", "type of facility",
+                  "payment amount (RM per payment)"],
+        # check if the content contain total, otherwise it continues on the next page
+        "branches": [{"if_any": ["total"], "label": "subject_of_fa"}],
+        "else": {"label": "subject_of_fa_1", "continues": "subject_of_fa"},
+    },
+    {
+        "match": ["pengiraan duit yang dikenakan", "salinan kepada"],
+        "label": "law_firm_details",
+    },
+    {
+        "match": ["to finance the purchase of the property described below", "execution of open charge under",
+                  "a letter of undertaking from registered owner"],
+        "branches": [{"if_any": ["if there is a disrepancy in the property details stated above",
+                                 "individual title", "strava title"],
+                      "label": "property_details"}],
+        "else": {"label": "property_details_1", "continues": "property_details"},
+    },
+    {
+        "match": ['all of the following documents (the "Security Documents") must be executed and perfected, in form and content acceptable to the Bank.',
+                  "the following security which shall be in such form",
+                  "execution of joint and several guarantee in favour of the bank"],
+        "branches": [{"if_any": ["joint and several guarantee in favour of the bank",
+                                 "corporate guarantee in favour of the bank",
+                                 "individual guarantee in favour of the bank"],
+                      "label": "guarantor_details"},
+                     {"if_any": ["property with"], "label": "property_details"}],
+        "else": {"label": "gurantor_details_1", "continues": "gurantor_details"},
+    },
+]
+
+page_classification_rules = {
+    "CIMB BANK BERHAD": CIMB_PAGE_RULES,
+    "CIMB ISLAMIC BANK BERHAD": CIMB_PAGE_RULES,
+}
+
+# Value formats shared by the field rules below
+COMPANY_REG_NO = r"\b(?:19|20)\d{2}0[1-6]\d{6}\b(?:\s*\(\s*\d{1,7}-[A-Z]\s*\))?"
+# Old-format number on its own, e.g. "(13491-P)": only part of the number
+OLD_COMPANY_REG_NO = r"\(\s*\d{1,7}-[A-Z]\s*\)"
+NRIC_NO = r"\b\d{2}(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])-?\d{2}-?\d{4}\b"
+RM_AMOUNT = r"\bRM\s?\d{1,3}(?:,\s?\d{3})+(?:\.\d{2})?\b|\bRM\s?\d+(?:\.\d{2})?\b"
+MONTHS = (r"jan(?:uary|uari)?|feb(?:ruary|ruari)?|mac|mar(?:ch)?|apr(?:il)?|mei|may|jun(?:e)?|jul(?:y|ai)?|"
+          r"ogos|aug(?:ust)?|sep(?:tember)?|o[ck]t(?:ober)?|nov(?:ember)?|dis(?:ember)?|dec(?:ember)?")
+LETTER_DATE = rf"\b\d{{1,2}}(?:st|nd|rd|th)?\s+(?:{MONTHS})\.?,?\s+\d{{4}}\b|\b\d{{1,2}}/\d{{1,2}}/\d{{4}}\b"
+FACILITY_LINE = (r"(?m)^[^\S\n]*[A-Za-z][\w/&.' -]{1,60}?[^\S\n]*\([A-Z0-9/-]{1,12}\)[^\S\n]*[-:][^\S\n]*"
+                 rf"(?:{RM_AMOUNT})")
+
+# Fields with a fixed format, read from the page text before the VLM call.
+# "pattern" finds candidate values (case-insensitive). A value that follows
+# one of its "anchors" within "window" characters (the detected bank's
+# aliases too, with "anchor_bank") scores "confidence"; any other value
+# scores "unanchored" (0 = ignored). Two different values sharing the best
+# score of a single-valued field halve it. "multiple" collects every value into a
+# list, scored by the weakest one. Values also found for an "exclude" field
+# are dropped (a borrower's registration number is never the bank's), and so
+# are values whose line, from the anchor's line on, has a "reject" word.
+# "partial_pattern" finds incomplete values (outside any "pattern" match),
+# scored at most "partial_confidence", which is kept below
+# RULE_MIN_CONFIDENCE so they are only VLM fallbacks.
+# See field_rules for how the scores decide between rules and the VLM
+field_extraction_rules = {
+    "bank_registration_number": {
+        "pattern": COMPANY_REG_NO, "anchors": [], "anchor_bank": True, "window": 80,
+        "confidence": 0.95, "unanchored": 0.0,
+        "partial_pattern": OLD_COMPANY_REG_NO, "partial_confidence": 0.5,
+    },
+    "borrower_registration_number": {
+        "pattern": COMPANY_REG_NO, "window": 40, "confidence": 0.95, "unanchored": 0.0,
+        "partial_pattern": OLD_COMPANY_REG_NO, "partial_confidence": 0.5,
+        "anchors": ["company no", "company registration no", "registration no", "reg. no", "co. no",
+                    "no. syarikat", "no. pendaftaran"],
+        "exclude": ["bank_registration_number"],
+    },
+    "guarantor_nric": {
+        "pattern": NRIC_NO, "multiple": True, "window": 40, "confidence": 0.95, "unanchored": 0.5,
+        "anchors": ["nric", "i/c", "ic no", "no. k/p", "no. kp", "mykad", "identity card"],
+    },
+    "total_loan_amount": {
+        "pattern": RM_AMOUNT, "window": 60, "confidence": 0.95, "unanchored": 0.0,
+        "anchors": ["total facility", "total facilities", "total limit", "total banking facility",
+                    "total banking facilities", "total loan amount", "jumlah kemudahan"],
+        "reject": ["interest", "fee", "instalment", "installment", "stamp", "faedah", "yuran", "ansuran"],
+    },
+    "subject_of_FA": {
+        "pattern": FACILITY_LINE, "multiple": True, "anchors": [], "confidence": 0.8, "unanchored": 0.8,
+    },
+    "date": {
+        "pattern": LETTER_DATE, "anchors": ["date", "dated", "tarikh"], "window": 20,
+        "confidence": 0.95, "unanchored": 0.6,
+    },
+}
+
+def page_fields_mapping(bank_name: str):
     targeted_bank = bank_field_mappings.get(bank_name.upper())
     if targeted_bank:
         return targeted_bank["page_fields_map"]
-    return None
\ No newline at end of file
+    return None
+
+def page_crop_regions(bank_name: str):
+    targeted_bank = bank_field_mappings.get(bank_name.upper())
+    if targeted_bank:
+        return targeted_bank.get("crop_regions", {})
+    return {}
+
+def page_vlm_mode(bank_name: str):
+    targeted_bank = bank_field_mappings.get(bank_name.upper())
+    if targeted_bank:
+        return targeted_bank.get("vlm_mode", VLM_MODE)
+    return VLM_MODE
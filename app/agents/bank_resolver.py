@@ -0,0 +1,81 @@
+import difflib
+import os
+import re
+from app.utils.logger import logger
+from app.utils.page_store import PageStore
+from app.agents.agent_config import bank_aliases, get_bank_name
+
+# Minimum difflib ratio for an OCR'd name to count as a fuzzy match, and how
+# far ahead of the runner-up the best bank must be to skip the VLM
+BANK_MATCH_CUTOFF = float(os.getenv("BANK_MATCH_CUTOFF", "0.85"))
+BANK_MATCH_MARGIN = float(os.getenv("BANK_MATCH_MARGIN", "0.05"))
+
+
+# Lower-case, drop punctuation and collapse whitespace
+def normalize_bank_text(text: str) -> str:
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", text.lower()).split())
+
+
+# Normalized alias -> key in bank_field_mappings
+alias_banks = {normalize_bank_text(alias): bank for bank, aliases in bank_aliases.items() for alias in aliases}
+# Longest aliases first, so "cimb bank berhad" wins over "cimb bank" at the same position
+alias_pattern = re.compile(
+    r"\b(?:" + "|".join(re.escape(alias) for alias in sorted(alias_banks, key=len, reverse=True)) + r")\b"
+)
+
+
+# Best difflib ratio per bank over every window of the text with as many words as an alias
+def fuzzy_bank_scores(text: str) -> dict:
+    words = text.split()
+    scores = {}
+    for alias, bank in alias_banks.items():
+        size = len(alias.split())
+        matcher = difflib.SequenceMatcher(b=alias, autojunk=False)
+        best = scores.get(bank, BANK_MATCH_CUTOFF)
+        for i in range(len(words) - size + 1):
+            matcher.set_seq1(" ".join(words[i:i + size]))
+            if matcher.real_quick_ratio() < best or matcher.quick_ratio() < best:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= best:
+                best = ratio
+                scores[bank] = ratio
+    return scores
+
+
+# Canonical bank key for a piece of text (OCR'd page or a VLM answer), or None
+# when no bank or more than one bank matches
+def resolve_bank_name(text: str):
+    text = normalize_bank_text(text or "")
+    if not text:
+        return None
+
+    exact = {alias_banks[match.group(0)] for match in alias_pattern.finditer(text)}
+    if len(exact) == 1:
+        return exact.pop()
+    if exact:
+        logger.info(f"Bank name is ambiguous, text names {sorted(exact)}")
+        return None
+
+    ranked = sorted(fuzzy_bank_scores(text).items(), key=lambda item: item[1], reverse=True)
+    if not ranked:
+        return None
+    if len(ranked) > 1 and ranked[0][1] - ranked[1][1] < BANK_MATCH_MARGIN:
+        logger.info(f"Bank name is ambiguous, fuzzy matches {ranked[:2]}")
+        return None
+    return ranked[0][0]
+
+
+# Resolve the bank from the bank copy's OCR text; ask the VLM only when the
+# text does not settle it, and map its answer back to a canonical key
+async def detect_bank_name(store: PageStore) -> str:
+    page_num = store.roles.get("bank_copy")
+    text = store.texts.get(page_num) if page_num is not None else None
+    if text:
+        bank_name = resolve_bank_name(text)
+        if bank_name:
+            logger.info(f"Bank name resolved from page text: {bank_name}")
+            return bank_name
+
+    answer = await get_bank_name(store)
+    return resolve_bank_name(answer) or answer
@@ -0,0 +1,90 @@
+import os
+from app.utils.logger import logger
+from app.utils.model_registry import registry
+
+# Hard limit on prompt + answer tokens for the RAG model / provider, and the
+# share of it kept free for the answer
+RAG_PROMPT_TOKEN_LIMIT = int(os.getenv("RAG_PROMPT_TOKEN_LIMIT", "6000"))
+RAG_ANSWER_TOKENS = int(os.getenv("RAG_ANSWER_TOKENS", "1024"))
+# Tokenizer of the RAG model, used to count prompt tokens
+RAG_TOKENIZER = os.getenv("RAG_TOKENIZER", "Qwen/Qwen3-8B")
+# A chunk whose words are this much covered by an already packed chunk is dropped
+RAG_DEDUP_OVERLAP = float(os.getenv("RAG_DEDUP_OVERLAP", "0.8"))
+# Characters per token when the tokenizer can't be loaded
+CHARS_PER_TOKEN = 4
+
+
+# Never fails: without the tokenizer (e.g. offline) counting falls back to
+# CHARS_PER_TOKEN, which /health reports
+def load_tokenizer():
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(RAG_TOKENIZER), {"tokenizer": RAG_TOKENIZER}
+    except Exception as e:
+        logger.warning(f"Tokenizer {RAG_TOKENIZER} unavailable, estimating tokens from length: {e}")
+        return None, {"tokenizer": f"chars/{CHARS_PER_TOKEN}", "error": str(e)}
+
+
+registry.register("rag_tokenizer", load_tokenizer)
+
+
+def count_tokens(text: str) -> int:
+    tokenizer = registry.get("rag_tokenizer")
+    if tokenizer is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+# First max_tokens tokens of text
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    tokenizer = registry.get("rag_tokenizer")
+    if tokenizer is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    return tokenizer.decode(tokenizer.encode(text, add_special_tokens=False)[:max_tokens])
+
+
+# Drop chunks that repeat, or mostly overlap with, a higher-ranked chunk
+def dedupe_chunks(chunks):
+    kept = []
+    kept_words = []
+    for chunk in chunks:
+        normalized = " ".join(chunk.split())
+        if not normalized:
+            continue
+        words = set(normalized.lower().split())
+        duplicate = any(normalized in other or len(words & other_words) >= RAG_DEDUP_OVERLAP * len(words)
+                        for other, other_words in zip(kept, kept_words))
+        if not duplicate:
+            kept.append(normalized)
+            kept_words.append(words)
+    return kept
+
+
+# Pack ranked chunks (best first) into budget tokens. Chunks that don't fit are
+# skipped so smaller, lower-ranked ones can still use the room; if not even the
+# best chunk fits, it is truncated. Returns (context, stats)
+def pack_context(ranked_chunks, budget: int, separator: str = "\n"):
+    chunks = dedupe_chunks(ranked_chunks)
+    separator_tokens = count_tokens(separator)
+    packed = []
+    used = 0
+    for chunk in chunks:
+        cost = count_tokens(chunk) + (separator_tokens if packed else 0)
+        if used + cost <= budget:
+            packed.append(chunk)
+            used += cost
+    if not packed and chunks and budget > 0:
+        packed = [truncate_tokens(chunks[0], budget)]
+        used = count_tokens(packed[0])
+
+    stats = {"budget_tokens": budget, "used_tokens": used, "retrieved_chunks": len(ranked_chunks),
+             "unique_chunks": len(chunks), "packed_chunks": len(packed)}
+    return separator.join(packed), stats
+
+
+# Context budget left for a prompt template, given the template's own tokens
+# and the tokens reserved for the answer
+def context_budget(template_tokens: int, answer_tokens: int = RAG_ANSWER_TOKENS) -> int:
+    return max(0, RAG_PROMPT_TOKEN_LIMIT - answer_tokens - template_tokens)
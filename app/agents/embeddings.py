@@ -0,0 +1,79 @@
+import importlib.util
+import os
+import threading
+from langchain_core.embeddings import Embeddings
+from app.utils.model_registry import registry
+
+# Embedding model for RAG. EMBEDDING_DEVICE is "cuda", "cpu" or "auto" (cuda
+# when available). Without EMBEDDING_MODEL the large Qwen model is used on GPU
+# and a small multilingual model on CPU
+EMBEDDING_DEVICE = os.getenv("EMBEDDING_DEVICE", "auto")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "")
+DEFAULT_EMBEDDING_MODELS = {
+    "cuda": "Qwen/Qwen3-Embedding-4B",
+    "cpu": "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+}
+# "torch", or "onnx" to run through ONNX Runtime (optional dependency, see
+# requirements-onnx.txt); EMBEDDING_ONNX_FILE picks the exported file, e.g.
+# the int8-quantized one
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+# Concurrent encode calls on the shared model; more than one mostly
+# oversubscribes CPU threads or GPU memory
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "1"))
+
+
+# Thin wrapper so one loaded model can be shared by concurrent requests:
+# encode calls are bounded by a semaphore
+class SharedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, model_name: str = "", concurrency: int = EMBEDDING_CONCURRENCY):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.slots = threading.BoundedSemaphore(max(1, concurrency))
+
+    def embed_documents(self, texts):
+        with self.slots:
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with self.slots:
+            return self.embeddings.embed_query(text)
+
+
+def resolve_device() -> str:
+    if EMBEDDING_DEVICE != "auto":
+        return EMBEDDING_DEVICE
+    try:
+        import torch
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    except ImportError:
+        return "cpu"
+
+
+def load_embeddings():
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    device = resolve_device()
+    model_name = EMBEDDING_MODEL or DEFAULT_EMBEDDING_MODELS.get(device, DEFAULT_EMBEDDING_MODELS["cpu"])
+    model_kwargs = {"device": device}
+    if EMBEDDING_BACKEND == "onnx":
+        if importlib.util.find_spec("optimum") is None:
+            raise ImportError("EMBEDDING_BACKEND=onnx needs optimum[onnxruntime]: "
+                              "pip install -r requirements-onnx.txt")
+        model_kwargs["backend"] = "onnx"
+        if EMBEDDING_ONNX_FILE:
+            model_kwargs["model_kwargs"] = {"file_name": EMBEDDING_ONNX_FILE}
+    embeddings = HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs)
+
+    details = {"model": model_name, "device": device, "backend": EMBEDDING_BACKEND}
+    if device.startswith("cuda"):
+        import torch
+        details["cuda_allocated_mb"] = round(torch.cuda.memory_allocated() / 2**20, 1)
+    return SharedEmbeddings(embeddings, model_name), details
+
+
+registry.register("embeddings", load_embeddings)
+
+
+def get_embeddings() -> SharedEmbeddings:
+    return registry.get("embeddings")
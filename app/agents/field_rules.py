@@ -0,0 +1,124 @@
+import os
+import re
+import threading
+from app.agents.agent_config import bank_aliases, field_extraction_rules
+
+# Fields filled by the rules with at least this score are dropped from the
+# VLM call; lower-scored values only fill fields the VLM leaves empty.
+# RULE_EXTRACTION=0 sends every field to the VLM as before
+RULE_EXTRACTION = os.getenv("RULE_EXTRACTION", "1") == "1"
+RULE_MIN_CONFIDENCE = float(os.getenv("RULE_MIN_CONFIDENCE", "0.9"))
+
+
+# Settings that change what the rules extract, for the pipeline version
+def rule_settings() -> dict:
+    return {"enabled": RULE_EXTRACTION, "min_confidence": RULE_MIN_CONFIDENCE, "rules": field_extraction_rules}
+
+
+def normalize_value(field: str, value: str) -> str:
+    value = " ".join(value.split())
+    if field == "guarantor_nric":
+        return value.replace("-", "")
+    if field in ("total_loan_amount", "subject_of_FA"):
+        value = re.sub(r"\bRM\s+(?=\d)", "RM", value)
+        return re.sub(r"(?<=\d),\s+(?=\d)", ",", value)
+    # Old-format registration number on its own (a partial match):
+    # "(13491-P)" -> "13491-P"
+    if value.startswith("(") and value.endswith(")"):
+        return value[1:-1].strip()
+    return value
+
+
+# One field's rule (see field_extraction_rules) with its regexes compiled
+class FieldRule:
+    def __init__(self, field: str, rule: dict, extra_anchors=()):
+        self.field = field
+        self.pattern = re.compile(rule["pattern"], re.IGNORECASE)
+        partial = rule.get("partial_pattern")
+        self.partial_pattern = re.compile(partial, re.IGNORECASE) if partial else None
+        self.partial_confidence = rule.get("partial_confidence", 0.0)
+        anchors = list(rule.get("anchors", [])) + list(extra_anchors)
+        self.anchor = re.compile("|".join(re.escape(a) for a in anchors), re.IGNORECASE) if anchors else None
+        self.window = rule.get("window", 40)
+        self.confidence = rule.get("confidence", 0.9)
+        self.unanchored = rule.get("unanchored", 0.0)
+        self.multiple = rule.get("multiple", False)
+        self.exclude = rule.get("exclude", [])
+        reject = rule.get("reject", [])
+        self.reject = re.compile("|".join(rf"\b{re.escape(w)}" for w in reject), re.IGNORECASE) if reject else None
+
+    # [(value, score)] in text order, one per distinct value (best score kept).
+    # An anchor only counts for the first value (full or partial) after it.
+    # A value is dropped when its line, from the anchor's line on, has a
+    # "reject" word
+    def candidates(self, text: str):
+        matches = [(match, 1.0) for match in self.pattern.finditer(text)]
+        if self.partial_pattern is not None:
+            spans = [match.span() for match, _ in matches]
+            matches += [(match, self.partial_confidence) for match in self.partial_pattern.finditer(text)
+                        if not any(start < match.end() and match.start() < end for start, end in spans)]
+            matches.sort(key=lambda item: item[0].start())
+        found = {}
+        previous_end = 0
+        for match, cap in matches:
+            start = max(previous_end, match.start() - self.window)
+            previous_end = match.end()
+            anchor = self.anchor.search(text, start, match.start()) if self.anchor is not None else None
+            if self.reject is not None:
+                line_start = text.rfind("\n", 0, (anchor or match).start()) + 1
+                if self.reject.search(text, line_start, match.start()):
+                    continue
+            anchored = anchor is not None
+            score = min(cap, self.confidence if anchored else self.unanchored)
+            if score <= 0:
+                continue
+            value = normalize_value(self.field, match.group(0))
+            found[value] = max(score, found.get(value, 0.0))
+        return list(found.items())
+
+
+# Every field rule for one bank, compiled once (get_field_extractor)
+class FieldExtractor:
+    def __init__(self, rules, bank_name: str = ""):
+        aliases = bank_aliases.get(bank_name, [])
+        self.rules = {field: FieldRule(field, rule, aliases if rule.get("anchor_bank") else ())
+                      for field, rule in rules.items()}
+
+    # Fill what the rules can of field_names from the texts of the pages going
+    # into one VLM call. Returns {field: (value, confidence)}; list fields get
+    # a list of values
+    def extract(self, texts, field_names) -> dict:
+        text = "\n".join(t for t in texts if t)
+        if not text:
+            return {}
+        candidates = {}
+        wanted = {f for f in field_names if f in self.rules}
+        for field in wanted | {x for f in wanted for x in self.rules[f].exclude}:
+            candidates[field] = self.rules[field].candidates(text)
+
+        results = {}
+        for field in wanted:
+            rule = self.rules[field]
+            excluded = {value for other in rule.exclude for value, _ in candidates.get(other, [])}
+            found = [(value, score) for value, score in candidates[field] if value not in excluded]
+            if not found:
+                continue
+            if rule.multiple:
+                results[field] = ([value for value, _ in found], min(score for _, score in found))
+                continue
+            value, score = max(found, key=lambda item: item[1])
+            if len({v for v, s in found if s == score}) > 1:
+                score /= 2
+            results[field] = (value, score)
+        return results
+
+
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+
+def get_field_extractor(bank_name: str) -> FieldExtractor:
+    with _extractors_lock:
+        if bank_name not in _extractors:
+            _extractors[bank_name] = FieldExtractor(field_extraction_rules, bank_name)
+        return _extractors[bank_name]
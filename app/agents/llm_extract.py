@@ -1,60 +1,23 @@
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.retrievers import BM25Retriever
 from langchain.retrievers import EnsembleRetriever
-from langchain_experimental.text_splitter import SemanticChunker
 from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
-import ollama
+from app.agents.rag_index import RagIndex
+from app.agents.context_packing import RAG_PROMPT_TOKEN_LIMIT, context_budget, count_tokens, pack_context
+from app.agents.output_schema import fields_schema, schema_num_predict
+from app.utils.metrics import OUTPUT_PARSES
+from app.utils.logger import log_payload
+from app.agents import ollama_client
 import json
 import logging
 import time
 
 logger = logging.getLogger(__name__)
 
-def create_vector_store(text: str) -> FAISS:
-    start_time = time.time()
-    # Split text into small chunks for faster retrieval (Traditional Chunking)
-    # text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=80)
-    # chunks = text_splitter.split_text(text)
-
-    # multilingual embeddings
-    # embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
-    # embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/stsb-xlm-r-multilingual", model_kwargs={"device": "cuda"})
-    embeddings = HuggingFaceEmbeddings(model_name="Qwen/Qwen3-Embedding-4B", model_kwargs={"device": "cuda"})   
-
-    # embeddings = HuggingFaceEmbeddings(model_name="BAAI/bge-m3", model_kwargs={"device": "cuda"}) 
-    chunker = SemanticChunker(embeddings, breakpoint_threshold_type="percentile", breakpoint_threshold_amount=0.85)
-    
-    chunks = chunker.split_text(text)
-    # Create FAISS index
-    vector_store = FAISS.from_texts(chunks, embeddings)
-    logger.info(f"Vector store created in {time.time() - start_time:.2f} seconds")
-    return vector_store, chunks
-
-def extract_with_rag(text: str, query: str, targeted_variables: str) -> dict:
-    logger.info(f"Starting RAG extraction for text of length: {len(text)}")
-    start_time = time.time()
-    # Create vector store
-    dense_store, chunks = create_vector_store(text)
-    dense_retriever = dense_store.as_retriever(search_kwargs={"k": 12})
-
-    # Sparse retriever
-    sparse_retriever = BM25Retriever.from_texts(chunks, k=12)
-
-    # Hybrid Search Retriever
-    hybrid_retriever = EnsembleRetriever(retrievers=[dense_retriever, sparse_retriever], weights=[0.3, 0.7])
-
-    # Retrieve relevant chunks using hybrid
-    relevant_chunks = hybrid_retriever.get_relevant_documents(query)
-
-    # Retrieve relevant chunks
-    # relevant_chunks = vector_store.similarity_search(query, k=10)
-    context = "\n".join([chunk.page_content for chunk in relevant_chunks])
-    logger.info(f"Context retrieved in {time.time() - start_time:.2f} seconds")
-    logger.info(f"Retrieved context: {context[:50000]}...")  # Log first 500 chars
+SYSTEM_PROMPT = "You are a precise data extraction tool for legal documents. Return only JSON, no other text."
 
 # Put example in prompt
-    prompt = f"""
+def build_rag_prompt(context: str, targeted_variables: str) -> str:
+    return f"""
         You are a law firm analyst AI tasked with extracting specific law variables from a document. The document content will be provided to you, 
         which may include text, images, or a combination of both. Your task is to carefully analyze this content and extract the requested information. 
         Here is the tips:
@@ -74,28 +37,82 @@ def extract_with_rag(text: str, query: str, targeted_variables: str) -> dict:
         "targeted_variable_name": "value",
         }}
 
-        Format your answer as an array of JSON objects. If you don't know the answer, add N/A as your response. Please don't include anything else in your response.
+        Format your answer as one JSON object with a key for each targeted variable. If you don't know the answer, add N/A as your response. Please don't include anything else in your response.
 
         What are the values for the following?
 
         {targeted_variables}
     """
 
+
+def create_vector_store(text: str) -> FAISS:
+    # Split text into small chunks for faster retrieval (Traditional Chunking)
+    # text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=80)
+    # chunks = text_splitter.split_text(text)
+
+    # Semantic chunks and their FAISS index, with each sentence embedded once
+    # (see app/agents/rag_index.py)
+    index = RagIndex(text)
+    return index.dense, index.chunks
+
+def extract_with_rag(text: str, query: str, targeted_variables: str) -> dict:
+    logger.info(f"Starting RAG extraction for text of length: {len(text)}")
+    start_time = time.time()
+    # Dense and sparse retrievers over the same chunk list
+    index = RagIndex(text, bm25_k=12)
+    dense_retriever = index.dense.as_retriever(search_kwargs={"k": 12})
+    sparse_retriever = index.sparse
+
+    # Hybrid Search Retriever
+    hybrid_retriever = EnsembleRetriever(retrievers=[dense_retriever, sparse_retriever], weights=[0.3, 0.7])
+
+    # Retrieve relevant chunks using hybrid, best first
+    relevant_chunks = hybrid_retriever.get_relevant_documents(query)
+
+    # Retrieve relevant chunks
+    # relevant_chunks = vector_store.similarity_search(query, k=10)
+
+    # The answer is constrained to one string per targeted variable and capped
+    # at what that object can hold
+    schema = fields_schema([name.strip() for name in targeted_variables.split(",") if name.strip()])
+    answer_tokens = schema_num_predict(schema)
+
+    # Pack the best chunks into whatever the token limit leaves after the
+    # prompt template and the answer, so the request always fits the model /
+    # provider limit
+    template_tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(build_rag_prompt("", targeted_variables))
+    context, packing = pack_context([chunk.page_content for chunk in relevant_chunks],
+                                    context_budget(template_tokens, answer_tokens))
+    logger.info(f"Context retrieved in {time.time() - start_time:.2f} seconds")
+    logger.info(f"Context packing: {packing['used_tokens']}/{packing['budget_tokens']} budget tokens used, "
+                f"{packing['packed_chunks']}/{packing['unique_chunks']} unique chunks "
+                f"({packing['retrieved_chunks']} retrieved), template {template_tokens} tokens")
+    log_payload("Retrieved context", context)
+
+    prompt = build_rag_prompt(context, targeted_variables)
+
     try:
-        response = ollama.chat(
-            model="qwen3:8b",  
+        response = ollama_client.chat_sync(
+            model="qwen3:8b",
             messages=[
-                {"role": "system", "content": "You are a precise data extraction tool for legal documents. Return only JSON, no other text."},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
-            options={"temperature": 0.3, "max_tokens": 2048}
+            format=schema,
+            options={"temperature": 0.3, "num_predict": answer_tokens, "num_ctx": RAG_PROMPT_TOKEN_LIMIT}
         )
         raw_content = response.get("message", {}).get("content", "")
-        logger.info(f"Raw LLM response: {raw_content}")
+        log_payload("Raw LLM response", raw_content)
 
         if raw_content.strip():
             logger.info(f"RAG extraction completed in {time.time() - start_time:.2f} seconds")
-            return json.loads(raw_content)
+            try:
+                parsed = json.loads(raw_content)
+            except json.JSONDecodeError:
+                OUTPUT_PARSES.labels("rag", "failed").inc()
+                raise
+            OUTPUT_PARSES.labels("rag", "ok").inc()
+            return parsed
         else:
             logger.error(f"RAG extraction failed: empty response")
             return {"inference_result": {}}
@@ -0,0 +1,257 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import httpx
+import ollama
+from app.utils.logger import logger
+
+# Ollama endpoints, comma-separated (point them at local fake servers for
+# testing). OLLAMA_HOST is the single-host fallback
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_HOSTS = [host.strip() for host in os.getenv("OLLAMA_HOSTS", OLLAMA_HOST).split(",") if host.strip()]
+# Max number of in-flight chat calls per backend and process
+VLM_CONCURRENCY = int(os.getenv("VLM_CONCURRENCY", "4"))
+# Per-call timeout in seconds, and retries with exponential backoff
+VLM_TIMEOUT = float(os.getenv("VLM_TIMEOUT", "180"))
+VLM_RETRIES = int(os.getenv("VLM_RETRIES", "2"))
+VLM_BACKOFF = float(os.getenv("VLM_BACKOFF", "1.0"))
+# A backend leaves the rotation after this many failed calls in a row, and is
+# probed every OLLAMA_HEALTH_INTERVAL seconds to bring it back
+OLLAMA_UNHEALTHY_AFTER = int(os.getenv("OLLAMA_UNHEALTHY_AFTER", "2"))
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv("OLLAMA_HEALTH_TIMEOUT", "3"))
+# Models loaded on every backend at startup, and how long Ollama keeps a model
+# in memory after a call (sent with every call)
+OLLAMA_WARM_MODELS = [m.strip() for m in os.getenv("OLLAMA_WARM_MODELS", "qwen2.5vl:7b").split(",") if m.strip()]
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+
+# One Ollama endpoint: its routing and health state, shared by every event
+# loop and thread, plus clients that keep their connection pools open
+class Backend:
+    def __init__(self, host: str):
+        self.host = host
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.last_error = None
+        self.warm = {}
+        self._sync_client = None
+
+    def sync_client(self):
+        if self._sync_client is None:
+            self._sync_client = ollama.Client(host=self.host, timeout=VLM_TIMEOUT)
+        return self._sync_client
+
+    def status(self) -> dict:
+        return {"host": self.host, "healthy": self.healthy, "outstanding": self.outstanding,
+                "requests": self.requests, "failures": self.failures, "last_error": self.last_error,
+                "warm": dict(self.warm)}
+
+
+_backends = [Backend(host) for host in OLLAMA_HOSTS]
+_lock = threading.Lock()
+
+# Async clients and semaphores are bound to the event loop that created them
+_loop = None
+_clients = {}
+_semaphores = {}
+_health_task = None
+
+
+def _bind_loop():
+    global _loop, _clients, _semaphores
+    loop = asyncio.get_running_loop()
+    if _loop is not loop:
+        _loop = loop
+        _clients = {b.host: ollama.AsyncClient(host=b.host) for b in _backends}
+        _semaphores = {b.host: asyncio.Semaphore(VLM_CONCURRENCY) for b in _backends}
+    return _clients, _semaphores
+
+
+# Least outstanding calls among the healthy backends, avoiding the ones that
+# already failed this call. With none healthy every backend is a candidate,
+# so calls still go out (and find the first one that recovers)
+def _acquire(exclude=()) -> Backend:
+    with _lock:
+        candidates = [b for b in _backends if b.healthy and b.host not in exclude]
+        if not candidates:
+            candidates = [b for b in _backends if b.host not in exclude] or list(_backends)
+        least = min(b.outstanding for b in candidates)
+        backend = random.choice([b for b in candidates if b.outstanding == least])
+        backend.outstanding += 1
+        backend.requests += 1
+        return backend
+
+
+# Record a call's outcome: error is None on success. A call cancelled by its
+# caller (CancelledError, KeyboardInterrupt) says nothing about the backend,
+# so it leaves the health and failure counts alone
+def _release(backend: Backend, error: BaseException = None):
+    with _lock:
+        backend.outstanding -= 1
+        if error is not None and not isinstance(error, Exception):
+            return
+        if error is None:
+            backend.consecutive_failures = 0
+            backend.healthy = True
+            return
+        backend.failures += 1
+        backend.last_error = f"{type(error).__name__}: {error}"
+        if _is_backend_error(error):
+            backend.consecutive_failures += 1
+            if backend.healthy and backend.consecutive_failures >= OLLAMA_UNHEALTHY_AFTER:
+                backend.healthy = False
+                logger.warning(f"Ollama backend {backend.host} taken out of rotation: {backend.last_error}")
+
+
+# Timeouts, connection failures and 429/5xx responses are worth retrying
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError, ConnectionError)):
+        return True
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+# Failures that say something about the backend rather than the request
+# (429 only means it is busy)
+def _is_backend_error(error: Exception) -> bool:
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code >= 500
+    return _is_retryable(error)
+
+
+def _backoff(attempt: int) -> float:
+    return VLM_BACKOFF * (2 ** attempt) * (1 + random.random() * 0.25)
+
+
+# Bounded async ollama.chat routed to the least busy healthy backend, with a
+# per-call timeout and retry with backoff on another backend where there is
+# one. The concurrency slot is released while waiting to retry
+async def chat(**kwargs):
+    clients, semaphores = _bind_loop()
+    kwargs.setdefault("keep_alive", OLLAMA_KEEP_ALIVE)
+    tried = set()
+    for attempt in range(VLM_RETRIES + 1):
+        backend = _acquire(exclude=tried)
+        error = None
+        try:
+            async with semaphores[backend.host]:
+                return await asyncio.wait_for(clients[backend.host].chat(**kwargs), timeout=VLM_TIMEOUT)
+        except Exception as e:
+            error = e
+            if attempt == VLM_RETRIES or not _is_retryable(e):
+                raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _release(backend, error)
+        tried.add(backend.host)
+        if len(tried) == len(_backends):
+            tried.clear()
+        delay = _backoff(attempt)
+        logger.warning(f"Ollama call to {backend.host} failed ({type(error).__name__}: {error}), "
+                       f"retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+# Blocking variant for code that runs outside the event loop (RAG extraction)
+def chat_sync(**kwargs):
+    kwargs.setdefault("keep_alive", OLLAMA_KEEP_ALIVE)
+    tried = set()
+    for attempt in range(VLM_RETRIES + 1):
+        backend = _acquire(exclude=tried)
+        error = None
+        try:
+            return backend.sync_client().chat(**kwargs)
+        except Exception as e:
+            error = e
+            if attempt == VLM_RETRIES or not _is_retryable(e):
+                raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _release(backend, error)
+        tried.add(backend.host)
+        if len(tried) == len(_backends):
+            tried.clear()
+        delay = _backoff(attempt)
+        logger.warning(f"Ollama call to {backend.host} failed ({type(error).__name__}: {error}), "
+                       f"retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+
+async def _check(backend: Backend, client) -> bool:
+    try:
+        await asyncio.wait_for(client.list(), timeout=OLLAMA_HEALTH_TIMEOUT)
+    except Exception as e:
+        with _lock:
+            backend.last_error = f"{type(e).__name__}: {e}"
+            if backend.healthy:
+                logger.warning(f"Ollama backend {backend.host} failed its health check: {backend.last_error}")
+            backend.healthy = False
+        return False
+    with _lock:
+        if not backend.healthy:
+            logger.info(f"Ollama backend {backend.host} is back in rotation")
+        backend.healthy = True
+        backend.consecutive_failures = 0
+    return True
+
+
+async def check_backends():
+    clients, _ = _bind_loop()
+    return await asyncio.gather(*[_check(b, clients[b.host]) for b in _backends])
+
+
+async def _health_loop():
+    while True:
+        await asyncio.sleep(OLLAMA_HEALTH_INTERVAL)
+        await check_backends()
+
+
+# Load the warm-up models on a backend (an empty generate loads the model and
+# keeps it for keep_alive), so the first real call doesn't pay the load time
+async def _warm(backend: Backend, client):
+    for model in OLLAMA_WARM_MODELS:
+        start_time = time.perf_counter()
+        try:
+            await asyncio.wait_for(client.generate(model=model, prompt="", keep_alive=OLLAMA_KEEP_ALIVE),
+                                   timeout=VLM_TIMEOUT)
+            backend.warm[model] = round(time.perf_counter() - start_time, 2)
+            logger.info(f"Warmed {model} on {backend.host} in {backend.warm[model]:.2f} seconds")
+        except Exception as e:
+            backend.warm[model] = None
+            logger.warning(f"Could not warm {model} on {backend.host}: {type(e).__name__}: {e}")
+
+
+# Startup (from the FastAPI lifespan hook): probe every backend, warm the
+# models on the healthy ones and start the periodic health checks
+async def start(warm: bool = True):
+    global _health_task
+    clients, _ = _bind_loop()
+    healthy = await check_backends()
+    if warm:
+        await asyncio.gather(*[_warm(b, clients[b.host]) for b, ok in zip(_backends, healthy) if ok])
+    if _health_task is None or _health_task.done():
+        _health_task = asyncio.create_task(_health_loop())
+
+
+async def stop():
+    global _health_task
+    if _health_task is not None:
+        _health_task.cancel()
+        await asyncio.gather(_health_task, return_exceptions=True)
+        _health_task = None
+
+
+def status():
+    with _lock:
+        return [b.status() for b in _backends]
@@ -0,0 +1,49 @@
+import os
+
+# Generation budget per field of a structured answer: short values (names,
+# numbers, dates) and lists of them, free-text values (addresses, property
+# titles, facility lines) and lists of them, and the JSON punctuation around
+# them. num_predict is the sum, so a call can't run on past what its schema
+# can hold
+SCHEMA_TOKENS_PER_VALUE = int(os.getenv("SCHEMA_TOKENS_PER_VALUE", "96"))
+SCHEMA_TOKENS_PER_LIST = int(os.getenv("SCHEMA_TOKENS_PER_LIST", "256"))
+SCHEMA_TOKENS_PER_TEXT = int(os.getenv("SCHEMA_TOKENS_PER_TEXT", "512"))
+SCHEMA_TOKENS_PER_TEXT_LIST = int(os.getenv("SCHEMA_TOKENS_PER_TEXT_LIST", "1024"))
+SCHEMA_TOKENS_OVERHEAD = 16
+
+# Fields whose values are free text that can run over several lines (a
+# multi-lot property title easily passes 96 tokens)
+TEXT_FIELDS = {"property_title", "property_description", "subject_of_FA"}
+
+
+# JSON schema for an object with one string (or list of strings) per field,
+# passed to Ollama as `format` so the answer is always a parseable object
+def fields_schema(field_names, list_fields=()) -> dict:
+    properties = {}
+    for name in field_names:
+        if name in list_fields:
+            properties[name] = {"type": "array", "items": {"type": "string"}}
+        else:
+            properties[name] = {"type": "string"}
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+def is_text_field(name: str) -> bool:
+    return name in TEXT_FIELDS or name.endswith("_address")
+
+
+# Token budget for one field's value, from its type and whether it is free text
+def value_num_predict(name: str, prop: dict) -> int:
+    if prop.get("type") == "array":
+        return SCHEMA_TOKENS_PER_TEXT_LIST if is_text_field(name) else SCHEMA_TOKENS_PER_LIST
+    return SCHEMA_TOKENS_PER_TEXT if is_text_field(name) else SCHEMA_TOKENS_PER_VALUE
+
+
+# Token cap for an answer to `schema`: each key (about one token per three
+# characters plus quotes) and its value budget
+def schema_num_predict(schema: dict) -> int:
+    total = SCHEMA_TOKENS_OVERHEAD
+    for name, prop in schema.get("properties", {}).items():
+        total += len(name) // 3 + 4
+        total += value_num_predict(name, prop)
+    return total
@@ -0,0 +1,143 @@
+import difflib
+import hashlib
+import os
+import re
+import numpy as np
+from PIL import Image
+
+# Repeated pages in a letter (bank copy + customer copy, duplicated annexures)
+# are detected before OCR so each distinct page is OCR'd and sent to the VLM
+# once. Text-layer pages match on their normalized text. Image pages are
+# fingerprinted from a DEDUP_ZOOM rendering: a difference hash over a
+# DEDUP_HASH_SIZE grid finds candidates within DEDUP_MAX_DISTANCE bits, and a
+# candidate only counts as a duplicate if no pixel of the renderings,
+# shrunk DEDUP_PIXEL_SCALE times, differs by more than DEDUP_MAX_PIXEL_DIFF
+# grey levels. The hash alone can't tell dense text pages apart (two clauses
+# of the same letter hash a few bits apart); the pixel check accepts
+# re-encoded copies of the same image (JPEG noise stays under 13 levels at
+# half scale) and rejects one changed digit (77+) or punctuation mark (19+).
+# Only the shrunk rendering (about 125 KB per A4 page at the defaults) is
+# kept, and only for the distinct pages until the document is fingerprinted;
+# at quarter scale a changed comma no longer shows.
+# A page scanned again (shifted, rotated, another resolution or exposure)
+# fails the pixel check, and its hash can be further from the original than
+# another page's. Those are found after OCR from the text instead: at least
+# DEDUP_MIN_TEXT_SIMILARITY of their words in common, in order, and exactly
+# the same numbers (0 turns this off). They still go through OCR, and share
+# the first copy's image and VLM calls. Pages that differ only in a few words
+# without digits (a name) can pass that test; raise the similarity to be
+# stricter
+DEDUP_PAGES = os.getenv("DEDUP_PAGES", "1") == "1"
+DEDUP_ZOOM = float(os.getenv("DEDUP_ZOOM", "1.0"))
+DEDUP_HASH_SIZE = int(os.getenv("DEDUP_HASH_SIZE", "16"))
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", "32"))
+DEDUP_PIXEL_SCALE = int(os.getenv("DEDUP_PIXEL_SCALE", "2"))
+DEDUP_MAX_PIXEL_DIFF = int(os.getenv("DEDUP_MAX_PIXEL_DIFF", "16"))
+DEDUP_MIN_TEXT_SIMILARITY = float(os.getenv("DEDUP_MIN_TEXT_SIMILARITY", "0.97"))
+
+
+# Settings that change which pages are merged, for the pipeline version
+def dedup_settings() -> dict:
+    return {"enabled": DEDUP_PAGES, "zoom": DEDUP_ZOOM, "hash_size": DEDUP_HASH_SIZE,
+            "max_distance": DEDUP_MAX_DISTANCE, "pixel_scale": DEDUP_PIXEL_SCALE,
+            "max_pixel_diff": DEDUP_MAX_PIXEL_DIFF,
+            "min_text_similarity": DEDUP_MIN_TEXT_SIMILARITY}
+
+
+def text_fingerprint(text: str) -> dict:
+    normalized = " ".join(text.split()).lower()
+    return {"kind": "text", "hash": hashlib.sha256(normalized.encode("utf-8")).hexdigest()}
+
+
+# Difference hash of a greyscale image: one bit per cell, set where the cell
+# is brighter than its right-hand neighbour
+def dhash(gray: Image.Image, size: int = DEDUP_HASH_SIZE) -> int:
+    cells = np.asarray(gray.resize((size + 1, size), Image.BOX), dtype=np.int16)
+    bits = (cells[:, :-1] > cells[:, 1:]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+# Fingerprint of a page rendered at DEDUP_ZOOM as a greyscale PyMuPDF pixmap:
+# its hash and the rendering shrunk for the pixel check
+def image_fingerprint(pix) -> dict:
+    image = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    small = image.reduce(DEDUP_PIXEL_SCALE) if DEDUP_PIXEL_SCALE > 1 else image
+    return {"kind": "image", "hash": dhash(image), "pixels": np.asarray(small, dtype=np.uint8)}
+
+
+def _hash_distance(a: dict, b: dict) -> int:
+    return bin(a["hash"] ^ b["hash"]).count("1")
+
+
+def _same_image(a: dict, b: dict):
+    distance = _hash_distance(a, b)
+    if distance > DEDUP_MAX_DISTANCE or a["pixels"].shape != b["pixels"].shape:
+        return None
+    diff = np.abs(a["pixels"].astype(np.int16) - b["pixels"].astype(np.int16)).max()
+    return distance if diff <= DEDUP_MAX_PIXEL_DIFF else None
+
+
+# Group pages with the first page they repeat. fingerprints is an iterable of
+# (page_num, fingerprint) in page order; a duplicate's rendering is dropped
+# as soon as it has been matched. Returns {page_num: match} for every
+# duplicate page, match being {"same_as", "match" (text / image / ocr_text),
+# "distance"}
+def find_duplicates(fingerprints) -> dict:
+    duplicates = {}
+    text_pages = {}
+    image_pages = []
+    for page_num, fingerprint in fingerprints:
+        if fingerprint is None:
+            continue
+        if fingerprint["kind"] == "text":
+            first = text_pages.setdefault(fingerprint["hash"], page_num)
+            if first != page_num:
+                duplicates[page_num] = {"same_as": first, "match": "text", "distance": 0}
+            continue
+        for first, first_fingerprint in image_pages:
+            distance = _same_image(fingerprint, first_fingerprint)
+            if distance is not None:
+                duplicates[page_num] = {"same_as": first, "match": "image", "distance": distance}
+                del fingerprint["pixels"]
+                break
+        else:
+            image_pages.append((page_num, fingerprint))
+    return duplicates
+
+
+_WORD = re.compile(r"\w+")
+
+
+# Rescanned repeats among the image pages find_duplicates kept apart, from
+# their OCR texts ({page_num: text}). Only the fingerprints' hashes are used.
+# Returns {page_num: match} like find_duplicates, with match "ocr_text", the
+# word "similarity" and the hash distance for reference
+def find_text_duplicates(fingerprints, texts, duplicates) -> dict:
+    if DEDUP_MIN_TEXT_SIMILARITY <= 0:
+        return {}
+    found = {}
+    pages = []  # (page_num, fingerprint, words, numbers) of the distinct image pages
+    for page_num, fingerprint in fingerprints:
+        if fingerprint is None or fingerprint["kind"] != "image" or page_num in duplicates:
+            continue
+        words = _WORD.findall((texts.get(page_num) or "").lower())
+        if not words:
+            continue
+        numbers = sorted(word for word in words if any(c.isdigit() for c in word))
+        for first, first_fingerprint, first_words, first_numbers in pages:
+            if numbers != first_numbers:
+                continue
+            matcher = difflib.SequenceMatcher(None, first_words, words, autojunk=False)
+            if matcher.real_quick_ratio() < DEDUP_MIN_TEXT_SIMILARITY:
+                continue
+            if matcher.quick_ratio() < DEDUP_MIN_TEXT_SIMILARITY:
+                continue
+            similarity = matcher.ratio()
+            if similarity >= DEDUP_MIN_TEXT_SIMILARITY:
+                found[page_num] = {"same_as": first, "match": "ocr_text",
+                                   "distance": _hash_distance(fingerprint, first_fingerprint),
+                                   "similarity": round(similarity, 3)}
+                break
+        else:
+            pages.append((page_num, fingerprint, words, numbers))
+    return found
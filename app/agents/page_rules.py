@@ -0,0 +1,74 @@
+import ahocorasick
+from app.agents.agent_config import page_classification_rules
+
+
+# Lower-case and collapse whitespace, so phrases match across line breaks
+# the same way page.search_for did on the OCR'd page
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+# Finds which of many phrases occur in a text in a single Aho-Corasick pass,
+# including overlapping and nested phrases
+class PhraseMatcher:
+    def __init__(self, phrases):
+        self.phrases = sorted({normalize_text(p) for p in phrases if p.strip()})
+        self.automaton = ahocorasick.Automaton()
+        for phrase in self.phrases:
+            self.automaton.add_word(phrase, phrase)
+        if self.phrases:
+            self.automaton.make_automaton()
+
+    # text must already be normalized
+    def find(self, text: str) -> set:
+        if not self.phrases:
+            return set()
+        return {phrase for _, phrase in self.automaton.iter(text)}
+
+
+# One bank's rule table (see page_classification_rules) compiled to a matcher
+class PageClassifier:
+    def __init__(self, rules):
+        self.rules = [self._compile_rule(rule) for rule in rules]
+        phrases = []
+        for rule in rules:
+            phrases += rule["match"]
+            for branch in rule.get("branches", []):
+                phrases += branch["if_any"]
+        self.matcher = PhraseMatcher(phrases)
+
+    @staticmethod
+    def _compile_rule(rule):
+        compiled = dict(rule)
+        compiled["match"] = {normalize_text(p) for p in rule["match"]}
+        compiled["branches"] = [dict(branch, if_any={normalize_text(p) for p in branch["if_any"]})
+                                for branch in rule.get("branches", [])]
+        return compiled
+
+    # Labels for a page and the sections it leaves pending for the next page
+    def classify(self, text: str):
+        hits = self.matcher.find(text)
+        labels = []
+        pending = []
+        for rule in self.rules:
+            if not hits & rule["match"]:
+                continue
+            if "label" in rule:
+                outcome = rule
+            else:
+                outcome = next((branch for branch in rule["branches"] if hits & branch["if_any"]),
+                               rule.get("else"))
+            if not outcome:
+                continue
+            labels.append(outcome["label"])
+            if outcome.get("continues"):
+                pending.append(outcome["continues"])
+        return labels, pending
+
+
+# Compiled once at import, shared by every request
+page_classifiers = {bank: PageClassifier(rules) for bank, rules in page_classification_rules.items()}
+
+
+def get_page_classifier(bank_name: str):
+    return page_classifiers.get(bank_name.upper())
@@ -0,0 +1,236 @@
+import asyncio
+import json
+import os
+from app.utils.logger import logger
+from app.utils.page_store import PageStore
+from app.utils.result_cache import get_cache, sha256_hex
+from app.utils.file_utils import file_sha256
+from app.utils.image_prep import image_prep_settings
+from app.utils.metrics import DOCUMENT_PAGES, observe_cache, track_stage
+from app.agents.agent_config import bank_field_mappings, bank_aliases, VLM_MODE
+from app.agents.preprocess import pdf_to_images, filter_bank_copy, ocr_settings
+from app.agents.page_dedup import dedup_settings
+from app.agents.field_rules import rule_settings
+from app.agents import vlm_agent
+from app.agents.vlm_agent import classify_document, extract_fields
+
+# Batch scheduling: documents in the CPU stages at once, documents in the VLM
+# stage at once, and prepared documents allowed to wait for the VLM stage
+BATCH_CPU_WORKERS = int(os.getenv("BATCH_CPU_WORKERS", "1"))
+BATCH_VLM_WORKERS = int(os.getenv("BATCH_VLM_WORKERS", "2"))
+BATCH_PREFETCH = int(os.getenv("BATCH_PREFETCH", "2"))
+
+# Bump when a pipeline change should invalidate cached documents without any
+# change to the model, prompts or page mapping
+PIPELINE_REVISION = "5"
+
+# Cached results are only reused for the same model, prompts, page mapping,
+# bank aliases, OCR / text layer settings, image preparation, VLM batching,
+# page dedup and field rules
+PIPELINE_VERSION = sha256_hex(
+    PIPELINE_REVISION,
+    vlm_agent.model_name,
+    vlm_agent.system_prompt,
+    vlm_agent.build_user_prompt([]),
+    json.dumps(bank_field_mappings, sort_keys=True),
+    json.dumps(bank_aliases, sort_keys=True),
+    json.dumps(ocr_settings(), sort_keys=True),
+    json.dumps(image_prep_settings(), sort_keys=True),
+    json.dumps({"vlm_mode": VLM_MODE, "max_images_per_call": vlm_agent.VLM_MAX_IMAGES_PER_CALL}),
+    json.dumps(dedup_settings(), sort_keys=True),
+    json.dumps(rule_settings(), sort_keys=True),
+)
+
+# Response field -> key in the merged VLM result
+RESPONSE_FIELDS = {
+    "ref_no": "ref_no",
+    "date": "date",
+    "open_date": "open_date",
+    "close_date": "close_date",
+    "borrower_name": "borrower_name",
+    "borrower_registration_number": "borrower_registration_number",
+    "borrower_address": "borrower_address",
+    "bank_name": "bank_name",
+    "bank_address": "bank_address",
+    "bank_registration_number": "bank_registration_number",
+    "subject_matter": "subject_of_FA",
+    "total_loan_amount": "total_loan_amount",
+    "gurantor_name": "gurantor_name",
+    "gurantor_nric": "gurantor_nric",
+    "coporate_gurantor_name": "coporate_gurantor_name",
+    "coporate_gurantor_registration_number": "coporate_gurantor_registration_number",
+    "law_firm_name": "law_firm_name",
+    "law_firm_address": "law_firm_address",
+    "property_description": "property_title",
+    "property_address": "property_address",
+    "property_price": "property_price",
+}
+
+
+# Format the extracted information
+def format_result(extracted_info: dict, metadata: dict) -> dict:
+    formatted_info = {field: extracted_info.get(key, "") for field, key in RESPONSE_FIELDS.items()}
+    formatted_info["metadata"] = metadata
+    return formatted_info
+
+
+# Stored result for a file, keyed by its hash and the pipeline version.
+# Returns (cache, cache_key, result or None)
+async def lookup_document(pdf_path: str, filename: str = "", file_hash: str = None):
+    cache = get_cache("documents")
+    if cache is not None and file_hash is None:
+        file_hash = await asyncio.to_thread(file_sha256, pdf_path)
+    cache_key = sha256_hex(file_hash or "", PIPELINE_VERSION)
+    if cache is None:
+        return None, cache_key, None
+    cached = await cache.aget(cache_key)
+    observe_cache("documents", cached is not None)
+    if cached is None:
+        return cache, cache_key, None
+    logger.info(f"Using cached result for {filename}")
+    cached["metadata"]["cache"] = "hit"
+    return cache, cache_key, cached
+
+
+# CPU stages for one PDF: render/OCR, bank copy, bank detection and page
+# classification. Returns the bank name
+async def prepare_document(pdf_path: str, store: PageStore, filename: str = "", on_stage=None) -> str:
+    on_stage = on_stage or (lambda stage, **details: None)
+
+    # Convert PDFs to Images (CPU-bound stages run off the event loop)
+    on_stage("rendering")
+    with track_stage("rendering") as attrs:
+        num_images = await asyncio.to_thread(pdf_to_images, pdf_path, store)
+        attrs["pages"] = store.page_count
+    DOCUMENT_PAGES.observe(store.page_count)
+    logger.info(f"Number of Images Converted for {filename}: {num_images}")
+
+    # Filter bank copy
+    on_stage("bank_detection")
+    with track_stage("bank_copy"):
+        await asyncio.to_thread(filter_bank_copy, store)
+
+    return await classify_document(store, on_stage=on_stage)
+
+
+# Result for a finished store; cached unless it is empty (e.g. no page
+# mapping for the bank) or a VLM call failed, so the next request retries
+async def finish_document(store: PageStore, extracted_info: dict, cache=None, cache_key: str = None) -> dict:
+    # Which path (native text layer or OCR) each page took
+    page_sources = [{"page": n, "source": store.sources.get(n, "")} for n in store.page_numbers()]
+    # Repeated pages that took another page's OCR text and VLM answer
+    dedup = {"pages": store.page_count, "unique_pages": store.page_count - len(store.duplicates),
+             "deduplicated_pages": len(store.duplicates), "shared_vlm_calls": store.shared_vlm_calls,
+             "duplicates": [{"page": n, **match} for n, match in sorted(store.duplicates.items())]}
+    # Fields read by the field rules instead of (or as a fallback for) the VLM
+    rules = {"fields": list(store.rule_fields), "skipped_vlm_calls": store.skipped_vlm_calls}
+    result = format_result(extracted_info, {"page_sources": page_sources, "vlm_calls": list(store.vlm_calls),
+                                            "dedup": dedup, "rules": rules, "cache": "miss"})
+    failed = any(call.get("error") for call in store.vlm_calls)
+    if cache is not None and extracted_info and not failed:
+        await cache.aset(cache_key, result)
+    return result
+
+
+# Full VLM extraction for one PDF on disk: render/OCR, bank detection, page
+# classification and per-page VLM extraction. on_stage(stage, **details)
+# reports progress (rendering, bank_detection, classifying, extracting).
+# file_hash is the SHA-256 of the file, if the caller already computed it
+async def run_extraction(pdf_path: str, filename: str = "", on_stage=None, file_hash: str = None) -> dict:
+    # Same bytes + same pipeline version -> return the stored result
+    cache, cache_key, cached = await lookup_document(pdf_path, filename, file_hash)
+    if cached is not None:
+        return cached
+
+    # Pages live in a per-request store and are released when the block exits,
+    # so concurrent documents never see each other's pages
+    with PageStore() as store:
+        bank_name = await prepare_document(pdf_path, store, filename, on_stage=on_stage)
+        # VLM Processing (async, concurrent page calls)
+        extracted_info = await extract_fields(store, bank_name, on_stage=on_stage)
+        return await finish_document(store, extracted_info, cache, cache_key)
+
+
+# Render every labelled page ahead of the VLM stage, so a batch's GPU workers
+# don't wait on rasterization
+def prerender_labels(store: PageStore):
+    for label in list(store.labels):
+        store.get_label(label)
+
+
+# Run many PDFs with the CPU stages (render/OCR/classify) and the VLM stage
+# as separate worker pools joined by a bounded queue, so one document's VLM
+# calls overlap the next document's OCR. documents is a list of dicts with
+# pdf_path, filename and file_hash. Yields (index, document, result, error)
+# as each document finishes, in completion order
+async def run_batch(documents, cpu_workers: int = None, vlm_workers: int = None, prefetch: int = None):
+    cpu_workers = max(1, cpu_workers or BATCH_CPU_WORKERS)
+    vlm_workers = max(1, vlm_workers or BATCH_VLM_WORKERS)
+    pending = asyncio.Queue()
+    for item in enumerate(documents):
+        pending.put_nowait(item)
+    # Prepared documents waiting for the VLM stage; bounded so the CPU side
+    # doesn't hold many documents' pages in memory ahead of the GPU
+    prepared = asyncio.Queue(maxsize=max(1, prefetch or BATCH_PREFETCH))
+    finished = asyncio.Queue()
+
+    async def cpu_worker():
+        while True:
+            try:
+                index, document = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            store = None
+            try:
+                cache, cache_key, cached = await lookup_document(document["pdf_path"], document["filename"],
+                                                                 document.get("file_hash"))
+                if cached is not None:
+                    finished.put_nowait((index, document, cached, None))
+                    continue
+                store = PageStore()
+                bank_name = await prepare_document(document["pdf_path"], store, document["filename"])
+                await asyncio.to_thread(prerender_labels, store)
+                await prepared.put((index, document, store, bank_name, cache, cache_key))
+                # The VLM worker owns the store now
+                store = None
+            except Exception as e:
+                logger.error(f"Batch document {document['filename']} failed: {e}")
+                finished.put_nowait((index, document, None, e))
+            finally:
+                # Failed, or cancelled (client gone) before the hand-off
+                if store is not None:
+                    store.close()
+
+    async def vlm_worker():
+        while True:
+            item = await prepared.get()
+            if item is None:
+                return
+            index, document, store, bank_name, cache, cache_key = item
+            try:
+                with store:
+                    extracted_info = await extract_fields(store, bank_name)
+                    result = await finish_document(store, extracted_info, cache, cache_key)
+                finished.put_nowait((index, document, result, None))
+            except Exception as e:
+                logger.error(f"Batch document {document['filename']} failed: {e}")
+                finished.put_nowait((index, document, None, e))
+
+    async def cpu_stage():
+        await asyncio.gather(*[cpu_worker() for _ in range(cpu_workers)])
+        for _ in range(vlm_workers):
+            await prepared.put(None)
+
+    tasks = [asyncio.create_task(cpu_stage())] + [asyncio.create_task(vlm_worker()) for _ in range(vlm_workers)]
+    try:
+        for _ in range(len(documents)):
+            yield await finished.get()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Stores of documents that never reached the VLM stage (client gone)
+        while not prepared.empty():
+            item = prepared.get_nowait()
+            if item is not None:
+                item[2].close()
@@ -1,12 +1,99 @@
 import pymupdf  # PyMuPDF
 import pytesseract
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_path, pdfinfo_from_path
+from app.utils.logger import logger
+from app.utils.page_store import PageStore
+from app.utils.result_cache import get_cache, sha256_hex
+from app.utils.image_prep import VLM_MAX_EDGE
+from app.utils.metrics import PAGES, observe_cache, observe_page_step
+from app.utils.tracing import span
+from app.agents.page_rules import PhraseMatcher, get_page_classifier, normalize_text
+from app.agents.page_dedup import (DEDUP_PAGES, DEDUP_ZOOM, find_duplicates, find_text_duplicates,
+                                   image_fingerprint, text_fingerprint)
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import multiprocessing
+import tempfile
+import threading
+import time
 import os
-import shutil
 
 # Set OCR languages (English + Malay)
 OCR_LANG = "eng+msa"
 
+# "hybrid" reads the native text layer where a page has one and OCRs only
+# image pages; "ocr" treats every page as a scan
+TEXT_LAYER_MODE = os.getenv("TEXT_LAYER_MODE", "hybrid")
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "100"))
+TEXT_LAYER_MIN_COVERAGE = float(os.getenv("TEXT_LAYER_MIN_COVERAGE", "0.9"))
+
+# Zoom used for images sent to the VLM
+PAGE_ZOOM = 4.0
+
+# "tiered" OCRs pages once at CLASSIFY_ZOOM for the bank copy markers and
+# classification, and renders at PAGE_ZOOM only the pages that are sent to
+# the VLM; a page that came out of that OCR without text is probed for the
+# markers on just its top PROBE_REGION at PROBE_ZOOM (see has_bank_copy_marker).
+# "full" renders and OCRs every page at PAGE_ZOOM
+CLASSIFY_MODE = os.getenv("CLASSIFY_MODE", "tiered")
+CLASSIFY_ZOOM = float(os.getenv("CLASSIFY_ZOOM", "2.0"))
+PROBE_ZOOM = float(os.getenv("PROBE_ZOOM", "1.5"))
+PROBE_REGION = float(os.getenv("PROBE_REGION", "0.4"))
+
+# Settings that change which pages are OCR'd, at what zoom and so what text
+# the classifier and field rules read, for the pipeline version
+def ocr_settings() -> dict:
+    return {"ocr_lang": OCR_LANG, "text_layer_mode": TEXT_LAYER_MODE,
+            "text_layer_min_chars": TEXT_LAYER_MIN_CHARS, "text_layer_min_coverage": TEXT_LAYER_MIN_COVERAGE,
+            "classify_mode": CLASSIFY_MODE, "classify_zoom": CLASSIFY_ZOOM, "page_zoom": PAGE_ZOOM,
+            "probe_zoom": PROBE_ZOOM, "probe_region": PROBE_REGION}
+
+# Header phrases that identify the bank copy (letter of offer) page
+BANK_COPY_MARKERS = [
+    'we are pleased',
+    'strictly private and highly confidential',
+    'private & confidential',
+    'private and confidential',
+]
+bank_copy_matcher = PhraseMatcher(BANK_COPY_MARKERS)
+
+# Size of the process pool used for the CPU-bound page stage (Tesseract is
+# single-threaded). 1 runs everything in the calling process
+PAGE_WORKERS = int(os.getenv("PAGE_WORKERS", str(os.cpu_count() or 1)))
+
+_page_pool = None
+_page_pool_lock = threading.Lock()
+
+# Shared across requests so workers are spawned once per process
+def get_page_pool():
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            _page_pool = ProcessPoolExecutor(max_workers=PAGE_WORKERS,
+                                             mp_context=multiprocessing.get_context("spawn"))
+    return _page_pool
+
+# Upper bound on pages being rendered/OCR'd (or waiting to be collected) at
+# once, so peak memory depends on this window rather than on document length
+MAX_INFLIGHT_PAGES = int(os.getenv("MAX_INFLIGHT_PAGES", str(2 * max(1, PAGE_WORKERS))))
+
+# Lazily run fn over items in the page pool, yielding results in input order
+# with at most MAX_INFLIGHT_PAGES tasks submitted at any time
+def imap_pages(fn, items):
+    if PAGE_WORKERS <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    pool = get_page_pool()
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= MAX_INFLIGHT_PAGES:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
 # Extract text from text-based PDF
 def extract_text_pdf(file_bytes: bytes) -> str:
     text = ""
@@ -15,181 +102,348 @@ def extract_text_pdf(file_bytes: bytes) -> str:
             text += page.get_text()
     return text
 
-# Extract text using OCR from image-based PDF (multi-language)
-def extract_text_ocr(file_bytes: bytes) -> str:
-    text = ""
-    images = convert_from_bytes(file_bytes)
-    # Log Total Pages
-    print(f"Total pages to process: {len(images)}")
-
-    for image in images:
-        # Log Loop Iteration
-        print(f"Processing image {images.index(image) + 1} of {len(images)}")
-        text += pytesseract.image_to_string(image, lang=OCR_LANG)
+# Decode and OCR a single page, so only in-flight pages are held as images
+def ocr_pdf_page(args) -> str:
+    pdf_path, page_num = args
+    image = convert_from_path(pdf_path, first_page=page_num, last_page=page_num)[0]
+    return pytesseract.image_to_string(image, lang=OCR_LANG)
+
+# Extract text using OCR from image-based PDF (multi-language).
+# Accepts the PDF as bytes or as a file path
+def extract_text_ocr(pdf) -> str:
+    tmp_path = None
+    if isinstance(pdf, (bytes, bytearray)):
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            f.write(pdf)
+            tmp_path = f.name
+    pdf_path = tmp_path or pdf
+    try:
+        num_pages = pdfinfo_from_path(pdf_path)["Pages"]
+        # Log Total Pages
+        logger.info(f"Total pages to process: {num_pages}")
+
+        # Pages are OCR'd in parallel; imap_pages keeps page order
+        pages = ((pdf_path, page_num) for page_num in range(1, num_pages + 1))
+        return "".join(imap_pages(ocr_pdf_page, pages))
+    finally:
+        if tmp_path:
+            os.unlink(tmp_path)
+
+# Read a page's native text layer. Returns None when the page has no usable
+# text: too few characters, or too many of them without a real glyph mapping
+# (broken font encodings come out as U+FFFD)
+def page_text_layer(page):
+    if not page.get_fonts():
+        return None
+    text = page.get_text()
+    chars = [c for c in text if not c.isspace()]
+    if len(chars) < TEXT_LAYER_MIN_CHARS:
+        return None
+    readable = sum(1 for c in chars if c != "\ufffd" and c.isprintable())
+    if readable / len(chars) < TEXT_LAYER_MIN_COVERAGE:
+        return None
     return text
 
-# Convert each pages into images and store in directory ./pages
-def pdf_to_images(file_bytes: bytes, output_dir='./pages'):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    doc = pymupdf.open(stream=file_bytes, filetype="pdf")
+# Render a page for the VLM. The zoom is capped so the long edge is not much
+# bigger than VLM_MAX_EDGE, since the image is downsized to that size anyway
+def render_page(doc, page_num: int) -> bytes:
+    start_time = time.perf_counter()
+    page = doc.load_page(page_num - 1)
+    zoom = PAGE_ZOOM
+    if VLM_MAX_EDGE:
+        zoom = min(zoom, VLM_MAX_EDGE / max(page.rect.width, page.rect.height))
+    image = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom)).tobytes("png")
+    observe_page_step("render", time.perf_counter() - start_time, page=page_num)
+    return image
+
+# Each pool worker keeps the document it is working on open between pages
+_worker_doc = None
+
+def _open_worker_doc(pdf_path: str):
+    global _worker_doc
+    if _worker_doc is None or _worker_doc[0] != pdf_path:
+        if _worker_doc is not None:
+            _worker_doc[1].close()
+        _worker_doc = (pdf_path, pymupdf.open(pdf_path))
+    return _worker_doc[1]
+
+# Dedup fingerprint of a page: its text-layer text, or a greyscale rendering
+# at DEDUP_ZOOM for image pages (see page_dedup)
+def fingerprint_doc_page(doc, page_num: int):
+    page = doc.load_page(page_num - 1)
+    text = page_text_layer(page) if TEXT_LAYER_MODE == "hybrid" else None
+    if text is not None:
+        return text_fingerprint(text)
+    pix = page.get_pixmap(matrix=pymupdf.Matrix(DEDUP_ZOOM, DEDUP_ZOOM), colorspace=pymupdf.csGRAY, alpha=False)
+    return image_fingerprint(pix)
+
+# Fingerprint worker (runs in the page pool)
+def fingerprint_page(args):
+    pdf_path, page_num = args
+    return page_num, fingerprint_doc_page(_open_worker_doc(pdf_path), page_num)
+
+# Find the repeated pages of a document, so the page stage only processes the
+# first of each. Returns ({page_num: match}, fingerprints), see
+# page_dedup.find_duplicates
+def detect_duplicate_pages(pdf_path: str, doc, page_nums):
+    with span("dedup", pages=len(page_nums)) as attrs:
+        if PAGE_WORKERS <= 1:
+            results = ((page_num, fingerprint_doc_page(doc, page_num)) for page_num in page_nums)
+        else:
+            results = imap_pages(fingerprint_page, ((pdf_path, page_num) for page_num in page_nums))
+        # Pages are matched as their fingerprints arrive, so only the distinct
+        # pages' renderings are held at once
+        fingerprints = []
+        def collect():
+            for page_num, fingerprint in results:
+                if fingerprint is not None:
+                    fingerprints.append((page_num, fingerprint))
+                yield page_num, fingerprint
+        duplicates = find_duplicates(collect())
+        attrs["duplicates"] = len(duplicates)
+    for page_num, duplicate in duplicates.items():
+        logger.info(f"Page {page_num} repeats page {duplicate['same_as']} ({duplicate['match']} match)")
+    # The renderings are only needed for the pixel check
+    for _, fingerprint in fingerprints:
+        fingerprint.pop("pixels", None)
+    return duplicates, fingerprints
+
+# Rescanned repeats, found from the OCR text once the page stage is done
+# (see page_dedup.find_text_duplicates). They keep their own text and share
+# the first copy's image and VLM calls
+def detect_rescanned_pages(store: PageStore, fingerprints):
+    with span("dedup.ocr_text", pages=len(fingerprints)) as attrs:
+        rescans = find_text_duplicates(fingerprints, store.texts, store.duplicates)
+        attrs["duplicates"] = len(rescans)
+    for page_num, duplicate in rescans.items():
+        logger.info(f"Page {page_num} repeats page {duplicate['same_as']} "
+                    f"(ocr_text match, similarity {duplicate['similarity']})")
+    store.duplicates.update(rescans)
+
+# Page stage worker (runs in the page pool)
+def process_page(args):
+    pdf_path, page_num, zoom, keep_images = args
+    return process_doc_page(_open_worker_doc(pdf_path), page_num, zoom, keep_images)
+
+# Read the page's text layer, or render it once at `zoom` and OCR the
+# in-memory pixmap. The PNG is only returned when keep_images is set.
+# Step timings (seconds) come back with the result, since this may run in a
+# pool worker whose metrics are not collected
+def process_doc_page(doc, page_num: int, zoom: float, keep_images: bool):
+    logger.debug(f"Processing page {page_num} of {len(doc)}")
+    start_time = time.perf_counter()
+    page = doc.load_page(page_num - 1)
+    text = page_text_layer(page) if TEXT_LAYER_MODE == "hybrid" else None
+    timings = {"text_layer": time.perf_counter() - start_time}
+    if text is not None:
+        return {"page": page_num, "text": text, "source": "text", "image": None, "timings": timings}
+
+    start_time = time.perf_counter()
+    pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom))
+    result = {"page": page_num, "text": None, "source": "ocr",
+              "image": pix.tobytes("png") if keep_images else None, "timings": timings, "ocr_cache": None}
+    timings["render"] = time.perf_counter() - start_time
+    try:
+        start_time = time.perf_counter()
+        result["text"], result["ocr_cache"] = cached_ocr(pix, zoom)
+        timings["ocr"] = time.perf_counter() - start_time
+    except Exception as e:
+        result["source"] = "ocr_failed"
+        logger.warning(f"Error running OCR on page {page_num}: {str(e)}")
+    return result
+
+# Classify each page as text-layer or image page across the page pool.
+# Pages are streamed from the file on disk through a bounded window.
+# Text-layer pages keep their native text and are only rasterized later if a
+# stage asks for the image. In "full" mode image pages are rendered once at
+# PAGE_ZOOM, OCR'd once and the PNG buffer is kept; in "tiered" mode they are
+# OCR'd at CLASSIFY_ZOOM and the full-resolution image is rendered on demand
+def pdf_to_images(pdf_path: str, store: PageStore):
+    doc = pymupdf.open(pdf_path)
+    store.document = doc
+    store.page_count = len(doc)
+    store.renderer = lambda page_num: render_page(doc, page_num)
+
+    # Repeated pages are not rendered or OCR'd; they take the first copy's result
+    fingerprints = []
+    if DEDUP_PAGES:
+        store.duplicates, fingerprints = detect_duplicate_pages(pdf_path, doc, store.page_numbers())
+    page_nums = [page_num for page_num in store.page_numbers() if page_num not in store.duplicates]
+
+    tiered = CLASSIFY_MODE == "tiered"
+    zoom = CLASSIFY_ZOOM if tiered else PAGE_ZOOM
+    if PAGE_WORKERS <= 1:
+        results = (process_doc_page(doc, page_num, zoom, not tiered) for page_num in page_nums)
+    else:
+        tasks = ((pdf_path, page_num, zoom, not tiered) for page_num in page_nums)
+        results = imap_pages(process_page, tasks)
+
     num_images = 0
+    for result in results:
+        page_num = result["page"]
+        for step, seconds in result["timings"].items():
+            observe_page_step(step, seconds, page=page_num)
+        if result.get("ocr_cache") is not None:
+            observe_cache("ocr_pages", result["ocr_cache"])
+        PAGES.labels(result["source"]).inc()
+        if result["image"] is not None:
+            store.put_page(page_num, result["image"])
+            num_images += 1
+        if result["text"] is not None:
+            store.put_text(page_num, result["text"], source=result["source"])
+        else:
+            store.sources[page_num] = result["source"]
 
-    # Use Matrix for zoom (increasing DPI)
-    zoom_matrix = pymupdf.Matrix(4.0, 4.0)
-    for page_num in range(len(doc)):
-        print(f"Processing page {num_images + 1} of {len(doc)}")
-        page = doc.load_page(page_num)
-        pix = page.get_pixmap(matrix=zoom_matrix)
-        pix.save(f"{output_dir}/page_{page_num + 1}.png")
-        num_images += 1
-    doc.close()
+    for page_num, duplicate in store.duplicates.items():
+        PAGES.labels("duplicate").inc()
+        first = duplicate["same_as"]
+        if first in store.texts:
+            store.put_text(page_num, store.texts[first], source=store.sources[first])
+        else:
+            store.sources[page_num] = store.sources.get(first, "")
+
+    if fingerprints:
+        detect_rescanned_pages(store, fingerprints)
     return num_images
 
-def filter_bank_copy(output_dir='./pages'):
-    images = [f for f in os.listdir(output_dir) if f.lower().endswith('.png')]
-    images.sort(key=lambda x: int(x.split('_')[1].split('.')[0]))
-    
-    print(f"Total images to process: {len(images)}")
-    for img_name in images:
-        print(f"Processing image: {img_name}")
-        img_path = os.path.join(output_dir, img_name)
+# OCR text is cached by the hash of the rendered pixels, so a page that was
+# seen before (same document, or a partially changed one) skips Tesseract.
+# The key also covers the zoom, colorspace and OCR language.
+# Returns (text, cache hit), with None for the hit when caching is off
+def cached_ocr(pix, zoom: float):
+    cache = get_cache("ocr_pages")
+    if cache is None:
+        return ocr_pixmap(pix), None
+    key = sha256_hex(pix.samples, str(zoom), pix.colorspace.name if pix.colorspace else "", OCR_LANG)
+    text = cache.get(key)
+    if text is not None:
+        return text, True
+    text = ocr_pixmap(pix)
+    cache.set(key, text)
+    return text, False
+
+# OCR a rendered pixmap without going through a PNG file
+def ocr_pixmap(pix) -> str:
+    if pix.colorspace != pymupdf.csRGB:
+        pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
+    if pix.alpha:
+        pix = pymupdf.Pixmap(pix, 0)  # Remove alpha channel
+
+    # Convert Pixmap to PDF with OCR
+    pdf_bytes = pix.pdfocr_tobytes()
+    with pymupdf.open('pdf', pdf_bytes) as doc:
+        return doc[0].get_text()
+
+# Whether a page carries a bank copy marker, matched on the text the page
+# stage already read or OCR'd. A page that came out without text (a blank
+# duplex back or separator sheet, or failed OCR) is probed in tiered mode:
+# only its top PROBE_REGION, where the header markers sit, is OCR'd at
+# PROBE_ZOOM, and only a page whose probe finds a marker is OCR'd in full (at
+# PAGE_ZOOM) for classification. In full mode it is OCR'd in full straight
+# away. The full text is kept in the store
+def has_bank_copy_marker(store: PageStore, page_num: int) -> bool:
+    text = store.texts.get(page_num)
+    if text and text.strip():
+        return bool(bank_copy_matcher.find(normalize_text(text)))
+    page = store.document.load_page(page_num - 1)
+    if CLASSIFY_MODE == "tiered":
+        start_time = time.perf_counter()
+        rect = page.rect
+        clip = pymupdf.Rect(rect.x0, rect.y0, rect.x1, rect.y0 + rect.height * PROBE_REGION)
+        probe = ocr_pixmap(page.get_pixmap(matrix=pymupdf.Matrix(PROBE_ZOOM, PROBE_ZOOM), clip=clip))
+        observe_page_step("probe", time.perf_counter() - start_time, page=page_num)
+        if not bank_copy_matcher.find(normalize_text(probe)):
+            return False
+    start_time = time.perf_counter()
+    text = ocr_pixmap(page.get_pixmap(matrix=pymupdf.Matrix(PAGE_ZOOM, PAGE_ZOOM)))
+    observe_page_step("ocr", time.perf_counter() - start_time, page=page_num)
+    if text.strip():
+        store.put_text(page_num, text, source="ocr")
+    # The probe's marker was found, so the page counts even if the full OCR
+    # misreads it
+    return CLASSIFY_MODE == "tiered" or bool(bank_copy_matcher.find(normalize_text(text)))
+
+# Mark the first page carrying a bank copy marker as the 'bank_copy' role
+def filter_bank_copy(store: PageStore):
+    page_nums = store.page_numbers()
+
+    logger.debug(f"Total images to process: {len(page_nums)}")
+    for page_num in page_nums:
+        img_name = store.page_name(page_num)
+        # A repeat of a page already checked can't be the first marked page
+        # (a rescan has its own text, which may carry a different copy marker)
+        if store.duplicates.get(page_num, {}).get("match") in ("text", "image"):
+            continue
+        logger.debug(f"Processing image: {img_name}")
         try:
-            page_num = int(img_name.split('_')[1].split('.')[0])
-            
-            pix = pymupdf.Pixmap(img_path)
-            if pix.colorspace != pymupdf.csRGB:
-                pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
-            if pix.alpha:
-                pix = pymupdf.Pixmap(pix, 0)
-            
-            pdf_bytes = pix.pdfocr_tobytes()
-            doc = pymupdf.open('pdf', pdf_bytes)
-            page = doc[0]
-            
-            if (page.search_for('we are pleased') or
-                page.search_for('strictly private and highly confidential') or
-                page.search_for('private & confidential') or
-                page.search_for('private and confidential')):
-                new_name = 'bank_copy.png'
-                new_path = os.path.join(output_dir, new_name)
-                os.rename(img_path, new_path)
-                print(f"Renamed {img_name} to {new_name}")
+            if has_bank_copy_marker(store, page_num):
+                store.set_role('bank_copy', page_num)
+                logger.info(f"Renamed {img_name} to bank_copy")
                 break
-                
-            doc.close()
-            pix = None
             
         except Exception as e:
-            print(f"Error processing {img_name}: {str(e)}")
-
-# Filter page and rename page name using PYMUPDF OCR
-def filter_and_rename_pages(bank_name: str, output_dir='./pages'):
-    print(f"Filtering pages for bank: {bank_name}")
-    filtered_dir = os.path.join(output_dir, 'filtered')
-    if not os.path.exists(filtered_dir):
-        os.makedirs(filtered_dir)
-    
-    images = [f for f in os.listdir(output_dir) if f.lower().endswith(('.png'))]
-    # Sort images by numerical part of filename
-    images.sort(key=lambda x: int(x.split('_')[1].split('.')[0]) if x != 'bank_copy.png' else 0)    
-
-    print(f"Total images to process: {len(images)}")
-    pending_subject_fa = False
-    pending_gurantor_details = False
-    pending_property_details = False
-
-    for img_name in images:
-        print(f"Processing image: {img_name}")
-        img_path = os.path.join(output_dir, img_name)
-        try:
-            # Convert image to Pixmap
-            pix = pymupdf.Pixmap(img_path)
-            if pix.colorspace != pymupdf.csRGB:
-                pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
-            if pix.alpha:
-                pix = pymupdf.Pixmap(pix, 0)  # Remove alpha channel
-            
-            # Convert Pixmap to PDF with OCR
-            pdf_bytes = pix.pdfocr_tobytes()
-            doc = pymupdf.open('pdf', pdf_bytes)
-            page = doc[0]
-            
-            # Collect all matching names
-            new_names = []
-
-            # To check if the contents continue to next page
-            if pending_subject_fa:
-                new_names.append('subject_of_fa_2.png')
-                pending_subject_fa = False
-
-            if pending_gurantor_details:
-                new_names.append('gurantor_details_2.png')
-                pending_gurantor_details = False
-
-            if pending_property_details:
-                new_names.append('property_details_2.png')
-                pending_property_details = False
-
-            if bank_name.upper() == 'CIMB BANK BERHAD' or bank_name.upper() == 'CIMB ISLAMIC BANK BERHAD':
-                if (page.search_for('we are pleased to inform you that') or
-                    page.search_for('strictly private and highly confidential')):
-                    new_names.append(f'bank_copy.png')
-
-                if (page.search_for('form of facility') or
-                    page.search_for('facility amount is an amount which is equal') or
-                    page.search_for('type of facility') or 
-                    page.search_for('payment amount (RM per payment)')):
-                    # check if the content contain total
-                    if (page.search_for('total')):
-                        new_names.append(f'subject_of_fa.png')
-                    else:
-                        # To check if the contents continue to next page
-                        # Add current page as 'subject_of_fa_1'
-                        # Add the next page as 'subject_of_fa_2
-                        new_names.append('subject_of_fa_1.png')
-                        pending_subject_fa = True
-                if (page.search_for('pengiraan duit yang dikenakan') or
-                    page.search_for('salinan kepada')):
-                    new_names.append(f'law_firm_details.png')
-                if (page.search_for('to finance the purchase of the property described below') or page.search_for('execution of open charge under')
-                 or page.search_for('a letter of undertaking from registered owner')):
-                    if(page.search_for('if there is a disrepancy in the property details stated above') or page.search_for('individual title') or 
-                    page.search_for('strava title')):
-                        new_names.append(f'property_details.png')
-                    else:
-                        pending_property_details = True
-                        new_names.append(f'property_details_1.png')
-
-                if (page.search_for('all of the following documents (the "Security Documents") must be executed and perfected, in form and content acceptable to the Bank.') or
-                    page.search_for('the following security which shall be in such form') or
-                    page.search_for('execution of joint and several guarantee in favour of the bank')):
-                    if (page.search_for('joint and several guarantee in favour of the bank') or
-                        page.search_for('corporate guarantee in favour of the bank') or
-                        page.search_for('individual guarantee in favour of the bank')):
-                        new_names.append(f'guarantor_details.png')
-                    elif (page.search_for('property with')):
-                        new_names.append(f'property_details.png')
-                    else:
-                        # To check if the contents continue to next page
-                        # Add current page as 'gurantor_details_1'
-                        # Add the next page as 'gurantor_details_2'
-                        new_names.append('gurantor_details_1.png')
-                        pending_gurantor_details = True
-            doc.close()
-            pix = None
-            
-            # Copy image for each matching name
-            for new_name in new_names:
-                dest_path = os.path.join(filtered_dir, new_name)
-                shutil.copy(img_path, dest_path)
-                print(f"Saved {img_name} as {new_name}")
-            
-            if not new_names:
-                print(f"{img_name} does not match any criteria.")
-                
-        except Exception as e:
-            print(f"Error processing {img_name}: {str(e)}")
-            pending_subject_fa = False  # Reset on error
-            pending_gurantor_details = True
+            logger.warning(f"Error processing {img_name}: {str(e)}")
+
+# Bank copy first, then the remaining pages in page order
+def ordered_pages(store: PageStore):
+    bank_copy = store.roles.get('bank_copy')
+    rest = [n for n in store.page_numbers() if n != bank_copy]
+    return ([bank_copy] if bank_copy is not None else []) + rest
+
+# Sections whose content may continue on the next page ('<section>_1' on this
+# page, '<section>_2' on the next one)
+CONTINUED_SECTIONS = ['subject_of_fa', 'gurantor_details', 'property_details']
+
+# Classify a single page from its OCR text alone, using the bank's compiled
+# rule table. Returns the labels the page matches and the sections it leaves
+# pending for the next page
+def classify_page(bank_name: str, text: str):
+    classifier = get_page_classifier(bank_name)
+    if classifier is None:
+        return [], []
+    return classifier.classify(normalize_text(text))
+
+# Sequential merge over the ordered per-page results: prepend '<section>_2'
+# to the page after one that left a section pending. A page without a result
+# (failed OCR) resets the pending sections the same way the old loop did
+def resolve_labels(page_results):
+    resolved = []
+    pending = set()
+    for page_num, result in page_results:
+        if result is None:
+            pending.discard('subject_of_fa')
+            pending.add('gurantor_details')
+            resolved.append((page_num, None))
+            continue
+        labels, page_pending = result
+        # To check if the contents continue to next page
+        new_names = [f'{section}_2' for section in CONTINUED_SECTIONS if section in pending]
+        new_names += labels
+        pending = set(page_pending)
+        resolved.append((page_num, new_names))
+    return resolved
+
+# Filter page and label it in the page store using the cached OCR text
+def filter_and_rename_pages(bank_name: str, store: PageStore):
+    logger.info(f"Filtering pages for bank: {bank_name}")
+    page_nums = ordered_pages(store)
+
+    logger.debug(f"Total images to process: {len(page_nums)}")
+    page_results = []
+    for page_num in page_nums:
+        text = store.texts.get(page_num)
+        page_results.append((page_num, classify_page(bank_name, text) if text is not None else None))
+
+    for page_num, new_names in resolve_labels(page_results):
+        img_name = store.page_name(page_num)
+        if new_names is None:
+            logger.warning(f"Error processing {img_name}: no OCR text")
+            continue
+
+        # Label the page for each matching name
+        for new_name in new_names:
+            store.add_label(new_name, page_num)
+            logger.debug(f"Saved {img_name} as {new_name}")
 
+        if not new_names:
+            logger.debug(f"{img_name} does not match any criteria.")
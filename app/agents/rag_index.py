@@ -0,0 +1,122 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_community.retrievers import BM25Retriever
+from langchain_community.vectorstores import FAISS
+from app.utils.logger import logger
+from app.utils.result_cache import sha256_hex
+from app.agents.embeddings import get_embeddings
+
+# Same sentence split and breakpoint rule as
+# SemanticChunker(breakpoint_threshold_type="percentile", breakpoint_threshold_amount=0.85)
+SENTENCE_SPLIT_REGEX = r"(?<=[.?!])\s+"
+BREAKPOINT_PERCENTILE = float(os.getenv("RAG_BREAKPOINT_PERCENTILE", "0.85"))
+# Texts per encode call, and how many vectors the in-process cache keeps
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "50000"))
+# "mean" derives each chunk's vector from its sentence window vectors;
+# "embed" embeds every chunk once (through the cache)
+RAG_CHUNK_VECTORS = os.getenv("RAG_CHUNK_VECTORS", "mean")
+
+
+# LRU of embedding vectors keyed by sha256(model, text)
+class EmbeddingCache:
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.vectors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        with self.lock:
+            found = {}
+            for key in keys:
+                vector = self.vectors.get(key)
+                if vector is not None:
+                    self.vectors.move_to_end(key)
+                    found[key] = vector
+            return found
+
+    def set_many(self, items):
+        with self.lock:
+            for key, vector in items:
+                self.vectors[key] = vector
+                self.vectors.move_to_end(key)
+            while len(self.vectors) > self.max_entries:
+                self.vectors.popitem(last=False)
+
+
+embedding_cache = EmbeddingCache()
+
+
+# Embeddings front-end that looks every text up in the cache first and
+# encodes only the distinct misses, EMBEDDING_BATCH_SIZE texts at a time
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, cache: EmbeddingCache = embedding_cache,
+                 batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.batch_size = max(1, batch_size)
+        self.model_name = getattr(embeddings, "model_name", "")
+        self.hits = 0
+        self.misses = 0
+
+    def embed_array(self, texts) -> np.ndarray:
+        keys = [sha256_hex(self.model_name, text) for text in texts]
+        found = self.cache.get_many(set(keys))
+        missing = list(dict.fromkeys(text for key, text in zip(keys, texts) if key not in found))
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += len(missing)
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            vectors = np.asarray(self.embeddings.embed_documents(batch), dtype=np.float32)
+            new = [(sha256_hex(self.model_name, text), vector) for text, vector in zip(batch, vectors)]
+            self.cache.set_many(new)
+            found.update(new)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([found[key] for key in keys])
+
+    def embed_documents(self, texts):
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text):
+        return self.embed_array([text])[0].tolist()
+
+
+# Semantic chunking that keeps the sentence window vectors: each sentence is
+# embedded with its neighbours, a breakpoint goes wherever the cosine distance
+# to the next window is above the percentile, and the chunk vector is the mean
+# of its windows' vectors. Returns (chunks, chunk_vectors)
+def semantic_chunks(text: str, embeddings: CachedEmbeddings):
+    sentences = re.split(SENTENCE_SPLIT_REGEX, text)
+    if len(sentences) == 1:
+        return sentences, embeddings.embed_array(sentences)
+
+    windows = [" ".join(sentences[max(0, i - 1):i + 2]) for i in range(len(sentences))]
+    vectors = embeddings.embed_array(windows)
+    unit = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+    distances = 1.0 - np.sum(unit[:-1] * unit[1:], axis=1)
+    threshold = np.percentile(distances, BREAKPOINT_PERCENTILE)
+
+    bounds = [0] + [i + 1 for i, distance in enumerate(distances) if distance > threshold] + [len(sentences)]
+    chunks = [" ".join(sentences[start:end]) for start, end in zip(bounds, bounds[1:])]
+    if RAG_CHUNK_VECTORS == "embed":
+        return chunks, embeddings.embed_array(chunks)
+    return chunks, np.stack([vectors[start:end].mean(axis=0) for start, end in zip(bounds, bounds[1:])])
+
+
+# Dense (FAISS) and sparse (BM25) indexes over one shared chunk list, with
+# every sentence window embedded once
+class RagIndex:
+    def __init__(self, text: str, bm25_k: int = 12):
+        start_time = time.time()
+        embeddings = CachedEmbeddings(get_embeddings())
+        self.chunks, vectors = semantic_chunks(text, embeddings)
+        self.dense = FAISS.from_embeddings(list(zip(self.chunks, vectors.tolist())), embeddings)
+        self.sparse = BM25Retriever.from_texts(self.chunks, k=bm25_k)
+        logger.info(f"RAG index built in {time.time() - start_time:.2f} seconds: {len(self.chunks)} chunks, "
+                    f"{embeddings.misses} texts embedded, {embeddings.hits} from cache")
@@ -1,13 +1,26 @@
+import asyncio
 import base64
-import os
 import json
-import ollama
-from app.utils.logger import logger
+import time
+from app.agents import ollama_client
+from app.utils.logger import logger, log_payload
 from app.utils.file_utils import safe_json_parse, merge_dicts
-from app.agents.agent_config import get_bank_name, page_fields_mapping
+from app.agents.agent_config import page_fields_mapping, page_crop_regions, page_vlm_mode
+from app.agents.bank_resolver import detect_bank_name
 from app.agents.preprocess import filter_and_rename_pages
+from app.utils.page_store import PageStore
+from app.utils.result_cache import get_cache, sha256_hex
+from app.utils.image_prep import prepare_vlm_image
+from app.utils.metrics import OUTPUT_PARSES, PAGE_STEP_SECONDS, VLM_CALLS, VLM_PAYLOAD_BYTES, observe_cache, track_stage
+from app.agents.output_schema import fields_schema, schema_num_predict
+from app.agents.field_rules import RULE_EXTRACTION, RULE_MIN_CONFIDENCE, get_field_extractor
+from app.utils.tracing import span
+import os
 import re
 
+# Upper bound on pages sent in one batched ("section" / "document") VLM call
+VLM_MAX_IMAGES_PER_CALL = int(os.getenv("VLM_MAX_IMAGES_PER_CALL", "6"))
+
 # List of fields to extract
 fields = {
     "date": "",
@@ -29,7 +42,9 @@ fields = {
     "property_address": []
 }
 
-image_folder = "./pages/filtered"
+# Fields answered as lists; everything else is a single string
+list_fields = {name for name, default in fields.items() if isinstance(default, list)}
+
 model_name = "qwen2.5vl:7b"
 
 # Final schema to fill
@@ -56,103 +71,307 @@ system_prompt = (
 )
 
 
-def smart_scan():
-    per_page_results = []
+# num_images > 1 is a batched call: the pages of one section (or of the whole
+# document) are sent together and answered with one combined JSON object
+def build_user_prompt(fields_to_extract, num_images=1):
+    pages_note = ""
+    if num_images > 1:
+        pages_note = (f"\n    The {num_images} images are consecutive pages of the same document, in order. "
+                      "Read them together and return ONE JSON object covering all of them; "
+                      "a section may continue from one page to the next.")
+    return f"""
+    You are extracting structured data from a loan document.{pages_note}
+    Extract the following fields **and return them as a valid JSON object**. Each field should match its key.
+    Important Notes:
+    - Fields like 'guarantor_name', 'guarantor_nric', 'corporate_guarantor_name' and 'property_address' can have multiple values. Return them as arrays.
+    - If a field is missing, return an empty string for text, or an empty array for lists.
+    - Do NOT just return a list. Always return a JSON object with the correct field names.
+    Fields to extract:
+    {json.dumps(fields_to_extract, indent=2)}
+    Example valid output:
+    {{
+        "borrower_registration_number": "23932230923 (0931-B)",
+        "law_firm_name": "Abraham Ooi & Partners",
+        "law_firm_address": "28-b & 30-b, 2nd Floor, Jalan Ss 21/62, Damansara Utama Petaling Jaya, 47400 Petaling Jaya, Selangor",
+        "date": "6 November 2024",
+        "borrower_name": "Robert Dass",
+        "borrower_address": "BL 13A-05, Zeva Residence, Persiaran Pinggiran Putra, Pinggiran Putra Permai, 43300 Seri Kembangan, Selangor, MALAYSIA",
+        "bank_name": "PUBLIC BANK BERHAD",
+        "bank_address": "62, 64 & 66, Jalan Tapah, Off Jalan Goh Hock Huat, 41400 Klang, Selangor.",
+        "bank_registration_number": "196501000672 (6463-H)",
+        "subject_of_FA": [
+            "HL/HOME10 (Redraw) (PromoUC) - RM40, 000.00",
+            "MRTA (inclusive of PB Term CI) - RM1,000,620.00"
+        ],
+        "total_loan_amount": "RM1,100,620.00",
+        "property_title": "Individual Title ABC 0000, Lot 2, Jalan BSC 6A/2 Precinct 6A1 Type B2 Jardin Residences, 45000 Kuala Selangor",
+        "property_address": [
+            "49, Jalan BSC 6A/2 Precinct 6A1 Type B2 Jardin Residences, 45000 Kuala Selangor"
+        ],
+        "guarantor_name": ["Ali bin Abu", "Alex Lim"],
+        "guarantor_nric": ["038889384756", "9983484756431"],
+        "corporate_guarantor_name": ["ABC Sdn Bhd", "DEF Sdn Bhd"],
+        "corporate_guarantor_registration_number": ["20394456621", "30495563313"],
+    }}
+    Only return the JSON. Do not explain.
+    """
 
-    bank_name = get_bank_name()
 
-    filter_and_rename_pages(bank_name)
+# Rasterize (if needed) and prepare a labelled page for the VLM, off the event loop
+def load_vlm_image(store: PageStore, img_name: str, crop=None):
+    image_bytes = store.get_label(img_name)
+    if image_bytes is None:
+        return None
+    return prepare_vlm_image(image_bytes, crop=crop)
 
-    page_fields_map = page_fields_mapping(bank_name)
 
-    if page_fields_map is None:
-        logger.error(f"No page mapping found for bank: '{bank_name}'")
-        return {}
+# Send one labelled page, or a group of pages batched into one multi-image
+# call, to the VLM and parse its JSON answer. crops has one entry per page
+async def extract_pages(store: PageStore, img_names, fields_to_extract, crops=None):
+    crops = crops or [None] * len(img_names)
+    # Labels on repeated pages (same page and crop) send their image once
+    unique = {}
+    for img_name, crop in zip(img_names, crops):
+        unique.setdefault((store.canonical_page(store.labels.get(img_name)), json.dumps(crop)), (img_name, crop))
+    if len(unique) < len(img_names):
+        img_names, crops = [list(values) for values in zip(*unique.values())]
+    group_name = "+".join(img_names)
+    logger.info(f"Processing image: {group_name}")
+    images = await asyncio.gather(*[asyncio.to_thread(load_vlm_image, store, img_name, crop)
+                                    for img_name, crop in zip(img_names, crops)])
+    for img_name, image_bytes in zip(img_names, images):
+        if image_bytes is None:
+            logger.warning(f"Image not found: {img_name}")
+    images = [image_bytes for image_bytes in images if image_bytes is not None]
+    if not images:
+        return None
+    images_b64 = [base64.b64encode(image_bytes).decode("utf-8") for image_bytes in images]
+    bytes_sent = sum(len(image_bytes) for image_bytes in images)
 
-    images = [f for f in os.listdir(image_folder) if f.lower().endswith('.png')]
-    images.sort(key=lambda x: int(re.search(r'_(\d+)', x).group(1)) if re.search(r'_(\d+)', x) else 0)
+    user_prompt = build_user_prompt(fields_to_extract, num_images=len(images))
+    # The answer is constrained to an object with exactly these fields, and
+    # capped at what that object can hold
+    schema = fields_schema(fields_to_extract, list_fields)
+    options = {"temperature": 0.3, "num_predict": schema_num_predict(schema)}
 
-    for key in page_fields_map:
-        base_key = key.replace('.png', '')
-        pattern = re.compile(rf'^{re.escape(base_key)}(?:_(\d+))?\.png$')
-        matching_files = sorted([f for f in images if pattern.match(f)],
-                                key=lambda x: int(pattern.match(x).group(1) or 0))
-        
-        if not matching_files:
-            logger.info(f"No files found for key: {key}")
-            continue
-        
-        fields_to_extract = page_fields_map[key]
-        for img_name in matching_files:
-            logger.info(f"Processing image: {img_name}")
-            image_path = os.path.join(image_folder, img_name)
-            if not os.path.exists(image_path):
-                logger.warning(f"Image not found: {image_path}")
-                continue
-            with open(image_path, "rb") as f:
-                image_b64 = base64.b64encode(f.read()).decode("utf-8")
-
-            user_prompt = f"""
-            You are extracting structured data from a loan document.
-            Extract the following fields **and return them as a valid JSON object**. Each field should match its key.
-            Important Notes:
-            - Fields like 'guarantor_name', 'guarantor_nric', 'corporate_guarantor_name' and 'property_address' can have multiple values. Return them as arrays.
-            - If a field is missing, return an empty string for text, or an empty array for lists.
-            - Do NOT just return a list. Always return a JSON object with the correct field names.
-            Fields to extract:
-            {json.dumps(fields_to_extract, indent=2)}
-            Example valid output:
-            {{
-                "borrower_registration_number": "23932230923 (0931-B)",
-                "law_firm_name": "Abraham Ooi & Partners",
-                "law_firm_address": "28-b & 30-b, 2nd Floor, Jalan Ss 21/62, Damansara Utama Petaling Jaya, 47400 Petaling Jaya, Selangor",
-                "date": "6 November 2024",
-                "borrower_name": "Robert Dass",
-                "borrower_address": "BL 13A-05, Zeva Residence, Persiaran Pinggiran Putra, Pinggiran Putra Permai, 43300 Seri Kembangan, Selangor, MALAYSIA",
-                "bank_name": "PUBLIC BANK BERHAD",
-                "bank_address": "62, 64 & 66, Jalan Tapah, Off Jalan Goh Hock Huat, 41400 Klang, Selangor.",
-                "bank_registration_number": "196501000672 (6463-H)",
-                "subject_of_FA": [
-                    "HL/HOME10 (Redraw) (PromoUC) - RM40, 000.00",
-                    "MRTA (inclusive of PB Term CI) - RM1,000,620.00"
-                ],
-                "total_loan_amount": "RM1,100,620.00",
-                "property_title": "Individual Title ABC 0000, Lot 2, Jalan BSC 6A/2 Precinct 6A1 Type B2 Jardin Residences, 45000 Kuala Selangor",
-                "property_address": [
-                    "49, Jalan BSC 6A/2 Precinct 6A1 Type B2 Jardin Residences, 45000 Kuala Selangor"
-                ],
-                "guarantor_name": ["Ali bin Abu", "Alex Lim"],
-                "guarantor_nric": ["038889384756", "9983484756431"],
-                "corporate_guarantor_name": ["ABC Sdn Bhd", "DEF Sdn Bhd"],
-                "corporate_guarantor_registration_number": ["20394456621", "30495563313"],
-            }}
-            Only return the JSON. Do not explain.
-            """
+    # Answers are cached by images + prompt, so identical pages in a
+    # partially changed document don't go back to the model
+    cache = get_cache("vlm_pages")
+    cache_key = sha256_hex(model_name, system_prompt, user_prompt, json.dumps(options), json.dumps(schema),
+                           *images_b64)
+    if cache is not None:
+        cached = await cache.aget(cache_key)
+        observe_cache("vlm_pages", cached is not None)
+        if cached is not None:
+            logger.info(f"Using cached VLM response for {group_name}")
+            VLM_CALLS.labels("extract", "cached").inc()
+            store.vlm_calls.append({"page": group_name, "purpose": "extract", "images": len(images),
+                                    "bytes_sent": 0, "latency_ms": 0.0, "cached": True})
+            return cached or None
+
+    try:
+        start_time = time.perf_counter()
+        VLM_PAYLOAD_BYTES.labels("extract").observe(bytes_sent)
+        with span("vlm.extract", pages=group_name, images=len(images), bytes_sent=bytes_sent):
             try:
-                response = ollama.chat(
+                response = await ollama_client.chat(
                     model=model_name,
                     messages=[
                         {"role": "system", "content": system_prompt},
                         {
                             "role": "user",
                             "content": user_prompt,
-                            "images": [image_b64]
+                            "images": images_b64
                         }
                     ],
-                    options={"temperature": 0.3, "max_tokens": 2048}
+                    format=schema,
+                    options=options
                 )
-                raw_output = response.get("message", {}).get("content", "")
-                logger.info(f"Raw LLM response from {img_name}: {raw_output}")
-                if not raw_output.strip() or "nothing" in raw_output.lower() or "not found" in raw_output.lower():
-                    logger.info(f"No useful data extracted from {img_name}, skipping.")
-                    continue
-                parsed = safe_json_parse(raw_output)
-                per_page_results.append(parsed)
-            except json.JSONDecodeError:
-                logger.warning(f"Failed to parse JSON from {img_name}")
-            except Exception as e:
-                logger.error(f"Error extracting from {img_name}: {e}")
-
-    print(per_page_results)
+            except Exception:
+                VLM_CALLS.labels("extract", "error").inc()
+                raise
+        VLM_CALLS.labels("extract", "ok").inc()
+        PAGE_STEP_SECONDS.labels("vlm").observe(time.perf_counter() - start_time)
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        store.vlm_calls.append({"page": group_name, "purpose": "extract", "images": len(images),
+                                "bytes_sent": bytes_sent, "latency_ms": round(latency_ms, 1), "cached": False})
+        logger.info(f"VLM call for {group_name}: {len(images)} image(s), {bytes_sent} bytes sent, "
+                    f"{latency_ms:.0f} ms")
+        raw_output = response.get("message", {}).get("content", "")
+        log_payload("Raw LLM response", raw_output, group=group_name)
+        if not raw_output.strip() or "nothing" in raw_output.lower() or "not found" in raw_output.lower():
+            logger.info(f"No useful data extracted from {group_name}, skipping.")
+            if cache is not None:
+                await cache.aset(cache_key, {})
+            return None
+        parsed = safe_json_parse(raw_output)
+        OUTPUT_PARSES.labels("extract", "ok" if isinstance(parsed, dict) else "failed").inc()
+        if not isinstance(parsed, dict):
+            logger.warning(f"Failed to parse JSON from {group_name}")
+            store.vlm_calls[-1]["error"] = "unparseable answer"
+            return None
+        if cache is not None:
+            await cache.aset(cache_key, parsed)
+        return parsed
+    except Exception as e:
+        logger.error(f"Error extracting from {group_name}: {e}")
+        # Failed calls are recorded so the document result isn't cached
+        store.vlm_calls.append({"page": group_name, "purpose": "extract", "images": len(images),
+                                "bytes_sent": bytes_sent, "cached": False, "error": f"{type(e).__name__}: {e}"})
+    return None
+
+
+# Group the labelled pages into VLM calls, as (page names, fields, crops):
+#   per_page - one call per page
+#   section  - one call per page_fields_map section ('subject_of_fa_1' and
+#              'subject_of_fa_2' go together)
+#   document - one call for every mapped page, with the combined field list
+# Groups are split to at most VLM_MAX_IMAGES_PER_CALL pages
+def build_vlm_groups(page_fields_map, crop_regions, images, vlm_mode="per_page"):
+    sections = []
+    for key, fields_to_extract in page_fields_map.items():
+        pattern = re.compile(rf'^{re.escape(key)}(?:_(\d+))?$')
+        matching_files = sorted([f for f in images if pattern.match(f)],
+                                key=lambda x: int(pattern.match(x).group(1) or 0))
+
+        if not matching_files:
+            logger.info(f"No files found for key: {key}")
+            continue
+        sections.append((matching_files, fields_to_extract, [crop_regions.get(key)] * len(matching_files)))
+
+    if vlm_mode == "per_page":
+        groups = [([img_name], fields_to_extract, [crop])
+                  for img_names, fields_to_extract, crops in sections
+                  for img_name, crop in zip(img_names, crops)]
+    elif vlm_mode == "document" and sections:
+        combined_fields = []
+        for _, fields_to_extract, _ in sections:
+            combined_fields += [field for field in fields_to_extract if field not in combined_fields]
+        groups = [([img_name for img_names, _, _ in sections for img_name in img_names],
+                   combined_fields,
+                   [crop for _, _, crops in sections for crop in crops])]
+    else:
+        groups = sections
+
+    size = max(1, VLM_MAX_IMAGES_PER_CALL)
+    return [(img_names[i:i + size], fields_to_extract, crops[i:i + size])
+            for img_names, fields_to_extract, crops in groups
+            for i in range(0, len(img_names), size)]
+
+
+# CPU side of a scan: resolve the bank and label the pages. Returns the bank
+# name. The caller reports the "bank_detection" stage before it
+async def classify_document(store: PageStore, on_stage=None) -> str:
+    on_stage = on_stage or (lambda stage, **details: None)
+
+    with track_stage("bank_detection"):
+        bank_name = await detect_bank_name(store)
+
+    on_stage("classifying", bank_name=bank_name)
+    with track_stage("classifying", bank_name=bank_name):
+        await asyncio.to_thread(filter_and_rename_pages, bank_name, store)
+    return bank_name
+
+
+# Run the field rules over the text of a group's pages. Returns the values
+# scored at least RULE_MIN_CONFIDENCE and the lower-scored ones, as
+# {field: value} each, and records every value in store.rule_fields.
+# OCR text can misread a digit, so only groups read entirely from the native
+# text layer fill fields; values from OCR'd pages are VLM fallbacks
+def apply_field_rules(store: PageStore, bank_name: str, img_names, fields_to_extract):
+    page_nums = [store.labels.get(name) for name in img_names]
+    texts = [store.texts.get(page_num) for page_num in page_nums]
+    native = all(store.sources.get(page_num) == "text" for page_num in page_nums)
+    found = get_field_extractor(bank_name).extract(texts, fields_to_extract)
+    confident = {}
+    low = {}
+    for field, (value, confidence) in found.items():
+        used = native and confidence >= RULE_MIN_CONFIDENCE
+        (confident if used else low)[field] = value
+        store.rule_fields.append({"field": field, "value": value, "confidence": round(confidence, 2),
+                                  "pages": "+".join(img_names), "used": "filled" if used else "fallback"})
+    return confident, low
+
+
+# VLM side of a scan: extract the mapped fields from the labelled pages
+async def extract_fields(store: PageStore, bank_name: str, on_stage=None) -> dict:
+    on_stage = on_stage or (lambda stage, **details: None)
+
+    page_fields_map = page_fields_mapping(bank_name)
+    crop_regions = page_crop_regions(bank_name)
+
+    if page_fields_map is None:
+        logger.error(f"No page mapping found for bank: '{bank_name}'")
+        return {}
+
+    images = list(store.labels)
+    images.sort(key=lambda x: int(re.search(r'_(\d+)', x).group(1)) if re.search(r'_(\d+)', x) else 0)
+
+    # One VLM call per group of pages (see build_vlm_groups); all groups run
+    # concurrently (bounded by the client's concurrency limit) and gather keeps
+    # the mapping order, so merge_dicts sees the results in the same order as
+    # a sequential run
+    vlm_mode = page_vlm_mode(bank_name)
+    groups = build_vlm_groups(page_fields_map, crop_regions, images, vlm_mode)
+    logger.info(f"VLM mode '{vlm_mode}': {len(groups)} call(s) for {len(images)} page(s)")
+    # Pattern-shaped fields are read from the pages' text first; confidently
+    # filled ones leave the call, and a call with nothing left is skipped.
+    # Groups that would send the same pages (repeated pages carrying the same
+    # labels), fields and crops share one call. ordered keeps each group's
+    # rule values and call (an index into tasks) in mapping order
+    ordered = []
+    fallbacks = {}
+    seen = set()
+    tasks = []
+    for img_names, fields_to_extract, crops in groups:
+        if RULE_EXTRACTION:
+            confident, low = apply_field_rules(store, bank_name, img_names, fields_to_extract)
+            if confident:
+                ordered.append(confident)
+            for field, value in low.items():
+                fallbacks.setdefault(field, value)
+            fields_to_extract = [field for field in fields_to_extract if field not in confident]
+            if not fields_to_extract:
+                store.skipped_vlm_calls += 1
+                logger.info(f"Skipping VLM call for {'+'.join(img_names)}: every field filled by the rules")
+                continue
+        key = json.dumps([[store.canonical_page(store.labels.get(name)) for name in img_names],
+                          fields_to_extract, crops])
+        if key in seen:
+            store.shared_vlm_calls += 1
+            continue
+        seen.add(key)
+        ordered.append(len(tasks))
+        tasks.append(extract_pages(store, img_names, fields_to_extract, crops))
+
+    done = 0
+    on_stage("extracting", done=done, total=len(tasks))
+
+    async def tracked(task):
+        nonlocal done
+        result = await task
+        done += 1
+        on_stage("extracting", done=done, total=len(tasks))
+        return result
+
+    with track_stage("extracting", calls=len(tasks), vlm_mode=vlm_mode):
+        results = await asyncio.gather(*[tracked(task) for task in tasks])
+    per_page_results = [results[item] if isinstance(item, int) else item for item in ordered]
+    per_page_results = [result for result in per_page_results if isinstance(result, dict)]
+
+    logger.debug(f"Per-call results: {per_page_results}")
     final_result = merge_dicts(per_page_results)
+    # Low-confidence rule values only fill what the VLM left empty
+    for field, value in fallbacks.items():
+        if not final_result.get(field):
+            final_result[field] = value
     return final_result
+
+
+# on_stage(stage, **details) is called as the scan moves through bank detection,
+# page classification and per-page extraction
+async def smart_scan(store: PageStore, on_stage=None):
+    if on_stage is not None:
+        on_stage("bank_detection")
+    bank_name = await classify_document(store, on_stage=on_stage)
+    return await extract_fields(store, bank_name, on_stage=on_stage)
@@ -2,23 +2,93 @@
 # Handles text-based and image-based PDFs, processes them, and sends to LLM for Markdown output
 
 import uvicorn
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import List
 from app.utils.logger import logger
+from app.utils.jobs import JobQueue, QueueFullError
+from app.utils.file_utils import spool_upload, is_zip_upload, unpack_zip_pdfs
+from app.utils.model_registry import registry, current_rss_mb
+from app.utils.plugins import PipelineDisabledError, pipelines
+from app.agents import ollama_client
+from app.utils.metrics import JOB_QUEUE_DEPTH, REQUEST_SECONDS, render_metrics
+from app.utils.tracing import current_trace, start_trace
 from datetime import datetime
-import shutil
+import asyncio
 import json
+import os
+import time
 
-# Import Agents
-from app.agents.llm_extract import extract_with_rag
-from app.agents.preprocess import extract_text_ocr, pdf_to_images, filter_bank_copy
-from app.agents.vlm_agent import smart_scan
+# Pipelines (and their heavy imports) are loaded through the plugin registry
+# on first use, or at startup with PRELOAD_MODELS, and only when enabled in
+# ENABLED_PIPELINES
+async def load_pipeline(name: str):
+    module = pipelines.modules.get(name)
+    if module is not None:
+        return module
+    # First use imports the module; keep that off the event loop
+    return await asyncio.to_thread(pipelines.get, name)
 
-app = FastAPI()
+def pipeline_disabled(e: PipelineDisabledError):
+    return JSONResponse(status_code=404, content={"error": str(e)})
+
+# Background extraction jobs for POST /jobs; the spooled upload is removed
+# once the job finishes
+async def run_job(payload: dict, on_stage):
+    try:
+        vlm = await load_pipeline("vlm")
+        return await vlm.run_extraction(payload["pdf_path"], payload["filename"], on_stage=on_stage,
+                                        file_hash=payload["file_hash"])
+    finally:
+        os.unlink(payload["pdf_path"])
+
+# Spooled upload of a job dropped at shutdown
+def discard_job(payload: dict):
+    os.unlink(payload["pdf_path"])
+
+job_queue = JobQueue(run_job, discard=discard_job)
+JOB_QUEUE_DEPTH.set_function(job_queue.depth)
+
+# Import the enabled pipelines, load their registered models (embeddings) and
+# warm the Ollama models on every backend at startup instead of on the first
+# request
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "1") == "1"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if PRELOAD_MODELS:
+        await asyncio.to_thread(pipelines.load_enabled)
+        await asyncio.to_thread(registry.load_all)
+    await ollama_client.start(warm=PRELOAD_MODELS)
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await ollama_client.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+# Every request gets a trace; its id and the top-level stage timings go back
+# in the X-Trace-Id and Server-Timing headers
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    start_time = time.perf_counter()
+    with start_trace() as trace:
+        response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(getattr(route, "path", "unmatched"), str(response.status_code)).observe(
+        time.perf_counter() - start_time)
+    response.headers["X-Trace-Id"] = trace.trace_id
+    server_timing = trace.server_timing()
+    if server_timing:
+        response.headers["Server-Timing"] = server_timing
+    return response
 
 # Extract Markdown from PDF using RAG
 # @app.post("/extract")
 # async def extract_markdown_from_pdf(file: UploadFile = File(...)):
+#     from app.agents.preprocess import extract_text_ocr
+#     rag = await load_pipeline("rag")
 #     file_bytes = await file.read()
 #     start_time = datetime.now()
 #     logger.info(f"Started processing file: {file.filename}")
@@ -48,7 +118,7 @@ app = FastAPI()
 #         query = "Extract " + ", ".join(fields)
 #         targeted_variables = ", ".join(fields)
 
-#         markdown = extract_with_rag(extracted_text, query, targeted_variables)
+#         markdown = rag.extract_with_rag(extracted_text, query, targeted_variables)
 #         logger.info(f"Markdown conversion successful for: {file.filename}")
 
 #         end_time = datetime.now()
@@ -61,69 +131,135 @@ app = FastAPI()
 #         logger.error(f"Error processing file {file.filename}: {e}")
 #         return JSONResponse(status_code=500, content={"error": str(e)})
 
-# Extract Markdown from PDF using VLM
+# Extract Markdown from PDF using VLM. With ?debug=true the result carries the
+# request's span breakdown under "trace"
 @app.post("/extract-vlm")
-async def extract_markdown_VLM(file: UploadFile = File(...)):
-    image_path='./pages'
-    file_bytes = await file.read()
+async def extract_markdown_VLM(file: UploadFile = File(...), debug: bool = False):
+    try:
+        vlm = await load_pipeline("vlm")
+    except PipelineDisabledError as e:
+        return pipeline_disabled(e)
+    # Spool the upload to disk instead of holding it in memory
+    pdf_path, file_hash = await spool_upload(file)
     start_time = datetime.now()
     logger.info(f"Started processing file: {file.filename}")
     try:
-        # Convert PDFs to Images
-        num_images = pdf_to_images(file_bytes, image_path)
-        logger.info(f"Number of Images Converted: {num_images}")
-
-        # Filter bank copy
-        filter_bank_copy(image_path)
-
-        # VLM Processing
-        extracted_info = smart_scan()
-
-        #  Delete image after processing
-        try:
-            shutil.rmtree('./pages')
-            logger.info(f"Deleted of Images Path: {image_path}")
-        except Exception as e:
-            print(f"Error deleting {image_path}: {e}")
-
+        formatted_info = await vlm.run_extraction(pdf_path, file.filename, file_hash=file_hash)
 
         end_time = datetime.now()
         elapsed_time = (end_time - start_time).total_seconds()
         logger.info(f"Completed processing {file.filename} in {elapsed_time:.2f} seconds")
 
-        # Format the extracted information
-        formatted_info = {
-            "ref_no": extracted_info.get("ref_no", ""),
-            "date": extracted_info.get("date", ""),
-            "open_date": extracted_info.get("open_date", ""),
-            "close_date": extracted_info.get("close_date", ""),
-            "borrower_name": extracted_info.get("borrower_name", ""),
-            "borrower_registration_number": extracted_info.get("borrower_registration_number", ""),
-            "borrower_address": extracted_info.get("borrower_address", ""),
-            "bank_name": extracted_info.get("bank_name", ""),
-            "bank_address": extracted_info.get("bank_address", ""),
-            "bank_registration_number": extracted_info.get("bank_registration_number", ""),
-            "subject_matter": extracted_info.get("subject_of_FA", ""),
-            "total_loan_amount": extracted_info.get("total_loan_amount", ""),
-            "gurantor_name": extracted_info.get("gurantor_name", ""),
-            "gurantor_nric": extracted_info.get("gurantor_nric", ""),
-            "coporate_gurantor_name": extracted_info.get("coporate_gurantor_name", ""),
-            "coporate_gurantor_registration_number": extracted_info.get("coporate_gurantor_registration_number", ""),
-            "law_firm_name": extracted_info.get("law_firm_name", ""),
-            "law_firm_address": extracted_info.get("law_firm_address", ""),
-            "property_description": extracted_info.get("property_title", ""),
-            "property_address": extracted_info.get("property_address", ""),
-            "property_price": extracted_info.get("property_price", "")
-        }
-
         with open("structured_fields.json", "w") as f:
             json.dump(formatted_info, f, indent=2)
         logger.info("Final merged result saved to structured_fields.json")
+        # A copy: formatted_info may be the cached result
+        if debug and current_trace() is not None:
+            formatted_info = {**formatted_info, "trace": current_trace().to_dict()}
         return json.dumps(formatted_info, indent=2)
 
     except Exception as e:
         logger.error(f"Error processing file {file.filename}: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
+    finally:
+        os.unlink(pdf_path)
+
+# Extract many PDFs in one request: several PDF files and/or zips of PDFs.
+# Documents are scheduled across the CPU (render/OCR/classify) and VLM stages
+# together, and each result is streamed as one NDJSON line as soon as its
+# document finishes, so the lines arrive in completion order (see "index")
+@app.post("/extract-batch")
+async def extract_batch(files: List[UploadFile] = File(...)):
+    try:
+        vlm = await load_pipeline("vlm")
+    except PipelineDisabledError as e:
+        return pipeline_disabled(e)
+    documents = []
+    try:
+        for upload in files:
+            path, file_hash = await spool_upload(upload)
+            if not is_zip_upload(upload.filename, upload.content_type or ""):
+                documents.append({"pdf_path": path, "filename": upload.filename, "file_hash": file_hash})
+                continue
+            try:
+                unpacked = await asyncio.to_thread(unpack_zip_pdfs, path)
+            finally:
+                os.unlink(path)
+            documents += [{"pdf_path": pdf_path, "filename": name, "file_hash": pdf_hash}
+                          for name, pdf_path, pdf_hash in unpacked]
+    except Exception as e:
+        for document in documents:
+            os.unlink(document["pdf_path"])
+        logger.error(f"Error reading batch upload: {e}")
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    logger.info(f"Started batch of {len(documents)} documents")
+
+    async def stream_results():
+        start_time = datetime.now()
+        remaining = {document["pdf_path"] for document in documents}
+        try:
+            async for index, document, result, error in vlm.run_batch(documents):
+                os.unlink(document["pdf_path"])
+                remaining.discard(document["pdf_path"])
+                line = {"index": index, "filename": document["filename"]}
+                if error is None:
+                    line.update(status="done", result=result)
+                else:
+                    line.update(status="failed", error=str(error))
+                yield json.dumps(line) + "\n"
+        finally:
+            # Client disconnected before the batch finished
+            for path in remaining:
+                os.unlink(path)
+        elapsed_time = (datetime.now() - start_time).total_seconds()
+        logger.info(f"Completed batch of {len(documents)} documents in {elapsed_time:.2f} seconds")
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+# Submit a PDF for background extraction; poll GET /jobs/{job_id} for the result
+# (and, with ?debug=true, its span breakdown)
+@app.post("/jobs", status_code=202)
+async def submit_job(file: UploadFile = File(...), debug: bool = False):
+    if not pipelines.is_enabled("vlm"):
+        return pipeline_disabled(PipelineDisabledError("Pipeline 'vlm' is not enabled on this worker"))
+    # Refuse before spooling when the queue is full
+    try:
+        job_queue.reserve()
+    except QueueFullError as e:
+        logger.warning(f"Rejected job for {file.filename}: {e}")
+        return JSONResponse(status_code=429, content={"error": str(e)})
+    try:
+        pdf_path, file_hash = await spool_upload(file)
+    except BaseException:
+        # The spool failed or the request was cancelled: give the slot back
+        job_queue.release()
+        raise
+    job_id = job_queue.submit({"pdf_path": pdf_path, "filename": file.filename, "file_hash": file_hash,
+                               "debug": debug},
+                              reserved=True, filename=file.filename)
+    logger.info(f"Queued job {job_id} for file: {file.filename}")
+    return {"job_id": job_id, "status": "queued"}
+
+# Current stage of a job, plus the structured fields once it is done
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job
+
+# Liveness plus pipeline / model load state and time, Ollama backend health
+# and process memory
+@app.get("/health")
+async def health():
+    return {"status": "ok", "rss_mb": current_rss_mb(), "job_queue_depth": job_queue.depth(),
+            "pipelines": pipelines.status(), "models": registry.status(), "ollama": ollama_client.status()}
+
+# Prometheus scrape endpoint
+@app.get("/metrics")
+async def metrics():
+    data, content_type = render_metrics()
+    return Response(content=data, media_type=content_type)
 
 if __name__ == '__main__':
     uvicorn.run("app.main:app", host="0.0.0.0", port=8080, reload=True, log_level="debug")
\ No newline at end of file
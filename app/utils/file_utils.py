@@ -1,6 +1,20 @@
 import pymupdf
+import hashlib
 import json
+import os
 import re
+import tempfile
+import zipfile
+from app.utils.logger import logger, log_payload
+
+# Uploads are copied to disk in chunks of this size instead of read() into memory
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Where spooled uploads live (defaults to the system temp dir)
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+# Limits for zip uploads to the batch endpoint: number of PDFs and their
+# total uncompressed size
+ZIP_MAX_DOCUMENTS = int(os.getenv("ZIP_MAX_DOCUMENTS", "200"))
+ZIP_MAX_BYTES = int(os.getenv("ZIP_MAX_BYTES", str(2 * 1024**3)))
 
 def parse_and_sanitize(content):
     try:
@@ -17,8 +31,8 @@ def safe_json_parse(raw_content):
         # Step 2: Try parsing
         return json.loads(clean)
     except json.JSONDecodeError as e:
-        print("JSON parsing failed:", e)
-        print("Original content:", raw_content[:500])
+        logger.warning(f"JSON parsing failed: {e}")
+        log_payload("Unparseable model output", raw_content)
         return None
 
 def merge_dicts(list_of_dicts):
@@ -52,3 +66,60 @@ def merge_dicts(list_of_dicts):
 
     return merged
 
+
+# Stream an UploadFile to a temp file, hashing it on the way.
+# Returns (path, sha256 hex digest); the caller deletes the file
+async def spool_upload(upload) -> tuple:
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(suffix=".pdf", dir=UPLOAD_SPOOL_DIR, delete=False) as f:
+        try:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+        except Exception:
+            f.close()
+            os.unlink(f.name)
+            raise
+    return f.name, digest.hexdigest()
+
+# SHA-256 of a file on disk, read in chunks
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_zip_upload(filename: str, content_type: str = "") -> bool:
+    return (filename or "").lower().endswith(".zip") or content_type in ("application/zip",
+                                                                          "application/x-zip-compressed")
+
+# Unpack the PDFs in a spooled zip into their own spool files.
+# Returns [(name, path, sha256)]; the caller deletes the files
+def unpack_zip_pdfs(zip_path: str) -> list:
+    documents = []
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            members = [m for m in archive.infolist() if not m.is_dir() and m.filename.lower().endswith(".pdf")
+                       and not m.filename.startswith("__MACOSX/")]
+            if len(members) > ZIP_MAX_DOCUMENTS:
+                raise ValueError(f"Zip holds {len(members)} PDFs, the limit is {ZIP_MAX_DOCUMENTS}")
+            if sum(m.file_size for m in members) > ZIP_MAX_BYTES:
+                raise ValueError(f"Zip contents exceed {ZIP_MAX_BYTES} bytes")
+            for member in members:
+                digest = hashlib.sha256()
+                with archive.open(member) as src, \
+                        tempfile.NamedTemporaryFile(suffix=".pdf", dir=UPLOAD_SPOOL_DIR, delete=False) as dst:
+                    documents.append((os.path.basename(member.filename), dst.name, None))
+                    for chunk in iter(lambda: src.read(UPLOAD_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        dst.write(chunk)
+                documents[-1] = documents[-1][:2] + (digest.hexdigest(),)
+    except Exception:
+        for _, path, _ in documents:
+            os.unlink(path)
+        raise
+    return documents
@@ -0,0 +1,40 @@
+import io
+import os
+from PIL import Image
+
+# Images sent to the VLM are downsized so their long edge is at most
+# VLM_MAX_EDGE pixels (0 keeps the rendered size), optionally converted to
+# grayscale, and re-encoded as jpeg / webp / png at VLM_IMAGE_QUALITY
+VLM_MAX_EDGE = int(os.getenv("VLM_MAX_EDGE", "1600"))
+VLM_IMAGE_FORMAT = os.getenv("VLM_IMAGE_FORMAT", "jpeg").lower()
+VLM_IMAGE_QUALITY = int(os.getenv("VLM_IMAGE_QUALITY", "85"))
+VLM_GRAYSCALE = os.getenv("VLM_GRAYSCALE", "1") == "1"
+
+PIL_FORMATS = {"jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP", "png": "PNG"}
+
+
+# Settings that change what the VLM sees, for cache keys
+def image_prep_settings() -> dict:
+    return {"max_edge": VLM_MAX_EDGE, "format": VLM_IMAGE_FORMAT,
+            "quality": VLM_IMAGE_QUALITY, "grayscale": VLM_GRAYSCALE}
+
+
+# Crop / downsize / re-encode a rendered page for the VLM.
+# crop is an optional (x0, y0, x1, y1) box in fractions of the page size
+def prepare_vlm_image(image_bytes: bytes, crop=None) -> bytes:
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        if crop:
+            x0, y0, x1, y1 = crop
+            width, height = image.size
+            image = image.crop((int(x0 * width), int(y0 * height), int(x1 * width), int(y1 * height)))
+        image = image.convert("L" if VLM_GRAYSCALE else "RGB")
+        if VLM_MAX_EDGE and max(image.size) > VLM_MAX_EDGE:
+            image.thumbnail((VLM_MAX_EDGE, VLM_MAX_EDGE), Image.LANCZOS)
+
+        out = io.BytesIO()
+        fmt = PIL_FORMATS.get(VLM_IMAGE_FORMAT, "JPEG")
+        if fmt == "PNG":
+            image.save(out, format=fmt, optimize=True)
+        else:
+            image.save(out, format=fmt, quality=VLM_IMAGE_QUALITY)
+        return out.getvalue()
@@ -0,0 +1,162 @@
+import asyncio
+import os
+from abc import ABC, abstractmethod
+import threading
+import time
+import uuid
+from app.utils.logger import logger
+from app.utils.tracing import start_trace
+
+# Number of jobs processed at the same time, and how many may wait in the queue
+# before POST /jobs starts answering 429
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "20"))
+# Finished jobs are kept this many seconds for polling
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+
+
+class QueueFullError(Exception):
+    pass
+
+
+# Pluggable job/result storage. Implementations keep one record (a dict) per job
+class ResultStore(ABC):
+    @abstractmethod
+    def create(self, job_id: str, record: dict):
+        pass
+
+    @abstractmethod
+    def update(self, job_id: str, **fields):
+        pass
+
+    @abstractmethod
+    def get(self, job_id: str):
+        pass
+
+
+class InMemoryResultStore(ResultStore):
+    def __init__(self, ttl: int = JOB_RESULT_TTL):
+        self.ttl = ttl
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def create(self, job_id: str, record: dict):
+        with self.lock:
+            self._prune()
+            self.records[job_id] = record
+
+    def update(self, job_id: str, **fields):
+        with self.lock:
+            record = self.records.get(job_id)
+            if record is not None:
+                record.update(fields, updated_at=time.time())
+
+    def get(self, job_id: str):
+        with self.lock:
+            record = self.records.get(job_id)
+            return dict(record) if record is not None else None
+
+    # Drop finished jobs older than the TTL
+    def _prune(self):
+        now = time.time()
+        expired = [job_id for job_id, record in self.records.items()
+                   if record["status"] in ("done", "failed") and now - record["updated_at"] > self.ttl]
+        for job_id in expired:
+            del self.records[job_id]
+
+
+# Bounded queue of extraction jobs served by a fixed number of asyncio workers.
+# handler(payload, on_stage) is awaited for each job and its return value is
+# stored as the job result. Each job runs in its own trace; the span breakdown
+# is stored with the job when the payload has "debug" set. discard(payload) is
+# called for jobs still waiting at shutdown, to release what they hold
+class JobQueue:
+    def __init__(self, handler, store: ResultStore = None, workers: int = JOB_WORKERS,
+                 max_size: int = JOB_QUEUE_SIZE, discard=None):
+        self.handler = handler
+        self.discard = discard
+        self.store = store or InMemoryResultStore()
+        self.workers = workers
+        self.max_size = max_size
+        self.queue = None
+        self.tasks = []
+        # Slots held by uploads that are still being spooled (see reserve)
+        self.reserved = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # Jobs that never started
+        while not self.queue.empty():
+            job_id, payload = self.queue.get_nowait()
+            self.store.update(job_id, status="failed", stage="failed", error="Server shut down before the job ran")
+            if self.discard is not None:
+                try:
+                    self.discard(payload)
+                except Exception as e:
+                    logger.error(f"Failed to discard job {job_id}: {e}")
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    # Hold a queue slot while the upload is spooled, so a full queue is refused
+    # before any work is done; raises QueueFullError. submit(reserved=True)
+    # takes the slot, release() gives it back if the job is never submitted
+    def reserve(self):
+        if self.max_size > 0 and self.queue.qsize() + self.reserved >= self.max_size:
+            raise QueueFullError(f"Job queue is full ({self.max_size} jobs waiting)")
+        self.reserved += 1
+
+    def release(self):
+        self.reserved -= 1
+
+    # Enqueue a job and return its id; raises QueueFullError when the queue is
+    # full, unless the caller already reserved its slot
+    def submit(self, payload: dict, reserved: bool = False, **info) -> str:
+        if not reserved:
+            self.reserve()
+        self.release()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        record = {"job_id": job_id, "status": "queued", "stage": "queued", "progress": {},
+                  "result": None, "error": None, "created_at": now, "updated_at": now, **info}
+        # put_nowait doesn't yield, so no worker can pick the job up before
+        # its record exists
+        self.queue.put_nowait((job_id, payload))
+        self.store.create(job_id, record)
+        return job_id
+
+    def get(self, job_id: str):
+        return self.store.get(job_id)
+
+    async def _worker(self):
+        while True:
+            job_id, payload = await self.queue.get()
+            try:
+                await self._run(job_id, payload)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job_id: str, payload: dict):
+        def on_stage(stage, **details):
+            self.store.update(job_id, stage=stage, progress=details)
+
+        with start_trace(job_id) as trace:
+            self.store.update(job_id, status="running", trace_id=trace.trace_id)
+            try:
+                result = await self.handler(payload, on_stage)
+                self.store.update(job_id, status="done", stage="done", result=result)
+            except asyncio.CancelledError:
+                self.store.update(job_id, status="failed", stage="failed", error="Server shut down during the job")
+                raise
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                self.store.update(job_id, status="failed", stage="failed", error=str(e))
+            if payload.get("debug"):
+                self.store.update(job_id, trace=trace.to_dict())
@@ -1,14 +1,126 @@
 # Setup logger
+# Records are put on an in-memory queue by the calling thread and written by a
+# background listener thread, so request handlers never wait on file I/O.
+# Files rotate by size; raw model output and retrieved contexts go through
+# log_payload, which samples them, keeps a capped preview in the main log and
+# (optionally) the full text in a separate debug sink
+import atexit
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from app.utils.tracing import current_trace
 
-os.makedirs("logs", exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("logs/app.log"),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger("DocumentExtractor")
\ No newline at end of file
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json or text, for the log file and the console
+LOG_FILE_FORMAT = os.getenv("LOG_FILE_FORMAT", "json")
+LOG_CONSOLE_FORMAT = os.getenv("LOG_CONSOLE_FORMAT", "text")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Payloads (raw model answers, RAG contexts): share that is logged at all,
+# characters kept in the main log, and the debug sink file ("" = off) with its
+# own per-record cap
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+LOG_PAYLOAD_PREVIEW_CHARS = int(os.getenv("LOG_PAYLOAD_PREVIEW_CHARS", "500"))
+LOG_DEBUG_SINK = os.getenv("LOG_DEBUG_SINK", "")
+LOG_DEBUG_SINK_MAX_CHARS = int(os.getenv("LOG_DEBUG_SINK_MAX_CHARS", "200000"))
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+# One JSON object per line: time, level, logger, message, the trace id of the
+# request / job that logged it and any `fields` passed in extra=
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def make_formatter(kind: str):
+    return JsonFormatter() if kind == "json" else logging.Formatter(TEXT_FORMAT)
+
+
+# The trace id has to be read on the logging thread, before the record is queued
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        trace = current_trace()
+        record.trace_id = trace.trace_id if trace is not None else None
+        return True
+
+
+def queue_handler(log_queue):
+    handler = QueueHandler(log_queue)
+    handler.addFilter(TraceIdFilter())
+    return handler
+
+
+def rotating_file_handler(path: str, kind: str):
+    handler = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    handler.setFormatter(make_formatter(kind))
+    return handler
+
+
+logger = logging.getLogger("DocumentExtractor")
+payload_logger = logging.getLogger("DocumentExtractor.payloads")
+payload_logger.propagate = False
+
+
+def setup_logging():
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    console = logging.StreamHandler()
+    console.setFormatter(make_formatter(LOG_CONSOLE_FORMAT))
+    handlers = [console]
+    # Page pool workers (spawned processes) log to the console only: several
+    # processes rotating the same file would lose records
+    if multiprocessing.parent_process() is None:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        handlers.append(rotating_file_handler(os.path.join(LOG_DIR, "app.log"), LOG_FILE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root.handlers = [queue_handler(log_queue)]
+    listeners = [QueueListener(log_queue, *handlers, respect_handler_level=True)]
+
+    payload_logger.setLevel(logging.INFO)
+    if LOG_DEBUG_SINK and multiprocessing.parent_process() is None:
+        os.makedirs(os.path.dirname(LOG_DEBUG_SINK) or ".", exist_ok=True)
+        payload_queue = queue.SimpleQueue()
+        payload_logger.handlers = [queue_handler(payload_queue)]
+        listeners.append(QueueListener(payload_queue, rotating_file_handler(LOG_DEBUG_SINK, "json")))
+
+    for listener in listeners:
+        listener.start()
+    # Flush what is still queued on exit
+    atexit.register(lambda: [listener.stop() for listener in listeners])
+
+
+setup_logging()
+
+
+# Log a large artefact (raw model output, retrieved context). A sampled share
+# is logged at all; the main log gets its length and a capped preview, the
+# debug sink (LOG_DEBUG_SINK) the full text up to LOG_DEBUG_SINK_MAX_CHARS
+def log_payload(kind: str, text, **fields):
+    if LOG_PAYLOAD_SAMPLE_RATE < 1.0 and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    text = text if isinstance(text, str) else str(text)
+    preview = text[:LOG_PAYLOAD_PREVIEW_CHARS]
+    suffix = "..." if len(text) > len(preview) else ""
+    logger.info(f"{kind} ({len(text)} chars): {preview}{suffix}",
+                extra={"fields": {"payload": kind, "chars": len(text), **fields}})
+    if payload_logger.handlers:
+        payload_logger.info(kind, extra={"fields": {"payload": kind, "chars": len(text),
+                                                    "truncated": len(text) > LOG_DEBUG_SINK_MAX_CHARS,
+                                                    "text": text[:LOG_DEBUG_SINK_MAX_CHARS], **fields}})
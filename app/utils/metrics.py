@@ -0,0 +1,54 @@
+import time
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from app.utils.tracing import record_span, span
+
+# Process-wide Prometheus metrics, served by GET /metrics. Work done in page
+# pool workers is timed there and observed here when the result comes back
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6)
+PAGE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+REQUEST_SECONDS = Histogram("extractor_request_seconds", "HTTP request latency",
+                            ["path", "status"], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram("extractor_stage_seconds", "Time spent in each pipeline stage",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+PAGE_STEP_SECONDS = Histogram("extractor_page_step_seconds",
+                              "Per-page time by step (text_layer, render, ocr, probe, vlm)",
+                              ["step"], buckets=LATENCY_BUCKETS)
+VLM_PAYLOAD_BYTES = Histogram("extractor_vlm_payload_bytes", "Image bytes sent per VLM call",
+                              ["purpose"], buckets=BYTES_BUCKETS)
+VLM_CALLS = Counter("extractor_vlm_calls_total", "VLM calls by purpose and outcome (ok, error, cached)",
+                    ["purpose", "outcome"])
+DOCUMENT_PAGES = Histogram("extractor_document_pages", "Pages per processed document", buckets=PAGE_BUCKETS)
+PAGES = Counter("extractor_pages_total", "Processed pages by text source (text, ocr, ocr_failed, duplicate)", ["source"])
+CACHE_LOOKUPS = Counter("extractor_cache_lookups_total", "Result cache lookups by cache and result (hit, miss)",
+                        ["cache", "result"])
+OUTPUT_PARSES = Counter("extractor_output_parse_total", "Model answers by purpose and parse result (ok, failed)",
+                        ["purpose", "result"])
+JOB_QUEUE_DEPTH = Gauge("extractor_job_queue_depth", "Jobs waiting in the background queue")
+
+
+# Time a pipeline stage into STAGE_SECONDS and the current trace
+@contextmanager
+def track_stage(stage: str, **attrs):
+    start = time.perf_counter()
+    try:
+        with span(stage, **attrs) as span_attrs:
+            yield span_attrs
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+# Record a per-page step that was timed elsewhere
+def observe_page_step(step: str, seconds: float, **attrs):
+    PAGE_STEP_SECONDS.labels(step).observe(seconds)
+    record_span(f"page.{step}", seconds, **attrs)
+
+
+def observe_cache(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def render_metrics():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,113 @@
+import resource
+import threading
+import time
+from app.utils.logger import logger
+
+
+# Resident set size of this process in MB (falls back to the peak RSS where
+# /proc is not available)
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * resource.getpagesize() / 2**20, 1)
+    except (OSError, ValueError, IndexError):
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+# Process-wide registry of named objects that are expensive to build (models,
+# pipeline modules). Each is built once, on startup or on first use, and then
+# shared. The build runs outside the lock: other callers for the same name
+# wait on its event, and status() (read by /health on the event loop) only
+# takes the lock to copy the state, so it never waits for a load
+class LazyRegistry:
+    kind = "object"
+    seconds_key = "load_seconds"
+
+    def __init__(self):
+        self.builders = {}
+        self.objects = {}
+        self.info = {}
+        self.loading = {}  # name -> threading.Event set when its build ends
+        self.lock = threading.Lock()
+
+    # builder() returns (object, details) where details is a dict for /health
+    def add(self, name: str, builder, status: str = "not_loaded"):
+        with self.lock:
+            self.builders[name] = builder
+            self.info.setdefault(name, {"status": status})
+
+    def get(self, name: str):
+        obj = self.objects.get(name)
+        if obj is not None:
+            return obj
+        with self.lock:
+            if name in self.objects:
+                return self.objects[name]
+            done = self.loading.get(name)
+            building = done is None
+            if building:
+                done = self.loading[name] = threading.Event()
+                self.info[name] = {"status": "loading"}
+        if not building:
+            done.wait()
+            with self.lock:
+                if name in self.objects:
+                    return self.objects[name]
+                raise RuntimeError(f"Loading {self.kind} '{name}' failed: {self.info[name].get('error')}")
+        try:
+            return self._build(name)
+        finally:
+            with self.lock:
+                del self.loading[name]
+            done.set()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {name: dict(info) for name, info in self.info.items()}
+
+    # Called by the one caller that builds name, without the lock held
+    def _build(self, name: str):
+        logger.info(f"Loading {self.kind} '{name}'...")
+        rss_before = current_rss_mb()
+        start_time = time.perf_counter()
+        try:
+            obj, details = self.builders[name]()
+        except Exception as e:
+            with self.lock:
+                self.info[name] = {"status": "failed", "error": str(e)}
+            raise
+        seconds = time.perf_counter() - start_time
+        with self.lock:
+            self.objects[name] = obj
+            self.info[name] = {"status": "ready", self.seconds_key: round(seconds, 2),
+                               "rss_delta_mb": round(current_rss_mb() - rss_before, 1), **details}
+        logger.info(f"{self.kind.capitalize()} '{name}' loaded in {seconds:.2f} seconds")
+        return obj
+
+
+# Heavy models (the RAG embedding model), registered with a loader
+# and preloaded by load_all from the FastAPI lifespan hook unless
+# PRELOAD_MODELS=0; every request then shares the same instance
+class ModelRegistry(LazyRegistry):
+    kind = "model"
+
+    # loader() returns (model, details) where details is a dict for /health
+    def register(self, name: str, loader):
+        self.add(name, loader)
+
+    @property
+    def models(self):
+        return self.objects
+
+    # Load every registered model; failures are logged and reported in
+    # status() instead of stopping the service
+    def load_all(self):
+        for name in list(self.builders):
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.error(f"Failed to load model '{name}': {e}")
+
+
+registry = ModelRegistry()
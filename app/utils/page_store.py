@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import threading
+
+# Keep rendered pages in memory unless PAGE_STORE_SPILL=1, in which case
+# page buffers are written to a private temp directory for the request
+PAGE_STORE_SPILL = os.getenv("PAGE_STORE_SPILL", "0") == "1"
+
+
+# Per-request store for rendered page buffers and their role labels.
+# Every preprocessing / VLM stage takes the store explicitly, so concurrent
+# requests never share files the way the old ./pages directory did.
+class PageStore:
+    def __init__(self, spill: bool = PAGE_STORE_SPILL):
+        self.spill = spill
+        self.tmp_dir = tempfile.mkdtemp(prefix="pages_") if spill else None
+        self.pages = {}   # page_num -> image bytes (or file path when spilled)
+        self.roles = {}   # role -> page_num, e.g. "bank_copy"
+        self.labels = {}  # label -> page_num, e.g. "subject_of_fa_1"
+        self.texts = {}   # page_num -> OCR text, computed once per page
+        self.sources = {} # page_num -> "text" (native text layer) or "ocr"
+        # Repeated pages: page_num -> {"same_as": first page_num, "match",
+        # "distance"}. A duplicate page shares the first page's image, and its
+        # text too unless it is a rescan ("ocr_text" match, see page_dedup)
+        self.duplicates = {}
+        self.page_count = 0
+        # One entry per VLM call: page, bytes sent, latency
+        self.vlm_calls = []
+        # VLM calls answered by an identical call on repeated pages
+        self.shared_vlm_calls = 0
+        # Fields read from the page text by the field rules, and VLM calls
+        # left with nothing to extract after them
+        self.rule_fields = []
+        self.skipped_vlm_calls = 0
+        # Optional callable(page_num) -> image bytes, used to render pages
+        # that were skipped up front (e.g. text-layer pages) on first access
+        self.renderer = None
+        self.document = None
+        self._render_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self.page_count
+
+    def put_page(self, page_num: int, image_bytes: bytes):
+        if self.spill:
+            path = os.path.join(self.tmp_dir, f"page_{page_num}.png")
+            with open(path, "wb") as f:
+                f.write(image_bytes)
+            self.pages[page_num] = path
+        else:
+            self.pages[page_num] = image_bytes
+
+    # The page whose text and image stand in for page_num
+    def canonical_page(self, page_num: int) -> int:
+        duplicate = self.duplicates.get(page_num)
+        return duplicate["same_as"] if duplicate else page_num
+
+    def get_page(self, page_num: int) -> bytes:
+        page_num = self.canonical_page(page_num)
+        if page_num not in self.pages and self.renderer is not None:
+            with self._render_lock:
+                if page_num not in self.pages:
+                    self.put_page(page_num, self.renderer(page_num))
+        data = self.pages[page_num]
+        if self.spill:
+            with open(data, "rb") as f:
+                return f.read()
+        return data
+
+    def put_text(self, page_num: int, text: str, source: str = "ocr"):
+        self.texts[page_num] = text
+        self.sources[page_num] = source
+
+    def get_text(self, page_num: int) -> str:
+        return self.texts[page_num]
+
+    def page_numbers(self):
+        return list(range(1, self.page_count + 1))
+
+    # Name used in logs, matching the old file names (page_N / bank_copy)
+    def page_name(self, page_num: int) -> str:
+        for role, num in self.roles.items():
+            if num == page_num:
+                return role
+        return f"page_{page_num}"
+
+    def set_role(self, role: str, page_num: int):
+        self.roles[role] = page_num
+
+    def get_role(self, role: str):
+        page_num = self.roles.get(role)
+        if page_num is None:
+            return None
+        return self.get_page(page_num)
+
+    def add_label(self, label: str, page_num: int):
+        self.labels[label] = page_num
+
+    def get_label(self, label: str):
+        page_num = self.labels.get(label)
+        if page_num is None:
+            return None
+        return self.get_page(page_num)
+
+    def close(self):
+        self.pages.clear()
+        self.roles.clear()
+        self.labels.clear()
+        self.texts.clear()
+        self.sources.clear()
+        self.duplicates.clear()
+        self.vlm_calls.clear()
+        self.rule_fields.clear()
+        self.renderer = None
+        if self.document is not None:
+            self.document.close()
+            self.document = None
+        if self.tmp_dir:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
@@ -0,0 +1,64 @@
+import importlib
+import os
+from app.utils.logger import logger
+from app.utils.model_registry import LazyRegistry
+
+# Pipelines this worker serves. Each pipeline is a module imported on first
+# use (or at startup with PRELOAD_MODELS), so a VLM-only worker never pulls in
+# the RAG stack (langchain, FAISS, sentence-transformers, torch)
+ENABLED_PIPELINES = [name.strip() for name in os.getenv("ENABLED_PIPELINES", "vlm").split(",") if name.strip()]
+
+
+class PipelineDisabledError(Exception):
+    pass
+
+
+# Process-wide registry of pipeline modules, by name. Registering only records
+# the module path; get() imports it once (see LazyRegistry) and reports the
+# import cost in status()
+class PipelineRegistry(LazyRegistry):
+    kind = "pipeline"
+    seconds_key = "import_seconds"
+
+    def __init__(self, enabled):
+        super().__init__()
+        self.enabled = set(enabled)
+        self.targets = {}
+
+    def register(self, name: str, module_path: str):
+        self.targets[name] = module_path
+        self.add(name, lambda: (importlib.import_module(module_path), {"module": module_path}),
+                 status="not_loaded" if name in self.enabled else "disabled")
+
+    @property
+    def modules(self):
+        return self.objects
+
+    def is_enabled(self, name: str) -> bool:
+        return name in self.enabled and name in self.targets
+
+    def get(self, name: str):
+        module = self.objects.get(name)
+        if module is not None:
+            return module
+        if not self.is_enabled(name):
+            raise PipelineDisabledError(f"Pipeline '{name}' is not enabled on this worker")
+        return super().get(name)
+
+    # Import every enabled pipeline; failures are logged and reported in
+    # status() instead of stopping the service
+    def load_enabled(self):
+        for name in list(self.targets):
+            if name not in self.enabled:
+                continue
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.error(f"Failed to load pipeline '{name}': {e}")
+
+
+pipelines = PipelineRegistry(ENABLED_PIPELINES)
+# vlm: run_extraction / run_batch (PyMuPDF, OCR, Ollama VLM)
+pipelines.register("vlm", "app.agents.pipeline")
+# rag: extract_with_rag (langchain, FAISS, BM25, embeddings)
+pipelines.register("rag", "app.agents.llm_extract")
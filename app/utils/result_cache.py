@@ -0,0 +1,188 @@
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Set RESULT_CACHE_ENABLED=0 to turn off every cache tier
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") == "1"
+# In-memory LRU tier: entries per namespace and time-to-live in seconds
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "512"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+# Disk tier (SQLite), shared by every worker process; empty string disables it
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "cache/results.sqlite3")
+# Disk tier eviction: rows per namespace beyond RESULT_CACHE_MAX_ROWS (least
+# recently used first) and expired rows are purged on write, at most every
+# RESULT_CACHE_PURGE_INTERVAL seconds or RESULT_CACHE_PURGE_EVERY writes
+RESULT_CACHE_MAX_ROWS = int(os.getenv("RESULT_CACHE_MAX_ROWS", "20000"))
+RESULT_CACHE_PURGE_INTERVAL = float(os.getenv("RESULT_CACHE_PURGE_INTERVAL", "300"))
+RESULT_CACHE_PURGE_EVERY = int(os.getenv("RESULT_CACHE_PURGE_EVERY", "200"))
+
+
+def sha256_hex(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+# Two-tier cache of JSON-serialisable values: an LRU/TTL dict in memory in
+# front of a SQLite table. Disk hits are promoted to the memory tier.
+# get/set block on SQLite; async code uses aget/aset, which answer memory hits
+# inline and run the disk tier in a thread
+class ResultCache:
+    def __init__(self, namespace: str, max_entries: int = RESULT_CACHE_SIZE,
+                 ttl: int = RESULT_CACHE_TTL, db_path: str = RESULT_CACHE_PATH,
+                 max_rows: int = RESULT_CACHE_MAX_ROWS):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.memory = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        # The connection is shared by the threads of this process
+        self.db_lock = threading.Lock()
+        self.db = None
+        self.writes_since_purge = 0
+        self.last_purge = 0.0
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT, key TEXT, value TEXT, expires_at REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            # Tables created before eviction have no accessed_at column
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(cache)")}
+            if "accessed_at" not in columns:
+                self.db.execute("ALTER TABLE cache ADD COLUMN accessed_at REAL DEFAULT 0")
+            self.db.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires_at)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (namespace, accessed_at)")
+            self.db.commit()
+            self._purge(time.time())
+
+    # Values are copied on the way in and out, so callers never share (and
+    # can't mutate) a cached entry
+    def get(self, key: str):
+        found, value = self._get_memory(key)
+        if found:
+            return value
+        return self._get_disk(key)
+
+    def set(self, key: str, value):
+        expires_at = self._set_memory(key, value)
+        self._set_disk(key, value, expires_at)
+
+    async def aget(self, key: str):
+        found, value = self._get_memory(key)
+        if found:
+            return value
+        if self.db is None:
+            return None
+        return await asyncio.to_thread(self._get_disk, key)
+
+    async def aset(self, key: str, value):
+        expires_at = self._set_memory(key, value)
+        if self.db is not None:
+            await asyncio.to_thread(self._set_disk, key, value, expires_at)
+
+    def _get_memory(self, key: str):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] > now:
+                self.memory.move_to_end(key)
+                return True, copy.deepcopy(entry[1])
+            del self.memory[key]
+            return False, None
+
+    def _set_memory(self, key: str, value) -> float:
+        expires_at = time.time() + self.ttl
+        self._remember(key, copy.deepcopy(value), expires_at)
+        return expires_at
+
+    def _get_disk(self, key: str):
+        if self.db is None:
+            return None
+        now = time.time()
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self.db.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+            else:
+                self.db.execute("UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                                (now, self.namespace, key))
+            self.db.commit()
+        if row[1] <= now:
+            return None
+        value = json.loads(row[0])
+        self._remember(key, value, row[1])
+        return copy.deepcopy(value)
+
+    def _set_disk(self, key: str, value, expires_at: float):
+        if self.db is None:
+            return
+        now = time.time()
+        with self.db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), expires_at, now),
+            )
+            self.db.commit()
+            self.writes_since_purge += 1
+            if (self.writes_since_purge >= RESULT_CACHE_PURGE_EVERY
+                    or now - self.last_purge >= RESULT_CACHE_PURGE_INTERVAL):
+                self._purge(now)
+
+    # Drop expired rows (any namespace) and this namespace's least recently
+    # used rows beyond max_rows. Called with db_lock held (or from __init__)
+    def _purge(self, now: float):
+        self.db.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        if self.max_rows > 0:
+            self.db.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key IN ("
+                "SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.namespace, self.namespace, self.max_rows),
+            )
+        self.db.commit()
+        self.writes_since_purge = 0
+        self.last_purge = now
+
+    def _remember(self, key: str, value, expires_at: float):
+        with self.lock:
+            self.memory[key] = (expires_at, value)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# Process-wide cache for a namespace ("documents", "ocr_pages", "vlm_pages"),
+# or None when caching is disabled
+def get_cache(namespace: str):
+    if not RESULT_CACHE_ENABLED:
+        return None
+    with _caches_lock:
+        if namespace not in _caches:
+            _caches[namespace] = ResultCache(namespace)
+        return _caches[namespace]
@@ -0,0 +1,82 @@
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# The trace of the request / job being handled and the innermost open span.
+# Context variables follow the work into asyncio tasks and asyncio.to_thread
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+# Spans recorded while handling one request or job
+class Trace:
+    def __init__(self, trace_id: str = None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, name: str, start: float, duration: float, parent_id=None, attrs=None, span_id=None) -> str:
+        span_id = span_id or uuid.uuid4().hex[:16]
+        with self.lock:
+            self.spans.append({"span_id": span_id, "parent_id": parent_id, "name": name,
+                               "start_ms": round((start - self.started) * 1000, 1),
+                               "duration_ms": round(duration * 1000, 1), "attrs": attrs or {}})
+        return span_id
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s["start_ms"])
+        return {"trace_id": self.trace_id,
+                "duration_ms": round((time.perf_counter() - self.started) * 1000, 1), "spans": spans}
+
+    # Server-Timing header value: total time of the top-level spans by name
+    def server_timing(self) -> str:
+        totals = {}
+        with self.lock:
+            for s in self.spans:
+                if s["parent_id"] is None:
+                    totals[s["name"]] = totals.get(s["name"], 0.0) + s["duration_ms"]
+        return ", ".join(f"{name};dur={duration:.1f}" for name, duration in totals.items())
+
+
+@contextmanager
+def start_trace(trace_id: str = None):
+    trace = Trace(trace_id)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        yield trace
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+# Time a block as a span of the current trace (a no-op outside a trace).
+# Yields the span's attribute dict, so the block can add to it
+@contextmanager
+def span(name: str, **attrs):
+    trace = _current_trace.get()
+    span_id = uuid.uuid4().hex[:16]
+    parent_id = _current_span.get()
+    token = _current_span.set(span_id)
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        _current_span.reset(token)
+        if trace is not None:
+            trace.add(name, start, time.perf_counter() - start, parent_id, attrs, span_id)
+
+
+# Record a span measured elsewhere (e.g. in a page pool worker) as ending now
+def record_span(name: str, seconds: float, **attrs):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, time.perf_counter() - seconds, seconds, _current_span.get(), attrs)
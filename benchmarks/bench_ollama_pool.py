@@ -0,0 +1,100 @@
+# Routing benchmark for the Ollama client pool, against several fake servers
+# Starts --backends fake Ollama servers (the first one --slow times slower),
+# points OLLAMA_HOSTS at them, warms them up and sends --calls chat calls with
+# --concurrency in flight. Halfway through, --kill-after stops one backend to
+# show it being taken out of rotation and the calls failing over. Reports
+# per-backend call counts, health and the call throughput; compare with
+# --backends 1 for the single-host baseline.
+#
+# Usage: python -m benchmarks.bench_ollama_pool [--backends 3] [--calls 120] [--concurrency 12]
+#                                               [--latency 0.2] [--slow 3] [--kill-after 0.5]
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from benchmarks.fake_ollama import FakeOllamaServer
+
+
+async def run(args, servers):
+    from app.agents import ollama_client
+
+    start_time = time.perf_counter()
+    await ollama_client.start(warm=True)
+    warm_seconds = time.perf_counter() - start_time
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    errors = 0
+    killed = None
+
+    async def call(i):
+        nonlocal errors
+        async with semaphore:
+            try:
+                await ollama_client.chat(model="qwen2.5vl:7b", format="json",
+                                         messages=[{"role": "user", "content": f"What is the bank name? {i}"}])
+            except Exception:
+                errors += 1
+
+    async def killer():
+        nonlocal killed
+        if args.kill_after <= 0 or len(servers) < 2:
+            return
+        while sum(s.requests for s in servers) < args.calls * args.kill_after:
+            await asyncio.sleep(0.01)
+        killed = servers[-1]
+        await asyncio.to_thread(killed.shutdown)
+        killed.server_close()
+
+    start_time = time.perf_counter()
+    await asyncio.gather(killer(), *[call(i) for i in range(args.calls)])
+    elapsed = time.perf_counter() - start_time
+    await ollama_client.stop()
+
+    return {"backends": len(servers), "calls": args.calls, "concurrency": args.concurrency, "errors": errors,
+            "warm_seconds": round(warm_seconds, 3), "seconds": round(elapsed, 3),
+            "calls_per_second": round(args.calls / elapsed, 2),
+            "killed": killed.url if killed is not None else None,
+            "servers": [{"url": s.url, "latency": s.latency, "paths": dict(s.paths),
+                         "max_in_flight": s.max_in_flight} for s in servers],
+            "pool": ollama_client.status()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", type=int, default=3)
+    parser.add_argument("--calls", type=int, default=120)
+    parser.add_argument("--concurrency", type=int, default=12)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake seconds per call")
+    parser.add_argument("--slow", type=float, default=3.0, help="latency multiplier of the first backend")
+    parser.add_argument("--kill-after", type=float, default=0.5,
+                        help="stop the last backend after this share of the calls (0 = never)")
+    parser.add_argument("--out", default="")
+    args = parser.parse_args()
+
+    servers = []
+    for i in range(args.backends):
+        server = FakeOllamaServer(("127.0.0.1", 0), latency=args.latency * (args.slow if i == 0 else 1.0))
+        server.start()
+        servers.append(server)
+    # Read by ollama_client at import
+    os.environ["OLLAMA_HOSTS"] = ",".join(s.url for s in servers)
+    os.environ.setdefault("VLM_BACKOFF", "0.05")
+    os.environ.setdefault("OLLAMA_HEALTH_INTERVAL", "0.5")
+
+    report = asyncio.run(run(args, servers))
+    for server, backend in zip(report["servers"], report["pool"]):
+        print(f"{backend['host']}: latency {server['latency']}s, {server['paths'].get('/api/chat', 0)} calls, "
+              f"healthy {backend['healthy']}, failures {backend['failures']}")
+    print(f"{report['calls']} calls in {report['seconds']}s ({report['calls_per_second']} calls/s), "
+          f"{report['errors']} errors, warm-up {report['warm_seconds']}s")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Micro-benchmark: per-page classification time for CIMB rules
+#   search_for - the original chain of page.search_for() calls on a PyMuPDF page
+#   substring  - the same chain as `phrase in text` checks on the normalized text
+#   compiled   - the rule table compiled into one PhraseMatcher (one pass per page)
+# Pages are synthetic: filler text with a random subset of the rule phrases.
+# All three must produce the same labels.
+#
+# Usage: python -m benchmarks.bench_page_classifier [--pages 200] [--repeat 5]
+
+import argparse
+import random
+import time
+
+import pymupdf
+
+from app.agents.agent_config import CIMB_PAGE_RULES
+from app.agents.page_rules import PageClassifier, normalize_text
+
+FILLER = ("The Borrower shall pay interest on the facility at the rate stated in the schedule and "
+          "all fees, costs and charges incurred by the Bank in connection with this letter of offer. ")
+
+
+# The if-chain as it was written in filter_and_rename_pages, with the search
+# primitive passed in
+def legacy_classify(search):
+    labels, pending = [], []
+    if search('we are pleased to inform you that') or search('strictly private and highly confidential'):
+        labels.append('bank_copy')
+    if (search('form of facility') or search('facility amount is an amount which is equal') or
+            search('type of facility') or search('payment amount (RM per payment)')):
+        if search('total'):
+            labels.append('subject_of_fa')
+        else:
+            labels.append('subject_of_fa_1')
+            pending.append('subject_of_fa')
+    if search('pengiraan duit yang dikenakan') or search('salinan kepada'):
+        labels.append('law_firm_details')
+    if (search('to finance the purchase of the property described below') or search('execution of open charge under')
+            or search('a letter of undertaking from registered owner')):
+        if (search('if there is a disrepancy in the property details stated above') or search('individual title') or
+                search('strava title')):
+            labels.append('property_details')
+        else:
+            pending.append('property_details')
+            labels.append('property_details_1')
+    if (search('all of the following documents (the "Security Documents") must be executed and perfected, in form and content acceptable to the Bank.') or
+            search('the following security which shall be in such form') or
+            search('execution of joint and several guarantee in favour of the bank')):
+        if (search('joint and several guarantee in favour of the bank') or
+                search('corporate guarantee in favour of the bank') or
+                search('individual guarantee in favour of the bank')):
+            labels.append('guarantor_details')
+        elif search('property with'):
+            labels.append('property_details')
+        else:
+            labels.append('gurantor_details_1')
+            pending.append('gurantor_details')
+    return labels, pending
+
+
+def rule_phrases():
+    phrases = []
+    for rule in CIMB_PAGE_RULES:
+        phrases += rule["match"]
+        for branch in rule.get("branches", []):
+            phrases += branch["if_any"]
+    return phrases
+
+
+def make_pages(n_pages: int, seed: int = 7):
+    rng = random.Random(seed)
+    phrases = rule_phrases()
+    pages = []
+    for _ in range(n_pages):
+        parts = [FILLER] * 25
+        for phrase in rng.sample(phrases, rng.randint(0, 3)):
+            parts.insert(rng.randint(0, len(parts)), phrase + ". ")
+        pages.append("".join(parts))
+    return pages
+
+
+def build_pdf(pages):
+    doc = pymupdf.open()
+    for text in pages:
+        page = doc.new_page()
+        page.insert_textbox(pymupdf.Rect(36, 36, 559, 806), text, fontsize=8)
+    return doc
+
+
+def time_per_page(fn, items, repeat: int):
+    best = float("inf")
+    results = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [fn(item) for item in items]
+        best = min(best, time.perf_counter() - start)
+    return best / len(items) * 1e6, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    doc = build_pdf(make_pages(args.pages))
+    pdf_pages = [doc[i] for i in range(len(doc))]
+    texts = [normalize_text(page.get_text()) for page in pdf_pages]
+    classifier = PageClassifier(CIMB_PAGE_RULES)
+
+    search_for_us, expected = time_per_page(
+        lambda page: legacy_classify(lambda phrase: bool(page.search_for(phrase))), pdf_pages, args.repeat)
+    substring_us, substring = time_per_page(
+        lambda text: legacy_classify(lambda phrase: normalize_text(phrase) in text), texts, args.repeat)
+    compiled_us, compiled = time_per_page(classifier.classify, texts, args.repeat)
+
+    print(f"pages={len(texts)} avg_chars={sum(map(len, texts)) // len(texts)}")
+    print(f"search_for: {search_for_us:9.1f} us/page")
+    print(f"substring:  {substring_us:9.1f} us/page")
+    print(f"compiled:   {compiled_us:9.1f} us/page ({search_for_us / compiled_us:.0f}x faster than search_for)")
+    same = [list(map(list, r)) for r in expected] == [list(map(list, r)) for r in compiled] == \
+           [list(map(list, r)) for r in substring]
+    print(f"identical labels: {same}")
+
+
+if __name__ == "__main__":
+    main()
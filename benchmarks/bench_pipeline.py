@@ -0,0 +1,298 @@
+# End-to-end benchmark: synthetic letters of offer through POST /extract-vlm
+# Generates multi-page letters for each bank (with its bank copy and section
+# marker phrases), as text-layer and as image-only PDFs, starts the API with
+# uvicorn against the fake Ollama server and posts the letters at several
+# concurrency levels. Reports pages/sec, p50/p95 latency, peak RSS of the API
+# process tree, per-stage time (from the Server-Timing header) and how many
+# extracted fields differ from the letters' known values, and writes
+# everything to a JSON file so runs can be compared.
+#
+# Usage: python -m benchmarks.bench_pipeline [--concurrency 1,2,4] [--docs 8] [--pages 8]
+#                                            [--latency 0.5] [--out bench_pipeline.json]
+
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import httpx
+import pymupdf
+
+from benchmarks.fake_ollama import FakeOllamaServer
+
+FILLER = ("The Borrower shall pay interest on the facility at the rate stated in the schedule and all fees, "
+          "costs and charges incurred by the Bank in connection with this letter of offer. ")
+
+BANKS = {
+    "cimb": ("CIMB BANK BERHAD (13491-P)", "Level 13, Menara CIMB, Jalan Stesen Sentral 2, 50470 Kuala Lumpur"),
+    "maybank": ("MALAYAN BANKING BERHAD (3813-K)", "Menara Maybank, 100 Jalan Tun Perak, 50050 Kuala Lumpur"),
+    "rhb": ("RHB BANK BERHAD (6171-M)", "Level 10, Tower One, RHB Centre, Jalan Tun Razak, 50400 Kuala Lumpur"),
+    "public": ("PUBLIC BANK BERHAD (6463-H)", "Menara Public Bank, 146 Jalan Ampang, 50450 Kuala Lumpur"),
+}
+
+# Section pages of a letter, in order; the facility and property sections run
+# over two pages so the continued-section labels are exercised
+SECTIONS = [
+    "Type of facility: Term Loan (TL)\nPayment amount (RM per payment): RM5,000.00",
+    "Total Facilities: RM1,000,000.00",
+    "To finance the purchase of the property described below.",
+    "Individual title ABC 0000, Lot 2, 45000 Kuala Selangor",
+    "All of the following documents (the \"Security Documents\") must be executed and perfected, in form and "
+    "content acceptable to the Bank.\nJoint and several guarantee in favour of the bank by Ali bin Abu.",
+    "Salinan kepada: Abraham Ooi & Partners, 28-b & 30-b, 2nd Floor, Jalan Ss 21/62, 47400 Petaling Jaya",
+]
+
+
+# Values every letter carries, in its text and in the fake VLM's answer,
+# checked in each response (response field -> value). A request that fails,
+# OCRs badly or leaves pages unlabelled comes back with empty or different
+# fields and counts as a mismatch. Only CIMB has page rules, so the other
+# banks' letters come back empty: compare mismatches by bank between runs
+EXPECTED_FIELDS = {
+    "subject_matter": "Term Loan (TL) - RM1,000,000.00",
+    "total_loan_amount": "RM1,000,000.00",
+    "law_firm_name": "Abraham Ooi & Partners",
+    "property_description": "Individual Title ABC 0000, Lot 2",
+}
+
+
+def letter_pages(bank: str, n_pages: int, rng: random.Random):
+    name, address = BANKS[bank]
+    pages = [f"{name}\n{address}\n\nSTRICTLY PRIVATE AND HIGHLY CONFIDENTIAL\n\n"
+             f"Dear Sir/Madam,\nWe are pleased to inform you that the Bank has approved the facility below."]
+    pages += SECTIONS[:max(0, n_pages - 1)]
+    while len(pages) < n_pages:
+        pages.append(f"Terms and conditions (continued), clause {len(pages)}.")
+    return [page + "\n\n" + FILLER * rng.randint(8, 14) for page in pages]
+
+
+def write_letter(path: str, pages, image_only: bool):
+    doc = pymupdf.open()
+    for text in pages:
+        page = doc.new_page()
+        page.insert_textbox(pymupdf.Rect(48, 48, 547, 794), text, fontsize=10)
+    if image_only:
+        scanned = pymupdf.open()
+        for page in doc:
+            pix = page.get_pixmap(matrix=pymupdf.Matrix(2, 2))
+            scanned.new_page(width=page.rect.width, height=page.rect.height).insert_image(page.rect, pixmap=pix)
+        doc.close()
+        doc = scanned
+    doc.save(path)
+    doc.close()
+
+
+def build_corpus(out_dir: str, n_pages: int, seed: int = 7):
+    rng = random.Random(seed)
+    corpus = []
+    for bank in BANKS:
+        for kind in ("text", "image"):
+            path = os.path.join(out_dir, f"{bank}_{kind}.pdf")
+            write_letter(path, letter_pages(bank, n_pages, rng), image_only=(kind == "image"))
+            corpus.append({"path": path, "bank": bank, "kind": kind, "pages": n_pages})
+    return corpus
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# RSS of a process and all its descendants (page pool workers included), in MB
+def tree_rss_mb(pid: int) -> float:
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending += [int(child) for child in f.read().split()]
+        except (OSError, ValueError):
+            continue
+    return total / 1024
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0.0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, tree_rss_mb(self.pid))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        return self.peak
+
+
+def parse_server_timing(header: str) -> dict:
+    stages = {}
+    for part in filter(None, (p.strip() for p in (header or "").split(","))):
+        name, _, rest = part.partition(";dur=")
+        try:
+            stages[name] = float(rest)
+        except ValueError:
+            continue
+    return stages
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def post_letter(base_url: str, letter: dict) -> dict:
+    with open(letter["path"], "rb") as f:
+        data = f.read()
+    start = time.perf_counter()
+    response = httpx.post(f"{base_url}/extract-vlm", files={"file": (os.path.basename(letter["path"]), data,
+                                                                     "application/pdf")}, timeout=600)
+    return {"seconds": time.perf_counter() - start, "status": response.status_code,
+            "stages": parse_server_timing(response.headers.get("server-timing")),
+            "mismatches": field_mismatches(response), **letter}
+
+
+# Expected fields the response got wrong or left empty (all of them for a
+# failed request)
+def field_mismatches(response) -> list:
+    result = {}
+    if response.status_code == 200:
+        result = response.json()
+        # /extract-vlm returns the result JSON-encoded as a string
+        if isinstance(result, str):
+            result = json.loads(result)
+    return [field for field, value in EXPECTED_FIELDS.items() if result.get(field) != value]
+
+
+def run_level(base_url: str, pid: int, corpus, concurrency: int, n_docs: int) -> dict:
+    letters = [corpus[i % len(corpus)] for i in range(n_docs)]
+    sampler = RssSampler(pid)
+    sampler.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        runs = list(pool.map(lambda letter: post_letter(base_url, letter), letters))
+    wall = time.perf_counter() - start
+    peak_rss = sampler.stop()
+
+    latencies = [run["seconds"] for run in runs]
+    stage_names = sorted({name for run in runs for name in run["stages"]})
+    stages = {name: {"mean_ms": round(statistics.mean(run["stages"].get(name, 0.0) for run in runs), 1),
+                     "p95_ms": round(percentile([run["stages"].get(name, 0.0) for run in runs], 0.95), 1)}
+              for name in stage_names}
+    by_kind = {kind: round(statistics.mean(r["seconds"] for r in runs if r["kind"] == kind), 3)
+               for kind in sorted({r["kind"] for r in runs})}
+    mismatches_by_bank = {bank: sum(len(r["mismatches"]) for r in runs if r["bank"] == bank)
+                          for bank in sorted({r["bank"] for r in runs})}
+    mismatches_by_field = {field: sum(1 for r in runs if field in r["mismatches"]) for field in EXPECTED_FIELDS}
+    return {"concurrency": concurrency, "documents": len(runs), "pages": sum(r["pages"] for r in runs),
+            "errors": sum(1 for r in runs if r["status"] != 200),
+            "field_mismatches": sum(len(r["mismatches"]) for r in runs),
+            "fields_checked": len(runs) * len(EXPECTED_FIELDS),
+            "documents_with_mismatches": sum(1 for r in runs if r["mismatches"]),
+            "mismatches_by_bank": mismatches_by_bank, "mismatches_by_field": mismatches_by_field,
+            "wall_seconds": round(wall, 3),
+            "pages_per_second": round(sum(r["pages"] for r in runs) / wall, 2),
+            "docs_per_second": round(len(runs) / wall, 3),
+            "latency_p50_seconds": round(percentile(latencies, 0.5), 3),
+            "latency_p95_seconds": round(percentile(latencies, 0.95), 3),
+            "mean_latency_by_kind_seconds": by_kind, "peak_rss_mb": round(peak_rss, 1), "stages": stages}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,2,4", help="comma-separated client concurrency levels")
+    parser.add_argument("--docs", type=int, default=8, help="documents posted per concurrency level")
+    parser.add_argument("--pages", type=int, default=8, help="pages per synthetic letter")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake VLM seconds per call")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--cache", action="store_true", help="leave the result caches on")
+    parser.add_argument("--out", default="bench_pipeline.json")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    fake = FakeOllamaServer(("127.0.0.1", 0), latency=args.latency, jitter=args.jitter)
+    fake.start()
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus = build_corpus(tmp_dir, args.pages)
+        # The server runs in the temp dir so its logs/ and structured_fields.json stay out of the repo
+        repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        python_path = os.pathsep.join(filter(None, [repo_root, os.environ.get("PYTHONPATH")]))
+        env = dict(os.environ, OLLAMA_HOST=fake.url, PRELOAD_MODELS="0", UPLOAD_SPOOL_DIR=tmp_dir,
+                   PYTHONPATH=python_path)
+        if not args.cache:
+            env["RESULT_CACHE_ENABLED"] = "0"
+        server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                                   "--port", str(port), "--log-level", "warning"],
+                                  env=env, cwd=tmp_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(600):
+                try:
+                    if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if server.poll() is not None:
+                    raise SystemExit("API server exited during startup")
+                time.sleep(0.1)
+            startup_rss = tree_rss_mb(server.pid)
+
+            results = []
+            for concurrency in levels:
+                level = run_level(base_url, server.pid, corpus, concurrency, args.docs)
+                results.append(level)
+                print(f"c={concurrency}: {level['pages_per_second']} pages/s, "
+                      f"p50 {level['latency_p50_seconds']}s, p95 {level['latency_p95_seconds']}s, "
+                      f"peak RSS {level['peak_rss_mb']} MB, errors {level['errors']}, "
+                      f"field mismatches {level['field_mismatches']}/{level['fields_checked']} "
+                      f"{level['mismatches_by_bank']}")
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    report = {"timestamp": datetime.now(timezone.utc).isoformat(), "revision": git_revision(),
+              "settings": {"pages_per_letter": args.pages, "docs_per_level": args.docs,
+                           "fake_latency": args.latency, "fake_jitter": args.jitter, "cache": args.cache,
+                           "corpus": [{k: v for k, v in letter.items() if k != "path"} for letter in corpus]},
+              "startup_rss_mb": round(startup_rss, 1), "fake_ollama_requests": fake.requests,
+              "levels": results}
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
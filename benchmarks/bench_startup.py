@@ -0,0 +1,124 @@
+# Startup benchmark: time to a healthy API and per-worker memory for each
+# ENABLED_PIPELINES setting (e.g. a VLM-only worker vs a full VLM + RAG worker)
+# Starts the API with uvicorn once per configuration and repeat, waits for
+# /health, and records the startup time, the RSS of the worker process tree and
+# the per-pipeline import time / RSS that /health reports. Then posts one
+# synthetic letter to /extract-vlm (against the fake Ollama server) to time the
+# first request and the RSS after it, which is where a lazily loaded pipeline
+# pays its import cost. Everything goes to a JSON file so runs can be compared.
+#
+# Usage: python -m benchmarks.bench_startup [--configs "vlm;vlm,rag"] [--repeats 3]
+#                                           [--lazy] [--out bench_startup.json]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+from benchmarks.bench_pipeline import build_corpus, free_port, git_revision, tree_rss_mb
+from benchmarks.fake_ollama import FakeOllamaServer
+
+
+def start_worker(enabled: str, preload: bool, fake_url: str, tmp_dir: str):
+    port = free_port()
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    python_path = os.pathsep.join(filter(None, [repo_root, os.environ.get("PYTHONPATH")]))
+    env = dict(os.environ, ENABLED_PIPELINES=enabled, PRELOAD_MODELS="1" if preload else "0",
+               OLLAMA_HOST=fake_url, RESULT_CACHE_ENABLED="0", UPLOAD_SPOOL_DIR=tmp_dir, PYTHONPATH=python_path)
+    # The server runs in the temp dir so its logs/ and structured_fields.json stay out of the repo
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                               "--port", str(port), "--log-level", "warning"],
+                              env=env, cwd=tmp_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def wait_healthy(server, base_url: str, timeout: float = 600) -> dict:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            response = httpx.get(f"{base_url}/health", timeout=1)
+            if response.status_code == 200:
+                return response.json()
+        except httpx.TransportError:
+            pass
+        if server.poll() is not None:
+            raise SystemExit("API server exited during startup")
+        time.sleep(0.05)
+    raise SystemExit("API server did not become healthy")
+
+
+def run_once(enabled: str, preload: bool, fake_url: str, tmp_dir: str, letter_path: str) -> dict:
+    start = time.perf_counter()
+    server, base_url = start_worker(enabled, preload, fake_url, tmp_dir)
+    try:
+        health = wait_healthy(server, base_url)
+        startup_seconds = time.perf_counter() - start
+        startup_rss = tree_rss_mb(server.pid)
+
+        with open(letter_path, "rb") as f:
+            data = f.read()
+        request_start = time.perf_counter()
+        response = httpx.post(f"{base_url}/extract-vlm", files={"file": ("letter.pdf", data, "application/pdf")},
+                              timeout=600)
+        first_request_seconds = time.perf_counter() - request_start
+        pipelines = httpx.get(f"{base_url}/health", timeout=5).json().get("pipelines", {})
+        return {"startup_seconds": startup_seconds, "startup_rss_mb": startup_rss,
+                "first_request_seconds": first_request_seconds, "first_request_status": response.status_code,
+                "after_request_rss_mb": tree_rss_mb(server.pid), "startup_pipelines": health.get("pipelines", {}),
+                "pipelines": pipelines}
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def summarize(enabled: str, preload: bool, runs) -> dict:
+    def median(key):
+        return round(statistics.median(run[key] for run in runs), 3)
+
+    return {"enabled_pipelines": enabled, "preload": preload, "repeats": len(runs),
+            "startup_seconds": median("startup_seconds"), "startup_rss_mb": median("startup_rss_mb"),
+            "first_request_seconds": median("first_request_seconds"),
+            "after_request_rss_mb": median("after_request_rss_mb"),
+            "first_request_status": runs[-1]["first_request_status"],
+            "startup_pipelines": runs[-1]["startup_pipelines"], "pipelines": runs[-1]["pipelines"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", default="vlm;vlm,rag", help="semicolon-separated ENABLED_PIPELINES values")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--lazy", action="store_true", help="start without PRELOAD_MODELS (import on first use)")
+    parser.add_argument("--pages", type=int, default=4, help="pages of the letter posted after startup")
+    parser.add_argument("--out", default="bench_startup.json")
+    args = parser.parse_args()
+    preload = not args.lazy
+
+    fake = FakeOllamaServer(("127.0.0.1", 0), latency=0.05, jitter=0.0)
+    fake.start()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        letter_path = next(letter["path"] for letter in build_corpus(tmp_dir, args.pages) if letter["kind"] == "text")
+        for enabled in args.configs.split(";"):
+            runs = [run_once(enabled, preload, fake.url, tmp_dir, letter_path) for _ in range(args.repeats)]
+            summary = summarize(enabled, preload, runs)
+            results.append(summary)
+            print(f"ENABLED_PIPELINES={enabled}: startup {summary['startup_seconds']}s, "
+                  f"RSS {summary['startup_rss_mb']} MB, first request {summary['first_request_seconds']}s, "
+                  f"RSS after {summary['after_request_rss_mb']} MB")
+
+    report = {"timestamp": datetime.now(timezone.utc).isoformat(), "revision": git_revision(),
+              "settings": {"repeats": args.repeats, "preload": preload, "pages": args.pages}, "configs": results}
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
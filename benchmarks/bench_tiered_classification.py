@@ -0,0 +1,115 @@
+# Benchmark: "full" vs "tiered" page classification
+# Runs every PDF in a directory through pdf_to_images, filter_bank_copy and
+# filter_and_rename_pages in both CLASSIFY_MODEs, then reports the time spent
+# (in total and in filter_bank_copy) and whether the bank copy page and the
+# page labels came out the same.
+#
+# --synthetic first writes the bench_pipeline letters (text-layer and scanned)
+# into pdf_dir, plus scanned letters whose bank copy marker sits in the lower
+# half of the first page, and scanned letters behind a blank cover sheet
+# (front and back), whose pages OCR to no text and go through the bank copy
+# probe. OCR needs Tesseract language data (TESSDATA_PREFIX).
+#
+# Usage: python -m benchmarks.bench_tiered_classification <pdf_dir> [--synthetic] [--bank "CIMB BANK BERHAD"]
+#                                                          [--out results.json]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import time
+
+import pymupdf
+
+from app.agents import preprocess
+from app.utils.page_store import PageStore
+from benchmarks.bench_pipeline import build_corpus, letter_pages, write_letter
+
+MODES = ["full", "tiered"]
+
+
+def classify(pdf_path: str, bank_name: str, mode: str):
+    preprocess.CLASSIFY_MODE = mode
+    start = time.perf_counter()
+    with PageStore() as store, contextlib.redirect_stdout(io.StringIO()):
+        preprocess.pdf_to_images(pdf_path, store)
+        bank_copy_start = time.perf_counter()
+        preprocess.filter_bank_copy(store)
+        bank_copy_seconds = time.perf_counter() - bank_copy_start
+        preprocess.filter_and_rename_pages(bank_name, store)
+        pages = store.page_count
+        bank_copy = store.roles.get("bank_copy")
+        labels = dict(store.labels)
+    return {"seconds": time.perf_counter() - start, "bank_copy_seconds": bank_copy_seconds, "pages": pages,
+            "bank_copy": bank_copy, "labels": labels}
+
+
+def build_synthetic(out_dir: str, n_pages: int = 8, seed: int = 11):
+    os.makedirs(out_dir, exist_ok=True)
+    build_corpus(out_dir, n_pages)
+    rng = random.Random(seed)
+    for bank in ("cimb", "public"):
+        pages = letter_pages(bank, n_pages, rng)
+        header, rest = pages[0].split("STRICTLY PRIVATE", 1)
+        cover = "\n".join(f"Reference line {i}: LO/2024/{1000 + i}" for i in range(30))
+        pages[0] = header + cover + "\n\nSTRICTLY PRIVATE" + rest[:1200]
+        write_letter(os.path.join(out_dir, f"{bank}_low_marker_image.pdf"), pages, image_only=True)
+    for bank in ("cimb", "public"):
+        path = os.path.join(out_dir, f"{bank}_blank_cover_image.pdf")
+        write_letter(path, letter_pages(bank, n_pages, rng), image_only=True)
+        add_blank_cover(path, rng)
+
+
+# Put two scanned blank sheets (faint speckle, like a scanner's blank page)
+# in front of a letter
+def add_blank_cover(path: str, rng: random.Random):
+    doc = pymupdf.open(path)
+    width, height = doc[0].rect.width, doc[0].rect.height
+    for _ in range(2):
+        samples = bytearray(255 - (rng.random() < 0.002) * rng.randint(20, 60) for _ in range(int(width * height)))
+        pix = pymupdf.Pixmap(pymupdf.csGRAY, int(width), int(height), bytes(samples), False)
+        doc.new_page(pno=0, width=width, height=height).insert_image(pymupdf.Rect(0, 0, width, height), pixmap=pix)
+    doc.save(path + ".tmp")
+    doc.close()
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pdf_dir")
+    parser.add_argument("--bank", default="CIMB BANK BERHAD")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--synthetic", action="store_true", help="write the synthetic letters into pdf_dir first")
+    args = parser.parse_args()
+    if args.synthetic:
+        build_synthetic(args.pdf_dir)
+
+    files = sorted(f for f in os.listdir(args.pdf_dir) if f.lower().endswith(".pdf"))
+    results = []
+    for name in files:
+        pdf_path = os.path.join(args.pdf_dir, name)
+        runs = {mode: classify(pdf_path, args.bank, mode) for mode in MODES}
+        same = all(runs[m]["bank_copy"] == runs["full"]["bank_copy"] and
+                   runs[m]["labels"] == runs["full"]["labels"] for m in MODES)
+        results.append({"file": name, "same_classification": same, **runs})
+        print(f"{name}: pages={runs['full']['pages']} "
+              + " ".join(f"{m}={runs[m]['seconds']:.2f}s (bank copy {runs[m]['bank_copy_seconds']:.2f}s)"
+                         for m in MODES)
+              + f" same={same}")
+
+    if results:
+        totals = {m: sum(r[m]["seconds"] for r in results) for m in MODES}
+        matched = sum(r["same_classification"] for r in results)
+        print(f"Total: " + " ".join(f"{m}={totals[m]:.2f}s" for m in MODES)
+              + f" speedup={totals['full'] / max(totals['tiered'], 1e-9):.2f}x"
+              + f" identical={matched}/{len(results)}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Benchmark: VLM call batching modes ("per_page", "section", "document")
+# Builds a synthetic CIMB letter of offer whose facility and property sections
+# run over two pages, runs it through run_extraction against the fake Ollama
+# server in each mode and reports VLM calls, images sent, wall time and how
+# many fields came back filled.
+#
+# Usage: python -m benchmarks.bench_vlm_modes [--latency 0.5] [--repeat 3] [--out results.json]
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import pymupdf
+
+from benchmarks.fake_ollama import FakeOllamaServer
+
+MODES = ["per_page", "section", "document"]
+
+FILLER = "The Borrower shall pay interest on the facility at the rate stated in the schedule. " * 12
+
+# One entry per page of the synthetic letter
+LETTER_PAGES = [
+    "CIMB BANK BERHAD (13491-P)\nSTRICTLY PRIVATE AND HIGHLY CONFIDENTIAL\n"
+    "We are pleased to inform you that the Bank has approved the following facility.",
+    "Type of facility: Term Loan (TL)\nPayment amount (RM per payment): RM5,000.00",
+    "Total Facilities: RM1,000,000.00",
+    "Salinan kepada: Abraham Ooi & Partners",
+    "To finance the purchase of the property described below.",
+    "Individual title ABC 0000, Lot 2, 45000 Kuala Selangor",
+    "Execution of joint and several guarantee in favour of the bank by Ali bin Abu.",
+]
+
+
+def build_letter(path: str):
+    doc = pymupdf.open()
+    for text in LETTER_PAGES:
+        page = doc.new_page()
+        page.insert_textbox(pymupdf.Rect(36, 36, 559, 806), text + "\n\n" + FILLER, fontsize=10)
+    doc.save(path)
+    doc.close()
+
+
+def run_mode(pdf_path: str, mode: str):
+    from app.agents import agent_config
+    from app.agents.pipeline import run_extraction
+
+    agent_config.VLM_MODE = mode
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = asyncio.run(run_extraction(pdf_path, "bench.pdf"))
+    seconds = time.perf_counter() - start
+    calls = [call for call in result["metadata"]["vlm_calls"] if call["purpose"] == "extract"]
+    filled = sum(1 for key, value in result.items() if key != "metadata" and value not in ("", [], None))
+    return {"seconds": seconds, "vlm_calls": len(calls), "images": sum(call.get("images", 1) for call in calls),
+            "fields_filled": filled}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.5, help="fake VLM seconds per single-image call")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(("127.0.0.1", 0), latency=args.latency)
+    server.start()
+    os.environ["OLLAMA_HOST"] = server.url
+    os.environ.setdefault("PAGE_WORKERS", "1")
+
+    from app.utils import result_cache
+    result_cache.RESULT_CACHE_ENABLED = False
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "letter.pdf")
+        build_letter(pdf_path)
+        results = {}
+        for mode in MODES:
+            runs = [run_mode(pdf_path, mode) for _ in range(args.repeat)]
+            results[mode] = {**runs[-1], "seconds": min(run["seconds"] for run in runs)}
+            print(f"{mode:9s} calls={results[mode]['vlm_calls']} images={results[mode]['images']} "
+                  f"wall={results[mode]['seconds']:.2f}s fields={results[mode]['fields_filled']}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"pages": len(LETTER_PAGES), "latency": args.latency, "modes": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
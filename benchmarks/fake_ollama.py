@@ -0,0 +1,155 @@
+# Minimal stand-in for the Ollama HTTP API, for running the pipeline without a GPU.
+# Answers /api/chat and /api/generate after a configurable delay, and /api/tags
+# for health checks. Point the service at it with OLLAMA_HOST=http://127.0.0.1:<port>
+#
+# Usage: python -m benchmarks.fake_ollama [--port 11435] [--latency 0.5] [--jitter 0.1]
+
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BANK_NAME = "CIMB Bank Berhad"
+
+# Canned extraction answer; only the requested fields are returned
+SAMPLE_FIELDS = {
+    "date": "6 November 2024",
+    "borrower_name": "Robert Dass",
+    "borrower_registration_number": "202001234567 (1234567-A)",
+    "borrower_address": "BL 13A-05, Zeva Residence, 43300 Seri Kembangan, Selangor",
+    "bank_name": "CIMB BANK BERHAD",
+    "bank_address": "Level 13, Menara CIMB, Jalan Stesen Sentral 2, 50470 Kuala Lumpur",
+    "bank_registration_number": "197201001799 (13491-P)",
+    "subject_of_FA": ["Term Loan (TL) - RM1,000,000.00"],
+    "total_loan_amount": "RM1,000,000.00",
+    "guarantor_name": ["Ali bin Abu"],
+    "guarantor_nric": ["800101145678"],
+    "corporate_guarantor_name": ["ABC Sdn Bhd"],
+    "corporate_guarantor_registration_number": ["201901000001"],
+    "law_firm_name": "Abraham Ooi & Partners",
+    "law_firm_address": "28-b & 30-b, 2nd Floor, Jalan Ss 21/62, 47400 Petaling Jaya, Selangor",
+    "property_title": "Individual Title ABC 0000, Lot 2",
+    "property_address": ["49, Jalan BSC 6A/2, 45000 Kuala Selangor"],
+}
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.5, jitter=0.0, fail_rate=0.0):
+        super().__init__(address, FakeOllamaHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.paths = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def _fields_from_request(body: dict):
+    fmt = body.get("format")
+    if isinstance(fmt, dict) and fmt.get("properties"):
+        return list(fmt["properties"])
+    text = " ".join(str(m.get("content", "")) for m in body.get("messages", []))
+    # The field list sits between these two markers in the extraction prompt
+    text = text.split("Fields to extract", 1)[-1].split("Example valid output", 1)[0]
+    return [field for field in SAMPLE_FIELDS if f'"{field}"' in text]
+
+
+def _answer(body: dict) -> str:
+    text = " ".join(str(m.get("content", "")) for m in body.get("messages", []))
+    if "bank name" in text.lower() and "Fields to extract" not in text:
+        fmt = body.get("format")
+        if isinstance(fmt, dict) and "bank_name" in fmt.get("properties", {}):
+            return json.dumps({"bank_name": BANK_NAME})
+        return BANK_NAME
+    fields = _fields_from_request(body) or list(SAMPLE_FIELDS)
+    return json.dumps({field: SAMPLE_FIELDS.get(field, "") for field in fields})
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path in ("/api/tags", "/api/ps"):
+            self._send(200, {"models": [{"name": "qwen2.5vl:7b"}, {"name": "qwen3:8b"}]})
+        elif self.path == "/":
+            self._send(200, {"status": "Ollama is running"})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.paths[self.path] = server.paths.get(self.path, 0) + 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            images = sum(len(m.get("images") or []) for m in body.get("messages", []))
+            time.sleep(max(0.0, server.latency * max(1, images) ** 0.5 + random.uniform(-1, 1) * server.jitter))
+            if random.random() < server.fail_rate:
+                self._send(500, {"error": "injected failure"})
+                return
+            now = datetime.now(timezone.utc).isoformat()
+            content = _answer(body)
+            if self.path == "/api/chat":
+                self._send(200, {"model": body.get("model", ""), "created_at": now,
+                                 "message": {"role": "assistant", "content": content},
+                                 "done": True, "done_reason": "stop", "eval_count": len(content) // 4})
+            elif self.path == "/api/generate":
+                self._send(200, {"model": body.get("model", ""), "created_at": now,
+                                 "response": "" if not body.get("prompt") else content,
+                                 "done": True, "done_reason": "load" if not body.get("prompt") else "stop"})
+            else:
+                self._send(404, {"error": "not found"})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per call")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer((args.host, args.port), args.latency, args.jitter, args.fail_rate)
+    print(f"Fake Ollama listening on {server.url} (latency {args.latency}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()